@@ -0,0 +1,6 @@
+"""
+Offline benchmarks of EduBot's own overhead.
+
+OpenAI, Replicate, Stability and web pages are replaced by local fakes with configurable latencies, so the suite needs
+no API keys or network access. Run it with: python -m benchmarks --help
+"""
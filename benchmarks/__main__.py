@@ -0,0 +1,111 @@
+"""
+Command line entry point, run: python -m benchmarks --help
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Measure EduBot's overhead with fake providers, no API keys or network access are needed.",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=20, help="Calls to each operation."
+    )
+    parser.add_argument(
+        "--context-sizes",
+        type=_int_list,
+        default=[10, 100, 1000],
+        help="Comma separated numbers of messages passed to gpt_answer.",
+    )
+    parser.add_argument(
+        "--db-sizes",
+        type=_int_list,
+        default=[0, 10000],
+        help="Comma separated numbers of messages already in the database.",
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.0, help="Seconds per OpenAI call."
+    )
+    parser.add_argument(
+        "--replicate-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per image caption.",
+    )
+    parser.add_argument(
+        "--stability-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per generated image.",
+    )
+    parser.add_argument(
+        "--fetch-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per web page download.",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print results as JSON lines."
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    # Use a throwaway SQLite database unless a config is given
+    if "EDUBOT_CONFIG" not in os.environ:
+        directory = tempfile.mkdtemp(prefix="edubot-benchmark-")
+        config = os.path.join(directory, "config.ini")
+        with open(config, "w") as f:
+            f.write(
+                "[edubot]\n"
+                "openai_key = benchmark\n"
+                f"database = sqlite:///{os.path.join(directory, 'edubot.db')}\n"
+            )
+        os.environ["EDUBOT_CONFIG"] = config
+
+    from benchmarks import fakes, runner, synthetic
+    from edubot.bot import EduBot
+
+    fakes.install(
+        llm_latency=args.llm_latency,
+        replicate_latency=args.replicate_latency,
+        stability_latency=args.stability_latency,
+        fetch_latency=args.fetch_latency,
+    )
+
+    bot = EduBot("edubot", "benchmark", "You are a helpful teaching assistant.")
+
+    probe = runner.Probe()
+    probe.install()
+
+    runner.warm_up(bot)
+
+    results = []
+    populated = 0
+
+    for db_size in sorted(args.db_sizes):
+        synthetic.populate_database(db_size - populated, "benchmark")
+        populated = db_size
+
+        for context_size in args.context_sizes:
+            results += runner.run(bot, probe, context_size, db_size, args.iterations)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result.as_dict()))
+    else:
+        print(runner.format_table(results))
+
+
+if __name__ == "__main__":
+    main()
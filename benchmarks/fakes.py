@@ -0,0 +1,203 @@
+"""
+Local stand-ins for the providers EduBot calls, each waits for a configurable latency instead of doing real work.
+"""
+import asyncio
+import io
+import time
+from typing import AsyncIterator, Iterator
+
+from benchmarks.synthetic import article_html, words
+
+# The number of words in fake completions
+REPLY_WORDS = 40
+SUMMARY_WORDS = 30
+
+
+class FakeChatModel:
+    """
+    Replaces langchain's ChatOpenAI, replies with filler text.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        :param latency: Seconds each completion takes, spread over the chunks when streaming.
+        """
+        self.latency = latency
+        self.calls = 0
+
+    def __reply(self) -> str:
+        self.calls += 1
+        return words(REPLY_WORDS, seed=self.calls)
+
+    def __call__(self, messages: list, **kwargs):
+        from langchain.schema import AIMessage
+
+        time.sleep(self.latency)
+        return AIMessage(content=self.__reply())
+
+    def stream(self, messages: list, **kwargs) -> Iterator:
+        from langchain.schema.messages import AIMessageChunk
+
+        chunks = self.__reply().split(" ")
+        for chunk in chunks:
+            time.sleep(self.latency / len(chunks))
+            yield AIMessageChunk(content=f"{chunk} ")
+
+    async def apredict_messages(self, messages: list, **kwargs):
+        from langchain.schema import AIMessage
+
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self.__reply())
+
+    async def astream(self, messages: list, **kwargs) -> AsyncIterator:
+        from langchain.schema.messages import AIMessageChunk
+
+        chunks = self.__reply().split(" ")
+        for chunk in chunks:
+            await asyncio.sleep(self.latency / len(chunks))
+            yield AIMessageChunk(content=f"{chunk} ")
+
+
+class FakeChatCompletion:
+    """
+    Replaces openai.ChatCompletion, summarises every page with filler text.
+    """
+
+    latency = 0.0
+    calls = 0
+
+    @classmethod
+    def __response(cls, messages: list[dict]) -> dict:
+        cls.calls += 1
+        prompt_words = sum(len(message["content"].split()) for message in messages)
+
+        return {
+            "choices": [
+                {
+                    "message": {
+                        "role": "assistant",
+                        "content": words(SUMMARY_WORDS, seed=cls.calls),
+                    }
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_words,
+                "completion_tokens": SUMMARY_WORDS,
+            },
+        }
+
+    @classmethod
+    def create(cls, messages: list[dict], **kwargs) -> dict:
+        time.sleep(cls.latency)
+        return cls.__response(messages)
+
+    @classmethod
+    async def acreate(cls, messages: list[dict], **kwargs) -> dict:
+        await asyncio.sleep(cls.latency)
+        return cls.__response(messages)
+
+
+class FakeReplicateClient:
+    """
+    Replaces the Replicate client, captions every image with the same text.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def run(self, model: str, input: dict) -> str:
+        self.calls += 1
+        # Read the upload like the real client does
+        input["image"].read()
+        time.sleep(self.latency)
+        return "a photo of a whiteboard covered in equations"
+
+
+class FakeStabilityInference:
+    """
+    Replaces stability_sdk's StabilityInference, generates a blank PNG for every prompt.
+    """
+
+    latency = 0.0
+
+    def __init__(self, key: str, verbose: bool = False, **kwargs):
+        pass
+
+    def generate(self, prompt: str, **kwargs) -> list:
+        from PIL import Image
+        from stability_sdk.utils import generation
+
+        time.sleep(self.latency)
+
+        image_bytes = io.BytesIO()
+        Image.new("RGB", (512, 512), "white").save(image_bytes, format="PNG")
+
+        return [
+            generation.Answer(
+                artifacts=[
+                    generation.Artifact(
+                        type=generation.ARTIFACT_IMAGE,
+                        mime="image/png",
+                        binary=image_bytes.getvalue(),
+                    )
+                ]
+            )
+        ]
+
+
+class FakeWeb:
+    """
+    Replaces trafilatura.fetch_url, every URL is an article of the same length.
+    """
+
+    def __init__(self, latency: float = 0.0, article_words: int = 1500):
+        """
+        :param latency: Seconds each page takes to download.
+        :param article_words: The number of words in each article.
+        """
+        self.latency = latency
+        self.article_words = article_words
+        self.calls = 0
+
+    def fetch_url(self, url: str, **kwargs) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        return article_html(self.article_words, seed=url)
+
+
+def install(
+    llm_latency: float = 0.0,
+    replicate_latency: float = 0.0,
+    stability_latency: float = 0.0,
+    fetch_latency: float = 0.0,
+) -> None:
+    """
+    Replace every provider EduBot uses with a fake, this must be called before EduBot is used.
+
+    :param llm_latency: Seconds each OpenAI completion takes.
+    :param replicate_latency: Seconds each image caption takes.
+    :param stability_latency: Seconds each generated image takes.
+    :param fetch_latency: Seconds each web page takes to download.
+    """
+    import openai
+    import stability_sdk.client
+    import trafilatura
+
+    from edubot import async_bot, bot
+
+    chat_model = FakeChatModel(llm_latency)
+    bot.get_llm = async_bot.get_llm = lambda: chat_model
+
+    FakeChatCompletion.latency = llm_latency
+    openai.ChatCompletion = FakeChatCompletion
+
+    replicate_client = FakeReplicateClient(replicate_latency)
+    bot.get_replicate_client = lambda: replicate_client
+    bot.REPLICATE_KEY = "benchmark"
+
+    FakeStabilityInference.latency = stability_latency
+    stability_sdk.client.StabilityInference = FakeStabilityInference
+    bot.DREAMSTUDIO_KEY = "benchmark"
+
+    trafilatura.fetch_url = FakeWeb(fetch_latency).fetch_url
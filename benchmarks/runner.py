@@ -0,0 +1,277 @@
+"""
+Runs EduBot operations against the fake providers and collects latency, query and tokenization measurements.
+"""
+import datetime
+import logging
+import math
+import time
+from typing import Callable, Iterator
+
+from benchmarks import synthetic
+
+logger = logging.getLogger(__name__)
+
+# The percentiles of latency that are reported
+PERCENTILES = (50, 90, 99)
+
+
+class WhitespaceEncoding:
+    """
+    Stands in for a tiktoken encoding when its data can't be downloaded, one token per word.
+    """
+
+    def encode(self, text: str) -> list[str]:
+        return text.split()
+
+    def decode(self, tokens: list[str]) -> str:
+        return " ".join(tokens)
+
+
+class TimedEncoding:
+    """
+    Wraps an encoding, adding the time spent encoding and decoding to a Probe.
+    """
+
+    def __init__(self, encoding, probe: "Probe"):
+        self.encoding = encoding
+        self.probe = probe
+
+    def encode(self, text: str, **kwargs) -> list:
+        start = time.perf_counter()
+        try:
+            return self.encoding.encode(text, **kwargs)
+        finally:
+            self.probe.tokenize_seconds += time.perf_counter() - start
+
+    def decode(self, tokens: list, **kwargs) -> str:
+        start = time.perf_counter()
+        try:
+            return self.encoding.decode(tokens, **kwargs)
+        finally:
+            self.probe.tokenize_seconds += time.perf_counter() - start
+
+
+class Probe:
+    """
+    Counts the SQL statements executed and the time spent tokenizing, while it is installed.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.tokenize_seconds = 0.0
+        self.__encodings: dict[str, TimedEncoding] = {}
+
+    def install(self) -> None:
+        """
+        Listen to the database engine and wrap the tokenizer.
+        """
+        from sqlalchemy import event
+
+        from edubot import tokens
+        from edubot.sql import engine
+
+        event.listen(engine, "before_cursor_execute", self.__count_query)
+
+        real_get_encoding = tokens.get_encoding
+
+        def get_encoding(model: str) -> TimedEncoding:
+            if model not in self.__encodings:
+                try:
+                    encoding = real_get_encoding(model)
+                except Exception as e:
+                    logger.warning(
+                        f"Couldn't load the {model} encoding ({e}), counting words instead."
+                    )
+                    encoding = WhitespaceEncoding()
+                self.__encodings[model] = TimedEncoding(encoding, self)
+
+            return self.__encodings[model]
+
+        tokens.get_encoding = get_encoding
+
+    def __count_query(self, *args) -> None:
+        self.queries += 1
+
+    def reset(self) -> None:
+        self.queries = 0
+        self.tokenize_seconds = 0.0
+
+
+class Result:
+    """
+    The measurements of one operation at one context size and database size.
+    """
+
+    def __init__(self, operation: str, context_size: int, db_size: int):
+        self.operation = operation
+        self.context_size = context_size
+        self.db_size = db_size
+        self.latencies: list[float] = []
+        self.queries: list[int] = []
+        self.tokenize_seconds: list[float] = []
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the "p"th percentile latency in seconds, using the nearest rank.
+        """
+        latencies = sorted(self.latencies)
+        return latencies[max(math.ceil(p / 100 * len(latencies)) - 1, 0)]
+
+    def as_dict(self) -> dict:
+        return {
+            "operation": self.operation,
+            "context_size": self.context_size,
+            "db_size": self.db_size,
+            "calls": len(self.latencies),
+            **{f"p{p}_ms": self.percentile(p) * 1000 for p in PERCENTILES},
+            "queries_per_call": sum(self.queries) / len(self.queries),
+            "tokenize_ms_per_call": sum(self.tokenize_seconds)
+            / len(self.tokenize_seconds)
+            * 1000,
+        }
+
+
+def _operations(
+    bot, context_size: int, iterations: int, name: str
+) -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield each call to benchmark, labelled with its operation, in the order they must run.
+
+    Each call must be made before the next one is requested, as later calls depend on earlier results.
+
+    :param name: Makes the threads, URLs and images unique to this run.
+    """
+    thread = f"bench-{name}"
+    messages = synthetic.thread_messages(context_size + iterations, seed=thread)
+
+    replies: list[tuple[str | None, datetime.datetime]] = []
+    for i in range(iterations):
+        context = messages[i : i + context_size]
+        yield "gpt_answer", lambda: replies.append(
+            (bot.gpt_answer(context, thread), context[-1]["time"])
+        )
+
+    for reply, time_sent in replies:
+        completion = {
+            "message": reply,
+            "time": time_sent + datetime.timedelta(seconds=10),
+        }
+        yield "change_completion_score", lambda: bot.change_completion_score(
+            1, completion, thread
+        )
+
+    for reply, _ in replies:
+        yield "change_completion_score (id)", lambda: bot.change_completion_score(
+            1, reply.id, thread
+        )
+
+    # Requests that happen after the conversation
+    after = messages[-1]["time"]
+
+    def message(i: int) -> dict:
+        return {
+            "username": synthetic.USERS[i % len(synthetic.USERS)],
+            "message": synthetic.words(12, f"{thread}-request-{i}"),
+            "time": after + datetime.timedelta(minutes=i + 1),
+        }
+
+    for i in range(iterations):
+        yield "summarise_url", lambda: bot.summarise_url(
+            f"https://example.com/{thread}/{i}", message(i), thread
+        )
+
+    for i in range(iterations):
+        yield "summarise_url (cached)", lambda: bot.summarise_url(
+            f"https://example.com/{thread}/cached", message(iterations + i), thread
+        )
+
+    for i in range(iterations):
+        image = synthetic.image(seed=f"{thread}-{i}")
+        yield "save_image_to_context", lambda: bot.save_image_to_context(
+            {
+                "username": "alice",
+                "image": image,
+                "time": message(2 * iterations + i)["time"],
+            },
+            thread,
+        )
+
+    image = synthetic.image(seed=f"{thread}-cached")
+    for i in range(iterations):
+        yield "save_image_to_context (cached)", lambda: bot.save_image_to_context(
+            {
+                "username": "bob",
+                "image": image,
+                "time": message(3 * iterations + i)["time"],
+            },
+            thread,
+        )
+
+    for i in range(iterations):
+        yield "generate_image", lambda: bot.generate_image(
+            synthetic.words(10, i), message(4 * iterations + i), thread
+        )
+
+
+def run(
+    bot, probe: Probe, context_size: int, db_size: int, iterations: int
+) -> list[Result]:
+    """
+    Benchmark every operation once per iteration.
+
+    :param bot: An EduBot using the fake providers.
+    :param probe: An installed Probe.
+    :param context_size: The number of messages passed to gpt_answer.
+    :param db_size: The number of messages already in the database, only used to label results.
+    :param iterations: The number of calls to each operation.
+    """
+    from edubot import tokens
+
+    # Start from a cold token count cache, like a new process
+    tokens.clear_cache()
+
+    results: dict[str, Result] = {}
+
+    for operation, call in _operations(
+        bot, context_size, iterations, f"{context_size}-{db_size}"
+    ):
+        result = results.setdefault(operation, Result(operation, context_size, db_size))
+
+        probe.reset()
+        start = time.perf_counter()
+        call()
+        result.latencies.append(time.perf_counter() - start)
+        result.queries.append(probe.queries)
+        result.tokenize_seconds.append(probe.tokenize_seconds)
+
+    return list(results.values())
+
+
+def warm_up(bot) -> None:
+    """
+    Run every operation once so that imports and connection setup aren't measured.
+    """
+    for _, call in _operations(bot, 2, 1, "warm-up"):
+        call()
+
+
+def format_table(results: list[Result]) -> str:
+    """
+    Format results as a plain text table.
+    """
+    header = (
+        f"{'operation':<32}{'context':>8}{'db size':>10}{'calls':>7}"
+        + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES)
+        + f"{'queries':>9}{'tok ms':>9}"
+    )
+    lines = [header, "-" * len(header)]
+
+    for result in results:
+        row = result.as_dict()
+        lines.append(
+            f"{row['operation']:<32}{row['context_size']:>8}{row['db_size']:>10}{row['calls']:>7}"
+            + "".join(f"{row[f'p{p}_ms']:>10.2f}" for p in PERCENTILES)
+            + f"{row['queries_per_call']:>9.1f}{row['tokenize_ms_per_call']:>9.2f}"
+        )
+
+    return "\n".join(lines)
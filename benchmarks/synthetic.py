@@ -0,0 +1,150 @@
+"""
+Generators of synthetic threads, messages, web pages and images.
+
+Everything is generated from a seed, so runs with the same arguments use the same data.
+"""
+import datetime
+import random
+
+from edubot.types import MessageInfo
+
+# Words that chat messages and articles are made of
+VOCABULARY = (
+    "the a an and or but if then because so of to in on at for with about from by "
+    "student teacher lesson course class homework exam grade question answer idea "
+    "learn teach explain understand remember practice study read write think know "
+    "maths science history physics chemistry biology language music art project "
+    "today tomorrow yesterday week term year morning afternoon evening deadline "
+    "good great hard easy quick slow new old big small important interesting "
+    "please thanks sorry yes no maybe sure okay really very quite just also still"
+).split()
+
+# The usernames of people writing synthetic messages
+USERS = ["alice", "bob", "charlie", "dana", "eve", "frank"]
+
+# The time the first synthetic message is sent
+START_TIME = datetime.datetime(2023, 1, 1, 9, 0, 0)
+
+
+def words(count: int, seed: int | str = 0) -> str:
+    """
+    Returns "count" random words separated by spaces.
+    """
+    rng = random.Random(seed)
+    return " ".join(rng.choices(VOCABULARY, k=count))
+
+
+def thread_messages(
+    count: int, seed: int | str = 0, start: datetime.datetime = START_TIME
+) -> list[MessageInfo]:
+    """
+    Generate a chronological conversation between several users.
+
+    :param count: The number of messages.
+    :param seed: Threads with different seeds have different messages.
+    :param start: The time the first message is sent.
+    """
+    rng = random.Random(seed)
+    messages: list[MessageInfo] = []
+    time = start
+
+    for i in range(count):
+        time += datetime.timedelta(seconds=rng.randint(5, 120))
+        messages.append(
+            {
+                "username": rng.choice(USERS),
+                # Most chat messages are short, a few are long
+                "message": words(int(rng.lognormvariate(2.5, 0.8)) + 1, f"{seed}-{i}"),
+                "time": time,
+            }
+        )
+
+    return messages
+
+
+def article_html(word_count: int, seed: int | str = 0) -> str:
+    """
+    Returns a web page with an article of roughly "word_count" words, wrapped in navigation like a real site.
+    """
+    rng = random.Random(seed)
+    paragraphs = []
+
+    remaining = word_count
+    while remaining > 0:
+        length = min(remaining, rng.randint(40, 120))
+        paragraphs.append(f"<p>{words(length, rng.random())}.</p>")
+        remaining -= length
+
+    return (
+        "<html><head><title>Synthetic article</title></head><body>"
+        "<nav><a href='/'>Home</a> <a href='/news'>News</a></nav>"
+        f"<article><h1>{words(8, seed)}</h1>{''.join(paragraphs)}</article>"
+        "<footer>Copyright Synthetic News</footer></body></html>"
+    )
+
+
+def image(size: tuple[int, int] = (1920, 1080), seed: int | str = 0):
+    """
+    Returns an image of random coloured blocks, images with different seeds aren't similar enough to share a caption.
+    """
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+
+    width, height = size
+    for _ in range(24):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle(
+            (x, y, x + rng.randrange(width // 2), y + rng.randrange(height // 2)),
+            fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+        )
+
+    return img
+
+
+def populate_database(
+    message_count: int,
+    platform: str,
+    thread_size: int = 1000,
+    batch_size: int = 5000,
+) -> None:
+    """
+    Fill the database with synthetic threads, so benchmarks run against a database of a realistic size.
+
+    Threads are named "history-<n>" and are added on top of any that already exist.
+
+    :param message_count: The number of messages to add.
+    :param platform: The platform the threads belong to.
+    :param thread_size: The number of messages in each thread.
+    :param batch_size: The number of messages inserted per statement.
+    """
+    from sqlalchemy import func, select
+
+    from edubot import queries
+    from edubot.sql import Session, Thread
+
+    with Session() as session:
+        first = session.scalar(select(func.count(Thread.id)))
+
+        for n in range(first, first + -(-message_count // thread_size)):
+            thread_id = queries.get_or_create_thread(
+                session, platform, f"history-{n}"
+            ).id
+
+            messages = thread_messages(
+                min(thread_size, message_count - (n - first) * thread_size),
+                seed=f"history-{n}",
+            )
+
+            for i in range(0, len(messages), batch_size):
+                queries.insert_messages(
+                    session,
+                    [
+                        {**msg, "thread": thread_id}
+                        for msg in messages[i : i + batch_size]
+                    ],
+                )
+
+        session.commit()
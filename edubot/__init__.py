@@ -35,3 +35,132 @@ environ["OPENAI_API_KEY"] = OPENAI_KEY
 DREAMSTUDIO_KEY: str | None = CONFIG.get("edubot", "dreamstudio_key", fallback=None)
 REPLICATE_KEY: str | None = CONFIG.get("edubot", "replicate_key", fallback=None)
 DATABASE: str = CONFIG.get("edubot", "database")
+# The database URL used by AsyncEduBot, derived from DATABASE if not set
+ASYNC_DATABASE: str | None = CONFIG.get("edubot", "async_database", fallback=None)
+
+# Log every SQL statement, this is expensive so only enable it for debugging
+DATABASE_ECHO: bool = CONFIG.getboolean("edubot", "database_echo", fallback=False)
+
+# Connection pool settings, ignored for in-memory SQLite databases
+DATABASE_POOL_SIZE: int = CONFIG.getint("edubot", "database_pool_size", fallback=5)
+DATABASE_MAX_OVERFLOW: int = CONFIG.getint(
+    "edubot", "database_max_overflow", fallback=10
+)
+# Seconds before a pooled connection is replaced, -1 to never replace connections
+DATABASE_POOL_RECYCLE: int = CONFIG.getint(
+    "edubot", "database_pool_recycle", fallback=-1
+)
+
+# Seconds a statement can run before it is cancelled (Postgres) or can wait for a lock (SQLite), 0 to disable
+DATABASE_STATEMENT_TIMEOUT: float = CONFIG.getfloat(
+    "edubot", "database_statement_timeout", fallback=30
+)
+
+# Hours that web page summaries are cached for
+URL_CACHE_TTL: float = CONFIG.getfloat("edubot", "url_cache_ttl", fallback=168)
+# Hours that pages without content to summarise are remembered for
+URL_CACHE_NEGATIVE_TTL: float = CONFIG.getfloat(
+    "edubot", "url_cache_negative_ttl", fallback=24
+)
+# The maximum number of cached pages, the least recently used are evicted first
+URL_CACHE_SIZE: int = CONFIG.getint("edubot", "url_cache_size", fallback=10000)
+
+# The maximum number of cached image captions, the least recently used are evicted first
+CAPTION_CACHE_SIZE: int = CONFIG.getint("edubot", "caption_cache_size", fallback=10000)
+
+# Seconds that feedback score changes are buffered before being written together, 0 to write them immediately
+FEEDBACK_FLUSH_INTERVAL: float = CONFIG.getfloat(
+    "edubot", "feedback_flush_interval", fallback=0
+)
+# The number of completions with buffered score changes that causes an early write
+FEEDBACK_FLUSH_THRESHOLD: int = CONFIG.getint(
+    "edubot", "feedback_flush_threshold", fallback=100
+)
+
+# The maximum number of threads whose recent context each bot keeps in memory, 0 to disable the cache
+CONTEXT_CACHE_THREADS: int = CONFIG.getint(
+    "edubot", "context_cache_threads", fallback=256
+)
+# The maximum number of messages kept in memory per thread
+CONTEXT_CACHE_MESSAGES: int = CONFIG.getint(
+    "edubot", "context_cache_messages", fallback=2000
+)
+
+# Messages older than this many days are archived by edubot.retention, 0 keeps them forever
+RETENTION_DAYS: int = CONFIG.getint("edubot", "retention_days", fallback=0)
+
+# Limits on the requests and tokens sent to OpenAI per minute by each process, 0 is unlimited
+LLM_REQUESTS_PER_MINUTE: int = CONFIG.getint(
+    "edubot", "llm_requests_per_minute", fallback=0
+)
+LLM_TOKENS_PER_MINUTE: int = CONFIG.getint(
+    "edubot", "llm_tokens_per_minute", fallback=0
+)
+# The maximum number of OpenAI requests in flight at once
+LLM_CONCURRENCY: int = CONFIG.getint("edubot", "llm_concurrency", fallback=8)
+# The number of times a rate limited or failed OpenAI request is retried
+LLM_MAX_RETRIES: int = CONFIG.getint("edubot", "llm_max_retries", fallback=5)
+
+# Seconds each EduBot call is given before it raises edubot.deadlines.DeadlineExceeded, 0 is unlimited
+CALL_TIMEOUT: float = CONFIG.getfloat("edubot", "call_timeout", fallback=0)
+# Send a second attempt of OpenAI and Replicate requests that are slower than usual, using whichever answers first
+HEDGE_REQUESTS: bool = CONFIG.getboolean("edubot", "hedge_requests", fallback=False)
+
+# Hours that completions are cached for and reused for identical prompts, 0 disables the cache
+COMPLETION_CACHE_TTL: float = CONFIG.getfloat(
+    "edubot", "completion_cache_ttl", fallback=0
+)
+# The maximum number of completions cached in the database, and in the memory of each process
+COMPLETION_CACHE_SIZE: int = CONFIG.getint(
+    "edubot", "completion_cache_size", fallback=10000
+)
+COMPLETION_CACHE_MEMORY_SIZE: int = CONFIG.getint(
+    "edubot", "completion_cache_memory_size", fallback=1000
+)
+# Completions requested at a higher temperature aren't cached, as they vary between requests.
+#  Raise this to the bot's temperature to reuse its sampled completions anyway
+COMPLETION_CACHE_MAX_TEMPERATURE: float = CONFIG.getfloat(
+    "edubot", "completion_cache_max_temperature", fallback=0
+)
+
+# The number of newest messages in a thread sent to GPT as they are, older messages are replaced by a rolling summary.
+#  0 disables rolling summaries, sending as much of the context as fits in the prompt instead
+ROLLING_SUMMARY_WINDOW: int = CONFIG.getint(
+    "edubot", "rolling_summary_window", fallback=0
+)
+# The number of messages that age out of the window before they are folded into the summary
+ROLLING_SUMMARY_BATCH: int = CONFIG.getint(
+    "edubot", "rolling_summary_batch", fallback=20
+)
+
+# The number of older messages found by full-text search that are added to prompts, 0 disables retrieval
+RETRIEVAL_RESULTS: int = CONFIG.getint("edubot", "retrieval_results", fallback=0)
+# The maximum tokens of prompts used by the messages found
+RETRIEVAL_TOKENS: int = CONFIG.getint("edubot", "retrieval_tokens", fallback=2000)
+
+# The number of worker processes started by 'python -m edubot.jobs'
+JOB_WORKERS: int = CONFIG.getint("edubot", "job_workers", fallback=4)
+# Seconds between checks for new jobs by idle workers, and for finished jobs by integrations waiting on them
+JOB_POLL_INTERVAL: float = CONFIG.getfloat("edubot", "job_poll_interval", fallback=1.0)
+# Seconds a job can run before it is assumed its worker died, and it is given to another worker
+JOB_TIMEOUT: float = CONFIG.getfloat("edubot", "job_timeout", fallback=600)
+# The number of times a job is run before it fails
+JOB_MAX_ATTEMPTS: int = CONFIG.getint("edubot", "job_max_attempts", fallback=3)
+# Hours the results of finished jobs are kept for
+JOB_RESULT_TTL: float = CONFIG.getfloat("edubot", "job_result_ttl", fallback=24)
+
+# The number of calls run at once by the thread pool shared by every bot in a process, see EduBot.submit
+BOT_WORKERS: int = CONFIG.getint("edubot", "bot_workers", fallback=16)
+
+
+def init() -> None:
+    """
+    Create the database schema and the OpenAI client now, instead of when a bot first uses them.
+
+    This is optional, call it on startup to fail fast on a bad config and keep the first response quick.
+    """
+    from edubot.bot import get_llm
+    from edubot.sql import create_schema
+
+    create_schema()
+    get_llm()
@@ -0,0 +1,631 @@
+"""
+Module for AI processing tasks in asyncio applications
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+from contextlib import aclosing
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable
+
+import aiohttp
+
+from edubot import (
+    captions,
+    completion_cache,
+    deadlines,
+    feedback,
+    metrics,
+    queries,
+    thread_summaries,
+)
+from edubot.bot import (
+    FETCH_WORKERS,
+    FETCHES_PER_HOST,
+    GPT_SETTINGS,
+    BaseEduBot,
+    _chat_hedger,
+    _CompletionCleaner,
+    _summary_hedger,
+    _UrlSummary,
+    get_llm,
+)
+from edubot.gateway import get_gateway
+from edubot.sql import async_session, create_schema
+from edubot.types import CompletionInfo, CompletionText, ImageInfo, MessageInfo
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# The maximum time to wait for a web page to download in seconds
+FETCH_TIMEOUT = 30
+
+# The maximum allowed size of web pages in megabytes
+MAX_PAGE_SIZE_MB = 20
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEduBot(BaseEduBot):
+    """
+    An asyncio version of EduBot, methods that perform I/O are coroutines prefixed with 'a'.
+
+    The database is accessed through SQLAlchemy's async engine, this requires the aiosqlite or asyncpg driver to be
+    installed. Providers without an async client (Replicate and Stability) are called in a worker thread.
+    """
+
+    def __init__(self, username: str, platform: str, personality: str | list[str]):
+        """
+        Initialise AsyncEduBot with personalised information about the bot.
+
+        The bot is added to the database on the first call that uses it.
+
+        :param username: A unique name to identify this bot from others on the same platform.
+        :param platform: The platform the bot is running on E.g. 'telegram' 'matrix' 'mastodon'
+        :param personality: Instructions/information for the bot to follow when generating responses.
+        """
+        super().__init__(username, platform, personality)
+
+        # Prevents concurrent calls from adding the bot to the database twice
+        self.__bot_lock = asyncio.Lock()
+
+        # This variable is lazy loaded
+        self.http_session: aiohttp.ClientSession | None = None
+
+        # Rolling summary updates running in the background, kept so they aren't garbage collected
+        self.__summary_tasks: set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> "AsyncEduBot":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """
+        Wait for background summary updates, then close the HTTP connections used to fetch web pages.
+        """
+        if self.__summary_tasks:
+            await asyncio.gather(*self.__summary_tasks, return_exceptions=True)
+
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    async def __run_in_transaction(self, method: Callable, *args) -> Any:
+        """
+        Run one of the session methods shared with EduBot in a transaction on the async engine.
+        """
+        if self._bot_pk is None:
+            async with self.__bot_lock:
+                if self._bot_pk is None:
+                    await asyncio.to_thread(create_schema)
+
+                    async with async_session() as session:
+                        bot_pk = await session.run_sync(self._add_bot_to_db)
+                        await session.commit()
+                    self._bot_pk = bot_pk
+
+        with metrics.stage("db"):
+            async with async_session() as session:
+                result = await session.run_sync(method, *args)
+                await session.commit()
+
+        return result
+
+    def __schedule_summary_update(self, thread_id: int) -> None:
+        """
+        Update the rolling summary of a thread in the background, see EduBot.
+        """
+        if not thread_summaries.enabled() or not thread_summaries.claim(
+            thread_id, self._bot_pk
+        ):
+            return
+
+        # The task runs in an empty context, so it isn't bound by the deadline or measured with the call
+        task = contextvars.Context().run(
+            asyncio.ensure_future, self.__update_summary(thread_id)
+        )
+        self.__summary_tasks.add(task)
+        task.add_done_callback(self.__summary_tasks.discard)
+
+    @deadlines.bounded
+    async def __update_summary(self, thread_id: int) -> None:
+        """
+        Fold the messages that have aged out of the window into the rolling summary of a thread.
+        """
+        try:
+            while backlog := await self.__run_in_transaction(
+                thread_summaries.backlog,
+                thread_id,
+                self._bot_pk,
+                self.username,
+                GPT_SETTINGS["model"],
+            ):
+                completion = await self.__create_summary(
+                    thread_summaries.request_messages(backlog)
+                )
+                summary = completion["choices"][0]["message"]["content"].strip()
+
+                if not await self.__run_in_transaction(
+                    thread_summaries.store, backlog, summary
+                ):
+                    break
+        except Exception:
+            # The update is retried after the next completion in the thread
+            logger.exception(f"Updating the summary of thread {thread_id} failed.")
+        finally:
+            thread_summaries.release(thread_id, self._bot_pk)
+
+    async def __fetch_url(self, url: str) -> str | None:
+        """
+        Download a web page, returns None if there was an HTTP or network error.
+        """
+        if self.http_session is None:
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=FETCH_WORKERS, limit_per_host=FETCHES_PER_HOST
+                ),
+                timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+            )
+
+        try:
+            async with self.http_session.get(url) as resp:
+                if resp.status != 200:
+                    return None
+
+                limit = MAX_PAGE_SIZE_MB * 1048576
+
+                if (resp.content_length or 0) > limit:
+                    logger.info(f"Skipped {url} because it was too large.")
+                    return None
+
+                # Chunked responses have no length, one byte past the limit is read to find out if they are too large
+                body = bytearray()
+                while len(body) <= limit and (
+                    chunk := await resp.content.read(limit + 1 - len(body))
+                ):
+                    body += chunk
+
+                if len(body) > limit:
+                    logger.info(f"Skipped {url} because it was too large.")
+                    return None
+
+                return body.decode(resp.charset or "utf-8", errors="replace")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Fetching {url} failed: {e}")
+            return None
+
+    async def __acaption_image(self, image: Image.Image) -> str | None:
+        """
+        Gets an AI generated description of an image, reusing the caption of a similar image if there is one.
+        """
+        with metrics.stage("prepare_image"):
+            prepared = await asyncio.to_thread(self._prepare_image, image)
+
+        if prepared is None:
+            return None
+
+        image, key = prepared
+
+        if key and (caption := await self.__run_in_transaction(captions.lookup, key)):
+            return caption
+
+        with metrics.stage("caption"):
+            caption = await asyncio.to_thread(self._describe_image, image)
+
+        if key and caption:
+            await self.__run_in_transaction(captions.store, key, caption)
+
+        return caption
+
+    @metrics.measured("save_image_to_context")
+    @deadlines.bounded
+    async def asave_image_to_context(
+        self, image: ImageInfo, thread_name: str
+    ) -> str | None:
+        """
+        Saves an AI generated description of a user-sent image to the database, see EduBot.save_image_to_context.
+
+        :param image: An ImageInfo object.
+        :param thread_name: A unique identifier for the thread the image was posted in.
+        :returns: The description of the image or None if an error occurred.
+        """
+        image_description = await self.__acaption_image(image["image"])
+
+        if image_description is None:
+            return None
+
+        await self.__run_in_transaction(
+            self._save_message,
+            {
+                "username": image["username"],
+                "message": f"*An image of {image_description}",
+                "time": image["time"],
+            },
+            thread_name,
+        )
+
+        return image_description
+
+    @metrics.measured("gpt_answer")
+    @deadlines.bounded
+    async def agpt_answer(
+        self,
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> CompletionText | None:
+        """
+        Use chat context to generate a GPT response, see EduBot.gpt_answer.
+
+        :param new_context: Chat context as a chronological list of MessageInfo
+        :param thread_name: The unique identifier of the thread this context pertains to
+        :param personality_override: A custom personality that overrides the default.
+
+        :returns: The response from GPT, its 'id' attribute can be passed to achange_completion_score.
+        """
+        (
+            thread_id,
+            complete_context,
+            summary,
+            recalled,
+        ) = await self.__run_in_transaction(
+            self._prompt_context, new_context, thread_name
+        )
+
+        # The newest message was already answered, E.g. the integration retried a call that succeeded
+        if complete_context[-1]["username"] == self.username:
+            return await self.__run_in_transaction(
+                self._previous_answer, complete_context, thread_id
+            )
+
+        with metrics.stage("tokenize"):
+            langchain_context = self._format_context(
+                complete_context,
+                personality_override=personality_override,
+                summary=summary,
+                recalled=recalled,
+            )
+
+        key, tokens = self._llm_request(
+            "chat", [(msg.type, msg.content) for msg in langchain_context]
+        )
+
+        cache_key = key if completion_cache.enabled(GPT_SETTINGS) else None
+
+        if cache_key is not None:
+            with metrics.stage("cache"):
+                completion = completion_cache.get(
+                    cache_key
+                ) or await self.__run_in_transaction(completion_cache.lookup, cache_key)
+
+            if completion is not None:
+                completion_id = await self.__run_in_transaction(
+                    self._add_completion, completion, complete_context[-1], thread_id
+                )
+                self.__schedule_summary_update(thread_id)
+                return CompletionText(completion, completion_id)
+
+        with metrics.stage("llm"):
+            completion = (
+                await get_gateway().acall(
+                    lambda: get_llm().apredict_messages(
+                        langchain_context, **deadlines.request_timeout()
+                    ),
+                    key,
+                    tokens,
+                    _chat_hedger,
+                )
+            ).content
+
+        if not completion:
+            return None
+
+        completion = self._clean_completion(completion)
+        self._measure_prompt(langchain_context, completion)
+
+        completion_id = await self.__run_in_transaction(
+            self._add_completion,
+            completion,
+            complete_context[-1],
+            thread_id,
+            cache_key,
+        )
+        self.__schedule_summary_update(thread_id)
+
+        return CompletionText(completion, completion_id)
+
+    async def agpt_answer_stream(
+        self,
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> AsyncIterator[str]:
+        """
+        Use chat context to generate a GPT response, yielding chunks as they are generated, see EduBot.gpt_answer_stream.
+
+        :param new_context: Chat context as a chronological list of MessageInfo
+        :param thread_name: The unique identifier of the thread this context pertains to
+        :param personality_override: A custom personality that overrides the default.
+
+        :returns: An async iterator of response chunks
+        """
+        # Chunks of the response, then an exception if generating it failed, then None
+        chunks: asyncio.Queue = asyncio.Queue()
+
+        task = asyncio.ensure_future(
+            self.__produce_stream(
+                chunks, new_context, thread_name, personality_override
+            )
+        )
+
+        try:
+            while (chunk := await chunks.get()) is not None:
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            # Stops the response being generated and saved if the stream was closed early
+            task.cancel()
+
+    async def __produce_stream(self, chunks: asyncio.Queue, *args) -> None:
+        """
+        Generate a streamed response for agpt_answer_stream, putting its chunks in "chunks".
+        """
+        try:
+            await self.__stream_completion(chunks.put_nowait, *args)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            chunks.put_nowait(e)
+        finally:
+            chunks.put_nowait(None)
+
+    @metrics.measured("gpt_answer_stream")
+    @deadlines.bounded
+    async def __stream_completion(
+        self,
+        send: Callable[[str], None],
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> None:
+        """
+        Generate a response like agpt_answer, sending it in chunks as they are generated.
+        """
+        (
+            thread_id,
+            complete_context,
+            summary,
+            recalled,
+        ) = await self.__run_in_transaction(
+            self._prompt_context, new_context, thread_name
+        )
+
+        # The newest message was already answered, E.g. the integration retried a call that succeeded
+        if complete_context[-1]["username"] == self.username:
+            if previous := await self.__run_in_transaction(
+                self._previous_answer, complete_context, thread_id
+            ):
+                send(previous)
+            return
+
+        with metrics.stage("tokenize"):
+            langchain_context = self._format_context(
+                complete_context,
+                personality_override=personality_override,
+                summary=summary,
+                recalled=recalled,
+            )
+
+        cleaner = _CompletionCleaner(self.username)
+
+        _, tokens = self._llm_request(
+            "chat", [(msg.type, msg.content) for msg in langchain_context]
+        )
+
+        with metrics.stage("llm"):
+            async with get_gateway().alimit(tokens), aclosing(
+                get_llm().astream(langchain_context, **deadlines.request_timeout())
+            ) as stream:
+                async for chunk in stream:
+                    if text := cleaner.feed(chunk.content):
+                        send(text)
+
+        if text := cleaner.flush():
+            send(text)
+
+        if not cleaner.text:
+            return
+
+        self._measure_prompt(langchain_context, cleaner.text)
+
+        await self.__run_in_transaction(
+            self._add_completion, cleaner.text, complete_context[-1], thread_id
+        )
+        self.__schedule_summary_update(thread_id)
+
+    @metrics.measured("change_completion_score")
+    @deadlines.bounded
+    async def achange_completion_score(
+        self, offset: int, completion: CompletionInfo | int, thread_name: str
+    ) -> None:
+        """
+        Change user feedback to a completion, see EduBot.change_completion_score.
+
+        :param offset: An integer representing the new positive or negative votes to this reaction.
+        :param completion: The ID of the completion returned by agpt_answer, or information about the completion.
+        :param thread_name: A unique identifier for the thread the completion resides in.
+        """
+        if isinstance(completion, int):
+            if not await self.__run_in_transaction(
+                self._completion_in_thread, completion, thread_name
+            ):
+                logger.warning(
+                    f"Completion {completion} of {self.username} isn't in thread {thread_name}, it wasn't scored."
+                )
+                return
+
+            completion_id = completion
+        else:
+            completion_id = await self.__run_in_transaction(
+                self._find_completion, completion, thread_name
+            )
+
+            if completion_id is None:
+                return
+
+        if feedback.enabled():
+            feedback.add(self._bot_pk, completion_id, offset)
+        else:
+            await self.__run_in_transaction(
+                queries.add_scores, {(self._bot_pk, completion_id): offset}
+            )
+
+        logger.info(f"Completion {completion_id} incremented by {offset}.")
+
+    @metrics.measured("generate_image")
+    @deadlines.bounded
+    async def agenerate_image(
+        self, prompt: str, reply_to_msg: MessageInfo, thread_name: str
+    ) -> Image.Image | None:
+        """
+        Generate an image using Stability AI's DreamStudio, see EduBot.generate_image.
+
+        :param prompt: A description of the image that should be generated.
+        :param reply_to_msg: The message the bot is replying to.
+        :param thread_name: A unique identifier for the thread the message resides in.
+        :return: A PIL.Image.Image instance.
+        """
+        with metrics.stage("generate"):
+            image = await asyncio.to_thread(self._generate_image, prompt)
+
+        if image is None:
+            return None
+
+        thread_id = await self.__run_in_transaction(
+            self._save_message, reply_to_msg, thread_name
+        )
+
+        image_description = await self.__acaption_image(image)
+        completion = self._generated_image_completion(prompt, image_description)
+
+        await self.__run_in_transaction(
+            self._add_completion, completion, reply_to_msg, thread_id
+        )
+
+        return image
+
+    @metrics.measured("summarise_url")
+    @deadlines.bounded
+    async def asummarise_url(
+        self, url: str, msg: MessageInfo, thread_name: str, full_page: bool = False
+    ) -> str | None:
+        """
+        Use GPT to summarise the text content of a URL, see EduBot.summarise_url.
+
+        Returns None if the webpage cannot be fetched or doesn't contain long-form text to summarise.
+
+        :param url: A valid url.
+        :param msg: The message that triggered this summary request.
+        :param thread_name: A unique identifier for the thread the URL was sent in.
+        :param full_page: Summarise pages that are too long for one prompt in parts, instead of truncating them.
+        """
+        return (await self.asummarise_urls([(url, msg)], thread_name, full_page))[0]
+
+    @metrics.measured("summarise_urls")
+    @deadlines.bounded
+    async def asummarise_urls(
+        self,
+        requests: list[tuple[str, MessageInfo]],
+        thread_name: str,
+        full_page: bool = False,
+    ) -> list[str | None]:
+        """
+        Use GPT to summarise the text content of several URLs at once, see EduBot.summarise_urls.
+
+        :param requests: Pairs of a valid url and the message that triggered its summary request.
+        :param thread_name: A unique identifier for the thread the URLs were sent in.
+        :param full_page: Summarise pages that are too long for one prompt in parts, instead of truncating them.
+        :returns: The summary of each URL in the same order as "requests", None if a page couldn't be summarised.
+        """
+        summaries = await self.__run_in_transaction(self._cached_summaries, requests)
+
+        if uncached := [summary for summary in summaries if not summary["cached"]]:
+            with metrics.stage("fetch"):
+                await asyncio.gather(*map(self.__fetch_page, uncached))
+
+            await self.__run_in_transaction(self._content_summaries, uncached)
+
+        with metrics.stage("llm"):
+            await asyncio.gather(
+                *(
+                    self.__summarise_page(summary, full_page)
+                    for summary in summaries
+                    if summary["text"] is not None
+                )
+            )
+
+        # All outcomes and summaries are saved together
+        await self.__run_in_transaction(self._save_summaries, summaries, thread_name)
+
+        return [summary["summary"] for summary in summaries]
+
+    async def __fetch_page(self, summary: _UrlSummary) -> None:
+        """
+        Download a web page and convert it to plaintext.
+        """
+        html = await self.__fetch_url(summary["url"])
+
+        # Converting HTML to plaintext is CPU bound so it is kept off the event loop
+        await asyncio.to_thread(self._read_page, summary, html)
+
+    async def __summarise_page(self, summary: _UrlSummary, full_page: bool) -> None:
+        """
+        Summarise the plaintext of a web page, the page is left without an outcome if OpenAI fails.
+        """
+        from openai import OpenAIError
+
+        text = summary["text"]
+
+        try:
+            if full_page and (
+                chunks := await asyncio.to_thread(self._summary_chunks, text)
+            ):
+                text = self._combine_chunk_summaries(
+                    await asyncio.gather(*map(self.__create_summary, chunks))
+                )
+
+            completion = await self.__create_summary(
+                await asyncio.to_thread(self._summary_context, text)
+            )
+        except OpenAIError as e:
+            logger.error(f"OpenAI request failed: {e}")
+            summary["text"] = None
+            return
+
+        self._set_summary(summary, self._parse_summary(completion))
+
+    async def __create_summary(self, messages: list[dict]) -> dict:
+        """
+        Send a summary request to OpenAI through the gateway.
+        """
+        import openai
+
+        key, tokens = self._llm_request(
+            "summary", [(msg["role"], msg["content"]) for msg in messages]
+        )
+        completion = await get_gateway().acall(
+            lambda: openai.ChatCompletion.acreate(
+                messages=messages, **GPT_SETTINGS, **deadlines.request_timeout()
+            ),
+            key,
+            tokens,
+            _summary_hedger,
+        )
+
+        self._measure_usage(completion)
+
+        return completion
@@ -1,26 +1,52 @@
 """
 Module for AI processing tasks
 """
+from __future__ import annotations
+
 import datetime
+import functools
+import inspect
 import io
 import logging
-
-import openai
-import PIL
-import replicate
-import tiktoken
-import trafilatura
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
-from openai import OpenAIError
-from PIL import Image
-from sqlalchemy import desc, select
-from stability_sdk.client import StabilityInference, process_artifacts_from_answers
-from stability_sdk.utils import generation
-
-from edubot import DREAMSTUDIO_KEY, REPLICATE_KEY
-from edubot.sql import Bot, Completion, Message, Session, Thread
-from edubot.types import CompletionInfo, ImageInfo, MessageInfo
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Iterator, TypedDict
+from urllib.parse import urlsplit
+
+from sqlalchemy import desc, event, orm, select
+
+from edubot import (
+    DREAMSTUDIO_KEY,
+    REPLICATE_KEY,
+    captions,
+    completion_cache,
+    deadlines,
+    feedback,
+    metrics,
+    queries,
+    retrieval,
+    thread_summaries,
+    url_cache,
+)
+# Re-exported, integrations read the image size limit from here
+from edubot.captions import MAX_IMAGE_SIZE_MB  # noqa: F401
+from edubot.concurrency import KeyedLocks, SingleFlight, get_executor
+from edubot.context_cache import CachedMessage, ContextCache
+from edubot.gateway import get_gateway, request_key
+from edubot.sql import Bot, Completion, Message, Session, Thread, create_schema
+from edubot.tokens import TokenBudget, count_tokens, split_tokens, truncate_tokens
+from edubot.types import CompletionInfo, CompletionText, ImageInfo, MessageInfo
+
+# Provider SDKs are slow to import, so they are imported when they are first used
+if TYPE_CHECKING:
+    from langchain.chat_models import ChatOpenAI
+    from langchain.schema import AIMessage, HumanMessage, SystemMessage
+    from PIL import Image
+    from replicate import Client
+    from stability_sdk.client import StabilityInference
 
 # The limit for GPT-4 is 8192 tokens.
 MAX_GPT_TOKENS = 128000
@@ -36,10 +62,8 @@ GPT_SETTINGS = {
     "max_tokens": MAX_COMPLETION_TOKENS,
 }
 
-LLM = ChatOpenAI(**GPT_SETTINGS)
-
-# The maximum allowed size of images in megabytes
-MAX_IMAGE_SIZE_MB = 50
+# Trims chat context to fit in the prompt
+PROMPT_BUDGET = TokenBudget(GPT_SETTINGS["model"], MAX_PROMPT_TOKENS)
 
 # Prompt for GPT to summarise web pages
 WEB_SUMMARY_PROMPT = (
@@ -51,23 +75,202 @@ WEB_SUMMARY_PROMPT = (
     "This summary will then be sent to users.\n"
 )
 
+# Prompt for GPT to summarise one part of a web page that is too long to summarise at once
+WEB_CHUNK_PROMPT = (
+    "Your input is one part of the scraped text of a long website. "
+    "Summarise the key points of this part in a few sentences. "
+    "Your summary will be combined with summaries of the other parts.\n"
+)
+
+# The maximum number of parts a long web page is split into, text past the last part is ignored
+MAX_SUMMARY_CHUNKS = 16
+
+# The maximum number of summary requests a call sends to the gateway at once
+SUMMARY_WORKERS = 4
+
+# The maximum number of web pages downloaded at once, and from the same host at once
+FETCH_WORKERS = 8
+FETCHES_PER_HOST = 2
+
 logger = logging.getLogger(__name__)
 
-REPLICATE_CLIENT = replicate.Client(api_token=REPLICATE_KEY)
+
+# Time the requests of every EduBot in this process, sending second attempts of slow ones if HEDGE_REQUESTS is set
+_chat_hedger = deadlines.Hedger("chat")
+_summary_hedger = deadlines.Hedger("summary")
+_caption_hedger = deadlines.Hedger("caption")
+
+# Run the calls of every bot in this process for the same thread one at a time, see _per_thread
+_thread_locks = KeyedLocks()
+_identical_calls = SingleFlight()
+
+# Updates the rolling summaries of threads in the background, see edubot.thread_summaries
+_summary_pool = ThreadPoolExecutor(SUMMARY_WORKERS, thread_name_prefix="edubot-summary")
+
+# Limits the downloads from each host, keyed by hostname
+_host_limits: dict[str, threading.BoundedSemaphore] = {}
+_host_limits_lock = threading.Lock()
 
 
 def estimate_tokens(text: str) -> int:
-    # Load GPT-4 encoding
-    enc = tiktoken.encoding_for_model(GPT_SETTINGS["model"])
+    return count_tokens(text, GPT_SETTINGS["model"])
+
+
+@lru_cache(maxsize=None)
+def get_llm() -> ChatOpenAI:
+    """
+    Returns the langchain chat model shared by every bot, creating it on first use.
+    """
+    from langchain.chat_models import ChatOpenAI
 
-    # Turn text into tokens and count them
-    token_count = len(enc.encode(text))
-    return token_count
+    # Failed requests are retried by the gateway
+    return ChatOpenAI(max_retries=0, **GPT_SETTINGS)
 
 
-class EduBot:
+@lru_cache(maxsize=None)
+def get_replicate_client() -> Client:
     """
-    An AI chatbot which continually improves itself using user feedback.
+    Returns the Replicate client shared by every bot, creating it on first use.
+    """
+    import replicate
+
+    return replicate.Client(api_token=REPLICATE_KEY)
+
+
+def __getattr__(name: str) -> Any:
+    # LLM and REPLICATE_CLIENT used to be created on import, they are still available under their old names
+    if name == "LLM":
+        return get_llm()
+    if name == "REPLICATE_CLIENT":
+        return get_replicate_client()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _host_limit(url: str) -> threading.BoundedSemaphore:
+    """
+    Returns the semaphore limiting concurrent downloads from the host of "url".
+    """
+    host = urlsplit(url).hostname or ""
+
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(FETCHES_PER_HOST)
+
+        return _host_limits[host]
+
+
+def _per_thread(dedupe: bool = True) -> Callable[[Callable], Callable]:
+    """
+    Decorator running the calls of an EduBot method for the same thread one at a time, so a bot can be shared by
+     many OS threads.
+
+    :param dedupe: Identical calls made while a call is in flight receive its result instead of running again.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(self: BaseEduBot, *args, **kwargs):
+            thread_name = signature.bind(self, *args, **kwargs).arguments["thread_name"]
+
+            def locked():
+                with _thread_locks.hold((self.platform, thread_name)):
+                    return fn(self, *args, **kwargs)
+
+            if not dedupe:
+                return locked()
+
+            return _identical_calls.call(
+                request_key(fn.__name__, self.username, self.platform, args, kwargs),
+                locked,
+            )
+
+        return wrapper
+
+    return decorator
+
+
+class _CompletionCleaner:
+    """
+    Strips the bot's username from a completion as it is streamed, see BaseEduBot._clean_completion.
+
+    Text that could be the start of the username is held back until the next chunk shows whether it is.
+    """
+
+    def __init__(self, username: str):
+        self.marker = f"{username}:"
+        self.pending = ""
+        # Every piece of text that has been released
+        self.released: list[str] = []
+
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk of the completion, returns the text that is now safe to send.
+        """
+        self.pending = (self.pending + chunk).replace(self.marker, "")
+
+        # Leading whitespace is stripped until the first text is released
+        if not self.released:
+            self.pending = self.pending.lstrip()
+
+        # Hold back the longest tail that could be the start of the username
+        held = 0
+        for length in range(min(len(self.marker) - 1, len(self.pending)), 0, -1):
+            if self.marker.startswith(self.pending[-length:]):
+                held = length
+                break
+
+        text = self.pending[: len(self.pending) - held]
+        self.pending = self.pending[len(text) :]
+        return self.__release(text)
+
+    def flush(self) -> str:
+        """
+        Returns any text that was held back, call this once the stream ends.
+        """
+        text = self.pending
+        self.pending = ""
+        return self.__release(text)
+
+    def __release(self, text: str) -> str:
+        if text:
+            self.released.append(text)
+        return text
+
+    @property
+    def text(self) -> str:
+        """
+        The cleaned completion released so far.
+        """
+        return "".join(self.released)
+
+
+class _UrlSummary(TypedDict):
+    """
+    The progress of summarising a URL, passed between the stages of EduBot.summarise_urls.
+    """
+
+    url: str
+    # The message that requested the summary
+    msg: MessageInfo
+    # Whether the outcome was already in the URL cache
+    cached: bool
+    summary: str | None
+    # The outcome to store in the URL cache, None if there is nothing new to store
+    outcome: str | None
+    # The plaintext of the page while it is waiting to be summarised
+    text: str | None
+    text_hash: str | None
+
+
+class BaseEduBot:
+    """
+    Behaviour shared by EduBot and AsyncEduBot that doesn't depend on how I/O is performed.
+
+    Methods that take a session run inside a caller-managed transaction, so the same database logic is used by both
+    the sync and async bots.
     """
 
     def __init__(self, username: str, platform: str, personality: str | list[str]):
@@ -88,13 +291,17 @@ class EduBot:
         else:
             self.personality = personality
 
-        self.__add_bot_to_db()
-
         # The primary key of the bot in the database
-        self.__bot_pk = self.__get_bot(username).id
+        self._bot_pk: int | None = None
 
         # This variable is lazy loaded
         self.stability_client: StabilityInference | None = None
+        self.__stability_lock = threading.Lock()
+
+        # Recent context of the threads this bot replied in, so consecutive replies only load new messages
+        self._context_cache = ContextCache(GPT_SETTINGS["model"])
+
+        completion_cache.check_settings(GPT_SETTINGS)
 
         self.system_messages = [
             f"You are a chatbot named '{self.username}' which is controlled by an open source python"
@@ -116,434 +323,1120 @@ class EduBot:
             f"Never prefix your messages with '{self.username}:'",
         ]
 
-    def __get_bot(self, username: str) -> Bot | None:
-        """
-        Returns the Bot of "username" if it exists on this platform otherwise returns None.
-        """
-        with Session() as session:
-            bot = session.execute(
-                select(Bot)
-                .where(Bot.username == username)
-                .where(Bot.platform == self.platform)
-            ).fetchone()
-
-            if bot:
-                return bot[0]
-            else:
-                return None
-
-    def __add_bot_to_db(self) -> None:
+    def _add_bot_to_db(self, session: orm.Session) -> int:
         """
         Insert this bot into the DB if it isn't already.
-        """
-        if not self.__get_bot(self.username):
-            with Session() as session:
-                new_bot = Bot(username=self.username, platform=self.platform)
-
-                session.add(new_bot)
-                session.commit()
 
-    def __get_message(self, msg_info: MessageInfo) -> Message | None:
+        :returns: The primary key of the bot.
         """
-        Get an ORM Message object from the database.
-        """
-        with Session() as session:
-            message = session.execute(
-                select(Message)
-                .where(Message.username == msg_info["username"])
-                .where(Message.message == msg_info["message"])
-                .where(Message.time == msg_info["time"])
-                .where(Thread.platform == self.platform)
-            ).fetchone()
-            if message:
-                return message[0]
-            else:
-                return None
-
-    def __get_thread(self, thread_name: str) -> Thread | None:
-        """
-        Get an ORM Thread object from the database.
-        """
-        with Session() as session:
-            thread = session.execute(
-                select(Thread)
-                .where(Thread.thread_name == thread_name)
-                .where(Thread.platform == self.platform)
-            ).fetchone()
+        bot_pk = session.scalar(
+            select(Bot.id)
+            .where(Bot.username == self.username)
+            .where(Bot.platform == self.platform)
+        )
 
-            if thread:
-                return thread[0]
-            else:
-                return None
+        if bot_pk is None:
+            new_bot = Bot(username=self.username, platform=self.platform)
 
-    def __get_completion_from_message(self, msg_info: MessageInfo) -> Completion | None:
-        """
-        Gets the bots response to a specific message.
-        """
-        with Session() as session:
-            msg = self.__get_message(msg_info)
-            completion = session.execute(
-                select(Completion)
-                .where(Completion.bot == self.__bot_pk)
-                .where(Completion.reply_to == msg.id)
-            ).fetchone()
+            session.add(new_bot)
+            session.flush()
+            bot_pk = new_bot.id
 
-            if completion:
-                return completion[0]
-            else:
-                return None
+        return bot_pk
 
-    def __add_completion(self, completion: str, reply_to: MessageInfo) -> None:
+    def _add_completion(
+        self,
+        session: orm.Session,
+        completion: str,
+        reply_to: MessageInfo,
+        thread_id: int,
+        cache_key: str | None = None,
+    ) -> int:
         """
         Add a completion to the database.
 
         :param completion: The text the bot generated.
         :param reply_to: The message the bot was replying to.
+        :param thread_id: The primary key of the thread the message was sent in.
+        :param cache_key: Also cache the completion for identical prompts with this key, see edubot.completion_cache.
+        :returns: The ID of the completion.
         """
-        msg_id = self.__get_message(reply_to).id
-        with Session() as session:
-            new_comp = Completion(
-                bot=self.__bot_pk,
-                message=completion,
-                reply_to=msg_id,
-            )
-            session.add(new_comp)
-            session.commit()
-
-    def __format_context(
-        self, context: list[MessageInfo], personality_override: str = None
-    ) -> list[SystemMessage | HumanMessage | AIMessage]:
-        """
-        Formats chat context and system messages into a chronological list of langchain messages.
+        reply_to_msg = queries.get_message(session, thread_id, reply_to)
+        new_comp = Completion(
+            bot=self._bot_pk,
+            message=completion,
+            reply_to=reply_to_msg.id,
+        )
+        session.add(new_comp)
+        session.flush()
 
-        :param context: A list of MessageInfo.
-        :return: The context as a list of langchain message objects.
-        """
-        if personality_override:
-            # We need to shallow copy 'self.personality' to avoid modifying the original list
-            personality = self.personality.copy()
-            personality.append(personality_override)
-        else:
-            personality = self.personality
+        if cache_key is not None:
+            completion_cache.store(session, cache_key, completion)
 
-        langchain_messages: list[SystemMessage | HumanMessage | AIMessage] = []
+        self._thread_written(
+            session, thread_id, completions={reply_to_msg.fingerprint: completion}
+        )
 
-        # Append the system messages and personality to the chat context
-        for i in self.system_messages + personality:
-            langchain_messages.append(SystemMessage(content=i))
+        return new_comp.id
 
-        # The context is too long if the prompt is longer than MAX_PROMPT_TOKENS
-        token_count = 0
+    def _save_message(
+        self, session: orm.Session, msg: MessageInfo, thread_name: str
+    ) -> int:
+        """
+        Add a message to a thread if it isn't already, creating the thread if it doesn't exist.
 
-        for msg in context:
-            if msg["username"] == self.username:
-                langchain_messages.append(AIMessage(content=msg["message"]))
-            else:
-                langchain_messages.append(HumanMessage(content=msg["message"]))
+        :returns: The primary key of the thread.
+        """
+        thread = queries.get_or_create_thread(session, self.platform, thread_name)
 
-            token_count += estimate_tokens(msg["message"])
+        queries.insert_messages(session, [{**msg, "thread": thread.id}])
 
-        # Remove messages from the context until the prompt is short enough
-        while token_count > MAX_PROMPT_TOKENS:
-            token_count -= estimate_tokens(langchain_messages.pop(0).content)
+        self._thread_written(
+            session,
+            thread.id,
+            [CachedMessage(thread.id, msg["username"], msg["message"], msg["time"])],
+        )
 
-        return langchain_messages
+        return thread.id
 
-    @staticmethod
-    def __describe_image(image: Image.Image) -> str:
-        """
-        Gets an AI generated description of an image.
+    def _thread_written(
+        self,
+        session: orm.Session,
+        thread_id: int,
+        messages: list[CachedMessage] = (),
+        completions: dict[str, str] | None = None,
+    ) -> None:
         """
-        if not REPLICATE_KEY:
-            raise RuntimeError(
-                "Replicate key is not defined, make sure to supply it in the config."
-            )
-
-        image_bytes = io.BytesIO()
-        image.save(image_bytes, format="PNG")
+        Increment the version of a thread that was written to, and apply the write to the context cache.
 
-        if image_bytes.tell() / 1048576 > MAX_IMAGE_SIZE_MB:
-            logger.info(f"Skipped image because it was too large.")
-            return None
-
-        output: str = REPLICATE_CLIENT.run(
-            "j-min/clip-caption-reward:de37751f75135f7ebbe62548e27d6740d5155dfefdf6447db35c9865253d7e06",
-            input={"image": image_bytes},
+        :param messages: Messages that were added.
+        :param completions: Completions that were added keyed by the fingerprint of the message they reply to.
+        """
+        version = queries.touch_thread(session, thread_id)
+
+        # The cache is only updated once the write is committed, so a rolled back write can't be cached
+        event.listen(
+            session,
+            "after_commit",
+            lambda _: self._context_cache.update(
+                thread_id, version, messages, completions
+            ),
+            once=True,
         )
 
-        if not output:
-            logger.error("Replicate returned an empty response.")
-            return None
+    def _save_summary(
+        self,
+        session: orm.Session,
+        completion_text: str,
+        msg: MessageInfo,
+        thread_name: str,
+    ) -> None:
+        """
+        Add the message that requested a URL summary, and the summary itself, to the database.
+        """
+        thread_id = self._save_message(session, msg, thread_name)
 
-        return output
+        # Ensure URL summaries are added to the DB
+        self._add_completion(session, completion_text, msg, thread_id)
 
-    def save_image_to_context(self, image: ImageInfo, thread_name: str) -> str | None:
+    def _cached_summaries(
+        self, session: orm.Session, requests: list[tuple[str, MessageInfo]]
+    ) -> list[_UrlSummary]:
         """
-        Saves an AI generated description of a user-sent image to the database. This allows GPT to understand what images are
-         and how to describe them. The maximum image size in MB can be read from the MAX_IMAGE_SIZE_MB constant.
+        Start summarising several URLs by looking them all up in the summary cache at once.
 
-        :param image: An ImageInfo object.
-        :param thread_name: A unique identifier for the thread the image was posted in.
-        :returns: The description of the image or None if an error occurred.
+        :returns: The progress of summarising each URL, in the same order as "requests".
         """
-        image_description = self.__describe_image(image["image"])
+        entries = url_cache.lookup(session, [url for url, _ in requests])
+
+        summaries = []
+        for url, msg in requests:
+            entry = entries.get(url_cache.url_hash(url))
+            summaries.append(
+                _UrlSummary(
+                    url=url,
+                    msg=msg,
+                    cached=entry is not None,
+                    summary=entry.summary if entry is not None else None,
+                    outcome=None,
+                    text=None,
+                    text_hash=None,
+                )
+            )
 
-        with Session() as session:
-            thread = self.__get_thread(thread_name)
-            if not thread:
-                thread = Thread(thread_name=thread_name, platform=self.platform)
-                session.add(thread)
-                session.commit()
+        return summaries
 
-            message = Message(
-                thread=thread.id,
-                username=image["username"],
-                message=f"*An image of {image_description}",
-                time=image["time"],
-            )
-            session.add(message)
+    def _content_summaries(
+        self, session: orm.Session, summaries: list[_UrlSummary]
+    ) -> None:
+        """
+        Reuse the summaries of pages with the same plaintext, the same page is often served from several URLs.
+        """
+        pending = [summary for summary in summaries if summary["text"] is not None]
 
-            session.commit()
+        found = url_cache.lookup_content(
+            session, [summary["text_hash"] for summary in pending]
+        )
 
-        return image_description
+        for summary in pending:
+            if (text := found.get(summary["text_hash"])) is not None:
+                self._set_summary(summary, text)
 
-    def gpt_answer(
+    def _save_summaries(
         self,
-        new_context: list[MessageInfo],
+        session: orm.Session,
+        summaries: list[_UrlSummary],
         thread_name: str,
-        personality_override: str = None,
-    ) -> str | None:
+    ) -> None:
         """
-        Use chat context to generate a GPT3 response.
-
-        :param new_context: Chat context as a chronological list of MessageInfo
-        :param thread_name: The unique identifier of the thread this context pertains to
-        :param personality_override: A custom personality that overrides the default.
-
-        :returns: The response from GPT
+        Cache the outcome of summarising each URL, and add every summary to the thread.
         """
-        with Session() as session:
-            thread = self.__get_thread(thread_name)
+        for summary in summaries:
+            if summary["outcome"] is not None:
+                url_cache.store(
+                    session,
+                    summary["url"],
+                    summary["outcome"],
+                    summary["summary"],
+                    summary["text_hash"],
+                )
 
-            if not thread:
-                thread = Thread(thread_name=thread_name, platform=self.platform)
+            if summary["summary"] is not None:
+                self._save_summary(
+                    session, summary["summary"], summary["msg"], thread_name
+                )
 
-                session.add(thread)
-                session.commit()
+        url_cache.evict(session)
 
-            # Context in this timeframe that is in the database but not in the new context provided
-            # (Usually images)
-            existing_context: list[MessageInfo] = []
+    def _ingest_context(
+        self, session: orm.Session, new_context: list[MessageInfo], thread_name: str
+    ) -> tuple[int, list[MessageInfo]]:
+        """
+        Add new context to the database and merge it with the context already stored for the same timeframe.
 
-            for existing_msg in session.scalars(
-                select(Message)
-                .where(Message.thread == thread.id)
-                .where(Message.time > new_context[0]["time"])
-            ):
-                row_as_msg_info: MessageInfo = {
-                    "username": existing_msg.username,
-                    "message": existing_msg.message,
-                    "time": existing_msg.time,
-                }
-                if row_as_msg_info not in new_context:
-                    existing_context.append(row_as_msg_info)
+        :param new_context: Chat context as a chronological list of MessageInfo
+        :param thread_name: The unique identifier of the thread this context pertains to
+        :returns: The primary key of the thread, and the chronological context including the bot's completions.
+        """
+        start = new_context[0]["time"]
 
-            # The existing context in this timeframe + the new messages
-            new_and_existing_context: list[MessageInfo] = []
+        thread = queries.get_or_create_thread(session, self.platform, thread_name)
+        thread_id = thread.id
 
-            for index, msg in enumerate(new_context):
-                # Figure out where to insert the extra context chronologically
-                for extra_msg in existing_context:
-                    check = extra_msg["time"] < msg["time"]
-                    if index > 0:
-                        check = (
-                            check and extra_msg["time"] > new_context[index - 1]["time"]
-                        )
+        new_fingerprints = {queries.fingerprint(thread_id, msg) for msg in new_context}
 
-                    if check:
-                        new_and_existing_context.append(extra_msg)
-                        existing_context.remove(extra_msg)
+        if cached := self._context_cache.get(thread_id, thread.version, start):
+            stored, completions = cached
+        else:
+            stored = queries.messages_since(session, thread_id, start)
+            completions = queries.completions_since(
+                session, self._bot_pk, thread_id, start
+            )
+            self._context_cache.put(
+                thread_id, thread.version, start, stored, completions
+            )
 
-                new_and_existing_context.append(msg)
+        stored_fingerprints = {msg.fingerprint for msg in stored}
 
-                # If the message is already in the database
-                if self.__get_message(msg) is not None:
-                    continue
+        bots = queries.bot_usernames(
+            session,
+            self.platform,
+            {msg["username"] for msg in new_context} | {msg.username for msg in stored},
+        )
 
-                # If the message was written by a bot
-                if self.__get_bot(msg["username"]) is not None:
-                    continue
+        # Context in this timeframe that is in the database but not in the new context provided
+        # (Usually images)
+        existing_context: list[MessageInfo] = [
+            {"username": msg.username, "message": msg.message, "time": msg.time}
+            for msg in stored
+            if start < msg.time < new_context[-1]["time"]
+            and msg.fingerprint not in new_fingerprints
+        ]
 
-                row: dict = msg
-                row["thread"] = thread.id
+        # Insert new messages that weren't written by a bot
+        new_messages = [
+            {**msg, "thread": thread_id}
+            for msg in new_context
+            if queries.fingerprint(thread_id, msg) not in stored_fingerprints
+            and msg["username"] not in bots
+        ]
 
-                session.add(Message(**row))
+        if new_messages:
+            queries.insert_messages(session, new_messages)
+            self._thread_written(
+                session,
+                thread_id,
+                [
+                    CachedMessage(
+                        thread_id, msg["username"], msg["message"], msg["time"]
+                    )
+                    for msg in new_messages
+                ],
+            )
 
-            session.commit()
+        # The existing context in this timeframe + the new messages, sorting is stable so ties keep their order
+        new_and_existing_context = sorted(
+            existing_context + new_context, key=lambda msg: msg["time"]
+        )
 
         # Ensure that all bot completions are included in context, notably image completions.
         complete_context: list[MessageInfo] = []
         for message in new_and_existing_context:
-            if self.__get_bot(message["username"]) is not None:
+            if message["username"] in bots:
                 continue
             complete_context.append(message)
 
-            if completion := self.__get_completion_from_message(message):
+            if completion := completions.get(queries.fingerprint(thread_id, message)):
                 complete_context.append(
                     {
                         "username": self.username,
-                        "message": completion.message,
+                        "message": completion,
                         "time": message[
                             "time"
                         ],  # Estimate this, it doesn't matter for gpt_context
                     }
                 )
 
-        langchain_context = self.__format_context(
-            complete_context, personality_override=personality_override
+        return thread_id, complete_context
+
+    def _prompt_context(
+        self, session: orm.Session, new_context: list[MessageInfo], thread_name: str
+    ) -> tuple[
+        int, list[MessageInfo], tuple[str, datetime.datetime] | None, str | None
+    ]:
+        """
+        Ingest new context like _ingest_context, also getting the rolling summary of the thread if it has one, and
+         older messages relevant to the conversation if retrieval is enabled.
+
+        :returns: The primary key of the thread, the complete context, the summary and the time it covers up to, and
+         the messages retrieved.
+        """
+        thread_id, complete_context = self._ingest_context(
+            session, new_context, thread_name
         )
 
-        chat = ChatOpenAI(**GPT_SETTINGS)
-        completion = chat(langchain_context).content
+        summary = None
+        if thread_summaries.enabled():
+            summary = thread_summaries.lookup(session, thread_id, self._bot_pk)
+
+        recalled = None
+        if retrieval.enabled():
+            recalled = retrieval.recall(
+                session,
+                thread_id,
+                self._bot_pk,
+                self.username,
+                [msg["message"] for msg in new_context],
+                new_context[0]["time"],
+                GPT_SETTINGS["model"],
+            )
 
-        if not completion:
-            return None
+        return thread_id, complete_context, summary, recalled
 
-        # Strip username from completion, sometimes GPT messes this up.
-        completion = completion.replace(f"{self.username}:", "").lstrip()
+    def _previous_answer(
+        self, session: orm.Session, complete_context: list[MessageInfo], thread_id: int
+    ) -> CompletionText | None:
+        """
+        Get the completion the bot already replied to the newest message with, E.g. when an integration retries a call
+         that succeeded.
 
-        # Add a new completion to the database using the completion text and the message being replied to
-        self.__add_completion(completion, complete_context[-1])
+        :param complete_context: The complete context from _ingest_context, ending with the bot's reply.
+        :returns: The newest completion replying to the message, or None if it was deleted.
+        """
+        reply_to_msg = queries.get_message(session, thread_id, complete_context[-2])
 
-        # Return the completion result back to the integration
-        return completion
+        row = session.execute(
+            select(Completion.id, Completion.message)
+            .where(Completion.reply_to == reply_to_msg.id)
+            .where(Completion.bot == self._bot_pk)
+            .order_by(desc(Completion.id))
+            .limit(1)
+        ).first()
 
-    def change_completion_score(
-        self, offset: int, completion: CompletionInfo, thread_name: str
-    ) -> None:
+        return None if row is None else CompletionText(row.message, row.id)
+
+    def _completion_in_thread(
+        self, session: orm.Session, completion_id: int, thread_name: str
+    ) -> bool:
         """
-        Change user feedback to a completion.
+        Returns whether a completion was sent by this bot in a thread, so integrations can only score their own.
+        """
+        return (
+            session.scalar(
+                select(Completion.id)
+                .join(Message)
+                .join(Thread)
+                .where(Completion.id == completion_id)
+                .where(Completion.bot == self._bot_pk)
+                .where(Thread.thread_name == thread_name)
+                .where(Thread.platform == self.platform)
+            )
+            is not None
+        )
+
+    def _find_completion(
+        self,
+        session: orm.Session,
+        completion: CompletionInfo,
+        thread_name: str,
+    ) -> int | None:
+        """
+        Find the ID of a completion from its text and the time it was sent, for integrations that didn't keep the ID.
 
-        :param offset: An integer representing the new positive or negative votes to this reaction.
         :param completion: Information about the completion being reacted to.
         :param thread_name: A unique identifier for the thread the completion resides in.
+        :returns: The ID of the completion, or None if the message isn't a completion.
         """
 
         # 1.5 mins before the completion was sent
         delta = completion["time"] - datetime.timedelta(minutes=1, seconds=30)
 
-        with Session() as session:
-            # This select statement might get the wrong completion if the bot has sent duplicate messages in the same
-            #  thread within 1.5 minutes.
-            # BUT this isn't really a problem because it's very likely that users have the same reaction to
-            #  both of the duplicate messages.
-            # TODO: Is there a way to uniquely identify a bot completion? We can't record the time the completion was
-            #  sent as we don't know when the integration sends the completion. The integration also can't know for
-            #  sure which message a completion was replying to, as messages can be sent while the bot is generating
-            #  responses.
-            completion_row = session.execute(
-                select(Completion)
-                .join(Bot)
-                .join(Message)
-                .join(Thread)
-                .where(Completion.message == completion["message"])
-                .where(Thread.thread_name == thread_name)
-                .where(Bot.id == self.__bot_pk)
-                # The message being replied to was sent not more than 1.5 minutes before the completion
-                .where(delta < Message.time)
-                .where(Message.time < completion["time"])
-                .order_by(desc(Completion.id))
-            ).fetchone()
-
-            if not completion_row:
-                logger.debug(
-                    f"Message is not a GPT completion: '{completion['message']}' @ {completion['time']}"
-                )
-                return
-
-            completion: Completion = completion_row[0]
-
-            completion.score += offset
+        # This select statement might get the wrong completion if the bot has sent duplicate messages in the same
+        #  thread within 1.5 minutes.
+        # BUT this isn't really a problem because it's very likely that users have the same reaction to
+        #  both of the duplicate messages.
+        # Integrations that keep the ID returned by gpt_answer avoid this lookup entirely.
+        completion_id = session.scalar(
+            select(Completion.id)
+            .join(Bot)
+            .join(Message)
+            .join(Thread)
+            .where(Completion.message == completion["message"])
+            .where(Thread.thread_name == thread_name)
+            .where(Bot.id == self._bot_pk)
+            # The message being replied to was sent not more than 1.5 minutes before the completion
+            .where(delta < Message.time)
+            .where(Message.time < completion["time"])
+            .order_by(desc(Completion.id))
+            .limit(1)
+        )
 
-            session.add(completion)
-            session.commit()
+        if completion_id is None:
+            logger.debug(
+                f"Message is not a GPT completion: '{completion['message']}' @ {completion['time']}"
+            )
 
-            logger.info(f"Completion {completion.id} incremented by {offset}.")
+        return completion_id
 
-    def generate_image(
-        self, prompt: str, reply_to_msg: MessageInfo, thread_name: str
-    ) -> Image.Image | None:
+    def _format_context(
+        self,
+        context: list[MessageInfo],
+        personality_override: str = None,
+        summary: tuple[str, datetime.datetime] | None = None,
+        recalled: str | None = None,
+    ) -> list[SystemMessage | HumanMessage | AIMessage]:
         """
-        Generate an image using Stability AI's DreamStudio.
+        Formats chat context and system messages into a chronological list of langchain messages.
 
-        :param prompt: A description of the image that should be generated.
-        :param reply_to_msg: The message the bot is replying to.
-        :param thread_name: A unique identifier for the thread the message resides in.
-        :return: A PIL.Image.Image instance.
+        :param context: A list of MessageInfo.
+        :param summary: The rolling summary of the thread, it replaces the messages it covers.
+        :param recalled: Older messages relevant to the conversation, see edubot.retrieval.
+        :return: The context as a list of langchain message objects.
         """
-        if not DREAMSTUDIO_KEY:
-            raise RuntimeError(
-                "DreamStudio key is not defined, make sure to supply it in the config."
-            )
+        from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
-        # Lazy load client
-        if self.stability_client is None:
-            verbose = logger.level >= 10
-            self.stability_client = StabilityInference(
-                key=DREAMSTUDIO_KEY, verbose=verbose
-            )
+        if personality_override:
+            # We need to shallow copy 'self.personality' to avoid modifying the original list
+            personality = self.personality.copy()
+            personality.append(personality_override)
+        else:
+            personality = self.personality
 
-        # Get Answer objects from stability
-        answers = self.stability_client.generate(prompt)
+        system = self.system_messages + personality
 
-        # Convert answer objects into artifacts we can use
-        artifacts = process_artifacts_from_answers("", "", answers, write=False)
+        if summary is not None:
+            system = system + [
+                f"A summary of the earlier conversation in this chat: {summary[0]}"
+            ]
+            context = thread_summaries.recent(summary, context)
 
-        image: Image.Image | None = None
+        if recalled is not None:
+            system = system + [recalled]
 
-        # noinspection PyBroadException
-        try:
-            for _, artifact in artifacts:
-                # Check that the artifact is an Image, not sure why this is necessary.
-                # See: https://github.com/Stability-AI/stability-sdk/blob/d8f140f8828022d0ad5635acbd0fecd6f6fc317a/src/stability_sdk/utils.py#L80
-                if artifact.type == generation.ARTIFACT_IMAGE:
-                    image = PIL.Image.open(io.BytesIO(artifact.binary))
-                    break
+        # Keep the newest messages that fit in the prompt alongside the system messages
+        start = PROMPT_BUDGET.fit(system, [msg["message"] for msg in context])
+
+        langchain_messages: list[SystemMessage | HumanMessage | AIMessage] = [
+            SystemMessage(content=i) for i in system
+        ]
+
+        for msg in context[start:]:
+            if msg["username"] == self.username:
+                langchain_messages.append(AIMessage(content=msg["message"]))
+            else:
+                langchain_messages.append(HumanMessage(content=msg["message"]))
+
+        return langchain_messages
+
+    def _clean_completion(self, completion: str) -> str:
+        """
+        Strip username from completion, sometimes GPT messes this up.
+        """
+        return completion.replace(f"{self.username}:", "").lstrip()
+
+    @staticmethod
+    def _prepare_image(
+        image: Image.Image,
+    ) -> tuple[Image.Image, captions.CacheKey | None] | None:
+        """
+        Downscale an image for captioning, the checks are cheap so oversized images are rejected quickly.
+
+        :returns: The downscaled image and its key in the caption cache (None if it isn't cached), or None if the
+         image is too large.
+        """
+        if captions.too_large(image):
+            logger.info(f"Skipped image because it was too large.")
+            return None
+
+        image = captions.downscale(image)
+
+        return image, captions.cache_key(image)
+
+    @staticmethod
+    def _describe_image(image: Image.Image) -> str | None:
+        """
+        Gets an AI generated description of an image prepared by _prepare_image.
+        """
+        if not REPLICATE_KEY:
+            raise RuntimeError(
+                "Replicate key is not defined, make sure to supply it in the config."
+            )
+
+        # The image is encoded for each attempt, as uploading it consumes the file
+        output: str = _caption_hedger.call(
+            lambda: get_replicate_client().run(
+                "j-min/clip-caption-reward:de37751f75135f7ebbe62548e27d6740d5155dfefdf6447db35c9865253d7e06",
+                input={"image": captions.encode(image)},
+            )
+        )
+
+        if not output:
+            logger.error("Replicate returned an empty response.")
+            return None
+
+        return output
+
+    def _generate_image(self, prompt: str) -> Image.Image | None:
+        """
+        Generate an image using Stability AI's DreamStudio, returns None if the prompt was rejected.
+        """
+        if not DREAMSTUDIO_KEY:
+            raise RuntimeError(
+                "DreamStudio key is not defined, make sure to supply it in the config."
+            )
+
+        from PIL import Image
+        from stability_sdk.client import (
+            StabilityInference,
+            process_artifacts_from_answers,
+        )
+        from stability_sdk.utils import generation
+
+        # Lazy load client, once if several threads generate images at the same time
+        with self.__stability_lock:
+            if self.stability_client is None:
+                verbose = logger.level >= 10
+                self.stability_client = StabilityInference(
+                    key=DREAMSTUDIO_KEY, verbose=verbose
+                )
+
+        # Get Answer objects from stability, generated images cost too much to hedge
+        answers = deadlines.call(lambda: list(self.stability_client.generate(prompt)))
+
+        # Convert answer objects into artifacts we can use
+        artifacts = process_artifacts_from_answers("", "", answers, write=False)
+
+        image: Image.Image | None = None
+
+        # noinspection PyBroadException
+        try:
+            for _, artifact in artifacts:
+                # Check that the artifact is an Image, not sure why this is necessary.
+                # See: https://github.com/Stability-AI/stability-sdk/blob/d8f140f8828022d0ad5635acbd0fecd6f6fc317a/src/stability_sdk/utils.py#L80
+                if artifact.type == generation.ARTIFACT_IMAGE:
+                    image = Image.open(io.BytesIO(artifact.binary))
+                    break
         # Exception only happens when prompt is inappropriate.
         except Exception:
             return None
 
-        if image is None:
+        return image
+
+    @staticmethod
+    def _generated_image_completion(prompt: str, image_description: str) -> str:
+        """
+        The completion stored for an image the bot generated.
+        """
+        return (
+            f"*An image you generated based on the prompt: '{prompt}'.\n"
+            f"*Your interpretation of the image is: '{image_description}'."
+        )
+
+    @staticmethod
+    def _summary_context(text: str) -> list[dict]:
+        """
+        The OpenAI chat messages used to summarise the plaintext of a web page.
+        """
+        # Ensure text doesn't exceed GPT limits
+        text = truncate_tokens(
+            text,
+            MAX_PROMPT_TOKENS - estimate_tokens(WEB_SUMMARY_PROMPT),
+            GPT_SETTINGS["model"],
+        )
+
+        return [
+            {"role": "system", "content": WEB_SUMMARY_PROMPT},
+            {"role": "user", "content": text},
+        ]
+
+    @staticmethod
+    def _summary_chunks(text: str) -> list[list[dict]]:
+        """
+        The OpenAI chat messages used to summarise each part of a web page that is too long to summarise at once.
+
+        Returns an empty list if the page fits in a single prompt.
+        """
+        chunks = split_tokens(
+            text,
+            MAX_PROMPT_TOKENS - estimate_tokens(WEB_CHUNK_PROMPT),
+            GPT_SETTINGS["model"],
+        )
+
+        if len(chunks) == 1:
+            return []
+
+        return [
+            [
+                {"role": "system", "content": WEB_CHUNK_PROMPT},
+                {"role": "user", "content": chunk},
+            ]
+            for chunk in chunks[:MAX_SUMMARY_CHUNKS]
+        ]
+
+    @staticmethod
+    def _combine_chunk_summaries(completions: list[dict]) -> str:
+        """
+        Join the summaries of each part of a web page into the text that is summarised for users.
+        """
+        return "\n\n".join(
+            completion["choices"][0]["message"]["content"].strip()
+            for completion in completions
+        )
+
+    @staticmethod
+    def _parse_summary(completion: dict) -> str | None:
+        """
+        Get the summary from an OpenAI response, returns None if the page had nothing to summarise.
+        """
+        completion_text: str = completion["choices"][0]["message"]["content"]
+
+        if "NO CONTENT" in completion_text.upper():
             return None
 
-        with Session() as session:
-            thread = self.__get_thread(thread_name)
+        return completion_text.strip()
 
-            if not thread:
-                thread = Thread(thread_name=thread_name, platform=self.platform)
+    @staticmethod
+    def _measure_prompt(langchain_context: list, completion: str) -> None:
+        """
+        Record the size of a chat prompt and its completion in the metrics of the call in progress.
+        """
+        if (call := metrics.current()) is None:
+            return
 
-                session.add(thread)
-                session.commit()
+        call.context_messages += len(langchain_context)
+        call.add_tokens(
+            # Prompt messages were already counted when trimming the context, so these counts are cached
+            sum(estimate_tokens(message.content) for message in langchain_context),
+            estimate_tokens(completion),
+        )
+
+    @staticmethod
+    def _llm_request(kind: str, messages: list[tuple[str, str]]) -> tuple[str, int]:
+        """
+        Describe a request for the LLM gateway.
+
+        :param kind: The kind of response the request returns, E.g. 'chat' 'summary'
+        :param messages: The role and content of each message in the request.
+        :returns: The key of the request and an estimate of the tokens it uses, including the completion.
+        """
+        tokens = sum(estimate_tokens(content) for _, content in messages)
+
+        return (
+            request_key(kind, GPT_SETTINGS, messages),
+            tokens + GPT_SETTINGS["max_tokens"],
+        )
 
-            message = Message(
-                username=reply_to_msg["username"],
-                message=reply_to_msg["message"],
-                time=reply_to_msg["time"],
-                thread=thread.id,
+    @staticmethod
+    def _measure_usage(completion: dict) -> None:
+        """
+        Record the token usage OpenAI reports for a completion in the metrics of the call in progress.
+        """
+        if (call := metrics.current()) is not None and "usage" in completion:
+            call.add_tokens(
+                completion["usage"]["prompt_tokens"],
+                completion["usage"]["completion_tokens"],
             )
-            session.add(message)
+
+    @staticmethod
+    def _read_page(summary: _UrlSummary, html: str | None) -> None:
+        """
+        Convert a downloaded web page to plaintext, recording why it can't be summarised if it fails.
+        """
+        # If HTTP or network error
+        if not html:
+            summary["outcome"] = url_cache.FETCH_FAILED
+            return
+
+        import trafilatura
+
+        text = trafilatura.extract(html)
+
+        # If error converting to plaintext
+        if text is None:
+            summary["outcome"] = url_cache.NO_CONTENT
+            return
+
+        summary["text"] = text
+        summary["text_hash"] = url_cache.content_hash(text)
+
+    @staticmethod
+    def _set_summary(summary: _UrlSummary, text: str | None) -> None:
+        """
+        Record the summary of a page, None if the page had nothing to summarise.
+        """
+        summary["summary"] = text
+        summary["outcome"] = url_cache.SUMMARISED if text else url_cache.NO_CONTENT
+        # The plaintext can be large, it isn't needed once the page is summarised
+        summary["text"] = None
+
+
+class EduBot(BaseEduBot):
+    """
+    An AI chatbot which continually improves itself using user feedback.
+    """
+
+    def __init__(self, username: str, platform: str, personality: str | list[str]):
+        """
+        Initialise EduBot with personalised information about the bot.
+
+        :param username: A unique name to identify this bot from others on the same platform.
+        :param platform: The platform the bot is running on E.g. 'telegram' 'matrix' 'mastodon'
+        :param personality: Instructions/information for the bot to follow when generating responses.
+        """
+        super().__init__(username, platform, personality)
+
+        create_schema()
+
+        self._bot_pk = self.__run_in_transaction(self._add_bot_to_db)
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """
+        Call a method in the thread pool shared by every bot, E.g. bot.submit("gpt_answer", context, thread_name)
+
+        Calls for the same thread run one at a time in the order they were submitted, calls for different threads run
+         in parallel, up to BOT_WORKERS at once. Calling methods directly from several threads is also safe.
+
+        :param method: The name of a method that takes a thread_name, except gpt_answer_stream.
+        :returns: A future of the value returned by the method.
+        """
+        fn = getattr(self, method)
+        thread_name = (
+            inspect.signature(fn).bind(*args, **kwargs).arguments["thread_name"]
+        )
+
+        return get_executor().submit((self.platform, thread_name), fn, *args, **kwargs)
+
+    def __run_in_transaction(self, method: Callable, *args) -> Any:
+        """
+        Run one of the session methods shared with AsyncEduBot in a transaction.
+        """
+        with metrics.stage("db"), Session() as session:
+            result = method(session, *args)
             session.commit()
 
-        image_description = self.__describe_image(image)
-        completion = (
-            f"*An image you generated based on the prompt: '{prompt}'.\n"
-            f"*Your interpretation of the image is: '{image_description}'."
+        return result
+
+    def __schedule_summary_update(self, thread_id: int) -> None:
+        """
+        Update the rolling summary of a thread in the background, if rolling summaries are enabled.
+        """
+        if thread_summaries.enabled() and thread_summaries.claim(
+            thread_id, self._bot_pk
+        ):
+            _summary_pool.submit(self.__update_summary, thread_id)
+
+    @deadlines.bounded
+    def __update_summary(self, thread_id: int) -> None:
+        """
+        Fold the messages that have aged out of the window into the rolling summary of a thread.
+        """
+        try:
+            while backlog := self.__run_in_transaction(
+                thread_summaries.backlog,
+                thread_id,
+                self._bot_pk,
+                self.username,
+                GPT_SETTINGS["model"],
+            ):
+                completion = self.__create_summary(
+                    thread_summaries.request_messages(backlog)
+                )
+                summary = completion["choices"][0]["message"]["content"].strip()
+
+                if not self.__run_in_transaction(
+                    thread_summaries.store, backlog, summary
+                ):
+                    break
+        except Exception:
+            # The update is retried after the next completion in the thread
+            logger.exception(f"Updating the summary of thread {thread_id} failed.")
+        finally:
+            thread_summaries.release(thread_id, self._bot_pk)
+
+    def __caption_image(self, image: Image.Image) -> str | None:
+        """
+        Gets an AI generated description of an image, reusing the caption of a similar image if there is one.
+        """
+        with metrics.stage("prepare_image"):
+            prepared = self._prepare_image(image)
+
+        if prepared is None:
+            return None
+
+        image, key = prepared
+
+        if key and (caption := self.__run_in_transaction(captions.lookup, key)):
+            return caption
+
+        with metrics.stage("caption"):
+            caption = self._describe_image(image)
+
+        if key and caption:
+            self.__run_in_transaction(captions.store, key, caption)
+
+        return caption
+
+    @metrics.measured("save_image_to_context")
+    @deadlines.bounded
+    @_per_thread()
+    def save_image_to_context(self, image: ImageInfo, thread_name: str) -> str | None:
+        """
+        Saves an AI generated description of a user-sent image to the database. This allows GPT to understand what images are
+         and how to describe them. The maximum image size in MB can be read from the MAX_IMAGE_SIZE_MB constant.
+
+        :param image: An ImageInfo object.
+        :param thread_name: A unique identifier for the thread the image was posted in.
+        :returns: The description of the image or None if an error occurred.
+        """
+        image_description = self.__caption_image(image["image"])
+
+        if image_description is None:
+            return None
+
+        self.__run_in_transaction(
+            self._save_message,
+            {
+                "username": image["username"],
+                "message": f"*An image of {image_description}",
+                "time": image["time"],
+            },
+            thread_name,
+        )
+
+        return image_description
+
+    @metrics.measured("gpt_answer")
+    @deadlines.bounded
+    @_per_thread()
+    def gpt_answer(
+        self,
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> CompletionText | None:
+        """
+        Use chat context to generate a GPT3 response.
+
+        If the bot already replied to the newest message, E.g. the integration retried a call that succeeded, that
+         reply is returned instead of generating another one.
+
+        :param new_context: Chat context as a chronological list of MessageInfo
+        :param thread_name: The unique identifier of the thread this context pertains to
+        :param personality_override: A custom personality that overrides the default.
+
+        :returns: The response from GPT, its 'id' attribute can be passed to change_completion_score.
+        """
+        thread_id, complete_context, summary, recalled = self.__run_in_transaction(
+            self._prompt_context, new_context, thread_name
+        )
+
+        # The newest message was already answered, E.g. the integration retried a call that succeeded
+        if complete_context[-1]["username"] == self.username:
+            return self.__run_in_transaction(
+                self._previous_answer, complete_context, thread_id
+            )
+
+        with metrics.stage("tokenize"):
+            langchain_context = self._format_context(
+                complete_context,
+                personality_override=personality_override,
+                summary=summary,
+                recalled=recalled,
+            )
+
+        key, tokens = self._llm_request(
+            "chat", [(msg.type, msg.content) for msg in langchain_context]
+        )
+
+        # An identical prompt may already have a completion, which is still saved as a new completion to be scored
+        cache_key = key if completion_cache.enabled(GPT_SETTINGS) else None
+
+        if cache_key is not None:
+            with metrics.stage("cache"):
+                completion = completion_cache.get(
+                    cache_key
+                ) or self.__run_in_transaction(completion_cache.lookup, cache_key)
+
+            if completion is not None:
+                completion_id = self.__run_in_transaction(
+                    self._add_completion, completion, complete_context[-1], thread_id
+                )
+                self.__schedule_summary_update(thread_id)
+                return CompletionText(completion, completion_id)
+
+        with metrics.stage("llm"):
+            completion = (
+                get_gateway()
+                .call(
+                    lambda: get_llm()(langchain_context, **deadlines.request_timeout()),
+                    key,
+                    tokens,
+                    _chat_hedger,
+                )
+                .content
+            )
+
+        if not completion:
+            return None
+
+        completion = self._clean_completion(completion)
+        self._measure_prompt(langchain_context, completion)
+
+        # Add a new completion to the database using the completion text and the message being replied to
+        completion_id = self.__run_in_transaction(
+            self._add_completion,
+            completion,
+            complete_context[-1],
+            thread_id,
+            cache_key,
+        )
+        self.__schedule_summary_update(thread_id)
+
+        # Return the completion result back to the integration
+        return CompletionText(completion, completion_id)
+
+    def gpt_answer_stream(
+        self,
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> Iterator[str]:
+        """
+        Use chat context to generate a GPT response, yielding the response in chunks as they are generated.
+
+        Integrations can use this to progressively edit the posted message. Once the stream ends the complete response
+        is added to the database like gpt_answer, it isn't added if the stream is closed early. Like gpt_answer, the
+        bot's existing reply to the newest message is yielded as one chunk if there is one.
+
+        The response is generated in a background thread from when the first chunk is requested, it is given the same
+         deadline as other calls from then. A slow consumer doesn't hold up other calls for the thread, or other OpenAI
+         requests.
+
+        :param new_context: Chat context as a chronological list of MessageInfo
+        :param thread_name: The unique identifier of the thread this context pertains to
+        :param personality_override: A custom personality that overrides the default.
+
+        :returns: An iterator of response chunks
+        """
+        # Chunks of the response, then an exception if generating it failed, then None
+        chunks: queue.SimpleQueue = queue.SimpleQueue()
+        closed = threading.Event()
+
+        threading.Thread(
+            target=metrics.bind(self.__produce_stream),
+            args=(chunks, closed, new_context, thread_name, personality_override),
+            name="edubot-stream",
+            daemon=True,
+        ).start()
+
+        try:
+            while (chunk := chunks.get()) is not None:
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            # Stops the response being generated and saved if the stream was closed early
+            closed.set()
+
+    def __produce_stream(
+        self, chunks: queue.SimpleQueue, closed: threading.Event, *args
+    ) -> None:
+        """
+        Generate a streamed response for gpt_answer_stream, putting its chunks in "chunks".
+        """
+        try:
+            self.__stream_completion(chunks.put, closed, *args)
+        except BaseException as e:
+            chunks.put(e)
+        finally:
+            chunks.put(None)
+
+    @metrics.measured("gpt_answer_stream")
+    @deadlines.bounded
+    @_per_thread(dedupe=False)
+    def __stream_completion(
+        self,
+        send: Callable[[str], None],
+        closed: threading.Event,
+        new_context: list[MessageInfo],
+        thread_name: str,
+        personality_override: str = None,
+    ) -> None:
+        """
+        Generate a response like gpt_answer, sending it in chunks as they are generated until "closed" is set.
+        """
+        thread_id, complete_context, summary, recalled = self.__run_in_transaction(
+            self._prompt_context, new_context, thread_name
+        )
+
+        # The newest message was already answered, E.g. the integration retried a call that succeeded
+        if complete_context[-1]["username"] == self.username:
+            if previous := self.__run_in_transaction(
+                self._previous_answer, complete_context, thread_id
+            ):
+                send(previous)
+            return
+
+        with metrics.stage("tokenize"):
+            langchain_context = self._format_context(
+                complete_context,
+                personality_override=personality_override,
+                summary=summary,
+                recalled=recalled,
+            )
+
+        cleaner = _CompletionCleaner(self.username)
+
+        _, tokens = self._llm_request(
+            "chat", [(msg.type, msg.content) for msg in langchain_context]
+        )
+
+        # Streams can't be retried or shared once they have started, so they are only limited
+        with metrics.stage("llm"), get_gateway().limit(tokens), closing(
+            get_llm().stream(langchain_context, **deadlines.request_timeout())
+        ) as stream:
+            for chunk in stream:
+                if closed.is_set():
+                    return
+
+                if text := cleaner.feed(chunk.content):
+                    send(text)
+
+        if text := cleaner.flush():
+            send(text)
+
+        if not cleaner.text or closed.is_set():
+            return
+
+        self._measure_prompt(langchain_context, cleaner.text)
+
+        self.__run_in_transaction(
+            self._add_completion, cleaner.text, complete_context[-1], thread_id
+        )
+        self.__schedule_summary_update(thread_id)
+
+    @metrics.measured("change_completion_score")
+    @deadlines.bounded
+    # Identical score changes each count
+    @_per_thread(dedupe=False)
+    def change_completion_score(
+        self, offset: int, completion: CompletionInfo | int, thread_name: str
+    ) -> None:
+        """
+        Change user feedback to a completion.
+
+        Changes are buffered and written in batches if FEEDBACK_FLUSH_INTERVAL is set, see edubot.feedback.
+
+        :param offset: An integer representing the new positive or negative votes to this reaction.
+        :param completion: The ID of the completion returned by gpt_answer, or information about the completion.
+        :param thread_name: A unique identifier for the thread the completion resides in.
+        """
+        if isinstance(completion, int):
+            if not self.__run_in_transaction(
+                self._completion_in_thread, completion, thread_name
+            ):
+                logger.warning(
+                    f"Completion {completion} of {self.username} isn't in thread {thread_name}, it wasn't scored."
+                )
+                return
+
+            completion_id = completion
+        else:
+            completion_id = self.__run_in_transaction(
+                self._find_completion, completion, thread_name
+            )
+
+            if completion_id is None:
+                return
+
+        if feedback.enabled():
+            feedback.add(self._bot_pk, completion_id, offset)
+        else:
+            self.__run_in_transaction(
+                queries.add_scores, {(self._bot_pk, completion_id): offset}
+            )
+
+        logger.info(f"Completion {completion_id} incremented by {offset}.")
+
+    @metrics.measured("generate_image")
+    @deadlines.bounded
+    @_per_thread()
+    def generate_image(
+        self, prompt: str, reply_to_msg: MessageInfo, thread_name: str
+    ) -> Image.Image | None:
+        """
+        Generate an image using Stability AI's DreamStudio.
+
+        :param prompt: A description of the image that should be generated.
+        :param reply_to_msg: The message the bot is replying to.
+        :param thread_name: A unique identifier for the thread the message resides in.
+        :return: A PIL.Image.Image instance.
+        """
+        with metrics.stage("generate"):
+            image = self._generate_image(prompt)
+
+        if image is None:
+            return None
+
+        thread_id = self.__run_in_transaction(
+            self._save_message, reply_to_msg, thread_name
+        )
+
+        image_description = self.__caption_image(image)
+        completion = self._generated_image_completion(prompt, image_description)
+
+        self.__run_in_transaction(
+            self._add_completion, completion, reply_to_msg, thread_id
         )
-        self.__add_completion(completion, reply_to_msg)
 
         return image
 
-    def summarise_url(self, url: str, msg: MessageInfo, thread_name: str) -> str | None:
+    @metrics.measured("summarise_url")
+    @deadlines.bounded
+    @_per_thread()
+    def summarise_url(
+        self, url: str, msg: MessageInfo, thread_name: str, full_page: bool = False
+    ) -> str | None:
         """
         Use GPT to summarise the text content of a URL.
 
@@ -552,60 +1445,109 @@ class EduBot:
         :param url: A valid url.
         :param msg: The message that triggered this summary request.
         :param thread_name: A unique identifier for the thread the URL was sent in.
+        :param full_page: Summarise pages that are too long for one prompt in parts, instead of truncating them.
         """
-        resp = trafilatura.fetch_url(url)
+        return self.summarise_urls([(url, msg)], thread_name, full_page)[0]
 
-        # If HTTP or network error
-        if resp == "" or resp is None:
-            return None
+    @metrics.measured("summarise_urls")
+    @deadlines.bounded
+    @_per_thread()
+    def summarise_urls(
+        self,
+        requests: list[tuple[str, MessageInfo]],
+        thread_name: str,
+        full_page: bool = False,
+    ) -> list[str | None]:
+        """
+        Use GPT to summarise the text content of several URLs at once, E.g. every link in a message.
 
-        # Convert HTML to Plaintext
-        text = trafilatura.extract(resp)
+        Pages are downloaded concurrently, reusing connections and limiting the downloads from each host, and then
+        summarised concurrently. FETCH_WORKERS caps the downloads in flight, and OpenAI requests are limited by the
+        gateway, see edubot.gateway.
 
-        # If error converting to plaintext
-        if text is None:
-            return None
+        :param requests: Pairs of a valid url and the message that triggered its summary request.
+        :param thread_name: A unique identifier for the thread the URLs were sent in.
+        :param full_page: Summarise pages that are too long for one prompt in parts, instead of truncating them.
+        :returns: The summary of each URL in the same order as "requests", None if a page couldn't be summarised.
+        """
+        summaries = self.__run_in_transaction(self._cached_summaries, requests)
+
+        if uncached := [summary for summary in summaries if not summary["cached"]]:
+            with metrics.stage("fetch"), ThreadPoolExecutor(FETCH_WORKERS) as pool:
+                list(pool.map(metrics.bind(self.__fetch_page), uncached))
+
+            self.__run_in_transaction(self._content_summaries, uncached)
+
+        if pending := [summary for summary in summaries if summary["text"] is not None]:
+            with metrics.stage("llm"), ThreadPoolExecutor(SUMMARY_WORKERS) as pool:
+                list(
+                    pool.map(
+                        metrics.bind(
+                            lambda summary: self.__summarise_page(summary, full_page)
+                        ),
+                        pending,
+                    )
+                )
 
-        # Ensure text doesn't exceed GPT limits
-        while estimate_tokens(text) > MAX_PROMPT_TOKENS:
-            text = text[:-100]
+        # All outcomes and summaries are saved together
+        self.__run_in_transaction(self._save_summaries, summaries, thread_name)
+
+        return [summary["summary"] for summary in summaries]
+
+    def __fetch_page(self, summary: _UrlSummary) -> None:
+        """
+        Download a web page and convert it to plaintext.
+        """
+        import trafilatura
+
+        # trafilatura keeps a pool of connections per host, so they are reused between pages
+        with _host_limit(summary["url"]):
+            html = deadlines.call(lambda: trafilatura.fetch_url(summary["url"]))
+
+        self._read_page(summary, html)
+
+    def __summarise_page(self, summary: _UrlSummary, full_page: bool) -> None:
+        """
+        Summarise the plaintext of a web page, the page is left without an outcome if OpenAI fails.
+        """
+        from openai import OpenAIError
+
+        text = summary["text"]
 
-        gpt_context = [
-            {"role": "system", "content": WEB_SUMMARY_PROMPT},
-            {"role": "user", "content": text},
-        ]
         try:
-            completion = openai.ChatCompletion.create(
-                messages=gpt_context,
-                **GPT_SETTINGS,
-            )
+            if full_page and (chunks := self._summary_chunks(text)):
+                with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as pool:
+                    text = self._combine_chunk_summaries(
+                        list(pool.map(metrics.bind(self.__create_summary), chunks))
+                    )
+
+            completion = self.__create_summary(self._summary_context(text))
         except OpenAIError as e:
             logger.error(f"OpenAI request failed: {e}")
-            return None
-
-        completion_text: str = completion["choices"][0]["message"]["content"]
-
-        if "NO CONTENT" in completion_text.upper():
+            summary["text"] = None
             return
 
-        completion_text = completion_text.strip()
+        self._set_summary(summary, self._parse_summary(completion))
 
-        with Session() as session:
-            thread = self.__get_thread(thread_name)
-            if not thread:
-                thread = Thread(thread_name=thread_name, platform=self.platform)
-                session.add(thread)
-                session.commit()
-
-            if self.__get_message(msg) is None:
-                row: dict = msg
-                row["thread"] = thread.id
-                session.add(Message(**row))
-                session.commit()
+    @staticmethod
+    def __create_summary(messages: list[dict]) -> dict:
+        """
+        Send a summary request to OpenAI through the gateway.
+        """
+        import openai
 
-            # Ensure URL summaries are added to the DB
-            self.__add_completion(completion_text, msg)
+        key, tokens = BaseEduBot._llm_request(
+            "summary", [(msg["role"], msg["content"]) for msg in messages]
+        )
+        completion = get_gateway().call(
+            lambda: openai.ChatCompletion.create(
+                messages=messages, **GPT_SETTINGS, **deadlines.request_timeout()
+            ),
+            key,
+            tokens,
+            _summary_hedger,
+        )
 
-            session.commit()
+        BaseEduBot._measure_usage(completion)
 
-        return completion_text
+        return completion
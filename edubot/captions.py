@@ -0,0 +1,240 @@
+"""
+Preparing images for the captioning model, and a database cache of captions so similar images are only captioned once.
+"""
+from __future__ import annotations
+
+import io
+from datetime import datetime
+from typing import TYPE_CHECKING, NamedTuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from edubot import CAPTION_CACHE_SIZE
+from edubot.queries import upsert
+from edubot.sql import ImageCaption, ImageCaptionBucket
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# The maximum allowed size of images in megabytes, measured uncompressed so it can be checked without encoding
+MAX_IMAGE_SIZE_MB = 50
+
+# Images are downscaled to fit in this resolution before captioning, the model works at a lower resolution
+CAPTION_RESOLUTION = (512, 512)
+
+# Encoding quality of images sent to the captioning model
+JPEG_QUALITY = 90
+
+# The width and height of the grid a perceptual hash compares, giving a 256 bit hash
+HASH_SIZE = 16
+
+# Images whose perceptual hash has fewer bits set than this are nearly uniform, E.g. a plain colour or a screenshot of
+#  a little text, and aren't cached as different images of this kind are too easily confused
+MIN_HASH_BITS = 16
+
+# Cached captions are reused for images whose perceptual hash differs by at most this many bits, E.g. resized or
+#  re-encoded copies of an image. Images that differ only in small details, like a line of small text, can also match
+MAX_HASH_DISTANCE = 8
+# ... and whose aspect ratio differs by at most this fraction
+MAX_ASPECT_DIFFERENCE = 0.02
+
+# Hashes are looked up by each of this many bands, hashes that differ by fewer bits than there are bands have at least
+#  one band in common, so this must be more than MAX_HASH_DISTANCE
+HASH_BANDS = 16
+_BAND_BITS = HASH_SIZE * HASH_SIZE // HASH_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+
+class CacheKey(NamedTuple):
+    """
+    The dimensions and perceptual hash of a downscaled image, which identify it in the caption cache.
+    """
+
+    width: int
+    height: int
+    image_hash: int
+
+    def __str__(self) -> str:
+        return f"{self.width}x{self.height}:{self.image_hash:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+    @classmethod
+    def parse(cls, text: str) -> CacheKey:
+        """
+        Read a key from the string it is stored as.
+        """
+        size, image_hash = text.split(":")
+        width, height = size.split("x")
+
+        return cls(int(width), int(height), int(image_hash, 16))
+
+
+def too_large(image: Image.Image) -> bool:
+    """
+    Returns whether an image is over MAX_IMAGE_SIZE_MB, based on its dimensions rather than its encoded size.
+    """
+    width, height = image.size
+    return width * height * len(image.getbands()) / 1048576 > MAX_IMAGE_SIZE_MB
+
+
+def downscale(image: Image.Image) -> Image.Image:
+    """
+    Returns a copy of an image that fits in CAPTION_RESOLUTION and has no transparency.
+    """
+    from PIL import Image
+
+    image = image.copy()
+    # Reducing by an integer factor first is much faster than resampling the full image
+    image.thumbnail(CAPTION_RESOLUTION, reducing_gap=2.0)
+
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        image = image.convert("RGBA")
+        # Transparent areas would otherwise turn black
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+
+    return image.convert("RGB")
+
+
+def encode(image: Image.Image) -> io.BytesIO:
+    """
+    Encode a downscaled image as a JPEG for upload, which is much faster than PNG.
+    """
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format="JPEG", quality=JPEG_QUALITY)
+    image_bytes.seek(0)
+    # Used by the upload to set the file's content type
+    image_bytes.name = "image.jpg"
+
+    return image_bytes
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """
+    Returns the difference hash of an image, resized or re-encoded copies of an image have similar hashes.
+    """
+    from PIL import Image
+
+    pixels = list(
+        image.convert("L")
+        .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+        .getdata()
+    )
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (HASH_SIZE + 1) + col + 1])
+
+    return bits
+
+
+def cache_key(image: Image.Image) -> CacheKey | None:
+    """
+    Returns the key of a downscaled image in the caption cache, or None if the image shouldn't be cached.
+    """
+    image_hash = perceptual_hash(image)
+
+    if image_hash.bit_count() < MIN_HASH_BITS:
+        return None
+
+    width, height = image.size
+
+    return CacheKey(width, height, image_hash)
+
+
+def _buckets(image_hash: int) -> list[int]:
+    """
+    Returns each band of a perceptual hash combined with its position, images with a bucket in common are compared.
+    """
+    return [
+        (band << _BAND_BITS) | (image_hash >> (band * _BAND_BITS) & _BAND_MASK)
+        for band in range(HASH_BANDS)
+    ]
+
+
+def _distance(key: CacheKey, other: CacheKey) -> int | None:
+    """
+    Returns the number of bits two perceptual hashes differ by, or None if the images' aspect ratios differ.
+    """
+    ratio, other_ratio = key.width / key.height, other.width / other.height
+
+    if abs(ratio - other_ratio) > MAX_ASPECT_DIFFERENCE * max(ratio, other_ratio):
+        return None
+
+    return (key.image_hash ^ other.image_hash).bit_count()
+
+
+def lookup(session: Session, key: CacheKey) -> str | None:
+    """
+    Get the cached caption of the most similar image to a cache_key(), marking it as recently used.
+
+    Images are similar if their aspect ratios match and their perceptual hashes differ by at most MAX_HASH_DISTANCE
+     bits, E.g. resized or re-encoded copies of an image.
+    """
+    candidates = session.scalars(
+        select(ImageCaption).where(
+            ImageCaption.id.in_(
+                select(ImageCaptionBucket.caption).where(
+                    ImageCaptionBucket.bucket.in_(_buckets(key.image_hash))
+                )
+            )
+        )
+    )
+
+    best = None
+    best_distance = MAX_HASH_DISTANCE + 1
+
+    for entry in candidates:
+        distance = _distance(key, CacheKey.parse(entry.image_hash))
+
+        if distance is not None and distance < best_distance:
+            best, best_distance = entry, distance
+
+    if best is None:
+        return None
+
+    best.last_used = datetime.utcnow()
+
+    return best.caption
+
+
+def store(session: Session, key: CacheKey, caption: str) -> None:
+    """
+    Cache the caption of an image by its cache_key(), then evict the least recently used captions past
+     CAPTION_CACHE_SIZE.
+    """
+    upsert(
+        session,
+        ImageCaption,
+        {"image_hash": str(key), "caption": caption, "last_used": datetime.utcnow()},
+        ["image_hash"],
+    )
+
+    caption_id = session.scalar(
+        select(ImageCaption.id).where(ImageCaption.image_hash == str(key))
+    )
+    session.execute(
+        delete(ImageCaptionBucket).where(ImageCaptionBucket.caption == caption_id)
+    )
+    session.execute(
+        insert(ImageCaptionBucket),
+        [
+            {"caption": caption_id, "bucket": bucket}
+            for bucket in _buckets(key.image_hash)
+        ],
+    )
+
+    excess = session.scalar(select(func.count(ImageCaption.id))) - CAPTION_CACHE_SIZE
+    if excess > 0:
+        evicted = list(
+            session.scalars(
+                select(ImageCaption.id).order_by(ImageCaption.last_used).limit(excess)
+            )
+        )
+        session.execute(
+            delete(ImageCaptionBucket).where(ImageCaptionBucket.caption.in_(evicted))
+        )
+        session.execute(delete(ImageCaption).where(ImageCaption.id.in_(evicted)))
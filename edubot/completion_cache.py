@@ -0,0 +1,138 @@
+"""
+Cache of completions keyed by their prompt, so a retried or repeated prompt doesn't pay for another OpenAI request.
+
+Entries are kept in the memory of each process and in the database, which is shared between processes. The cache is
+ opt-in with COMPLETION_CACHE_TTL, and is bypassed if the temperature is above COMPLETION_CACHE_MAX_TEMPERATURE.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from edubot import (
+    COMPLETION_CACHE_MAX_TEMPERATURE,
+    COMPLETION_CACHE_MEMORY_SIZE,
+    COMPLETION_CACHE_SIZE,
+    COMPLETION_CACHE_TTL,
+)
+from edubot.queries import upsert
+from edubot.sql import CachedCompletion
+
+logger = logging.getLogger(__name__)
+
+TTL = timedelta(hours=COMPLETION_CACHE_TTL)
+
+# The completion and expiry time of recently used prompts, least recently used first
+_memory: OrderedDict[str, tuple[str, datetime]] = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def enabled(settings: dict) -> bool:
+    """
+    Returns whether completions requested with these GPT settings are cached.
+    """
+    return (
+        bool(COMPLETION_CACHE_TTL)
+        and settings.get("temperature", 1) <= COMPLETION_CACHE_MAX_TEMPERATURE
+    )
+
+
+def check_settings(settings: dict) -> None:
+    """
+    Warn if the cache is turned on but completions requested with these GPT settings are too random to be cached.
+    """
+    if COMPLETION_CACHE_TTL and not enabled(settings):
+        logger.warning(
+            f"Completions aren't cached, their temperature of {settings.get('temperature', 1)} is above"
+            f" completion_cache_max_temperature ({COMPLETION_CACHE_MAX_TEMPERATURE}). Raise it to cache them anyway."
+        )
+
+
+def _remember(prompt_hash: str, completion: str, expires: datetime) -> None:
+    with _memory_lock:
+        _memory[prompt_hash] = (completion, expires)
+        _memory.move_to_end(prompt_hash)
+
+        while len(_memory) > COMPLETION_CACHE_MEMORY_SIZE:
+            _memory.popitem(last=False)
+
+
+def get(prompt_hash: str) -> str | None:
+    """
+    Get a completion from the memory of this process, without touching the database.
+    """
+    with _memory_lock:
+        entry = _memory.get(prompt_hash)
+
+        if entry is None:
+            return None
+
+        completion, expires = entry
+        if expires <= datetime.utcnow():
+            del _memory[prompt_hash]
+            return None
+
+        _memory.move_to_end(prompt_hash)
+
+    return completion
+
+
+def lookup(session: Session, prompt_hash: str) -> str | None:
+    """
+    Get an unexpired completion from the database, marking it as recently used and remembering it in memory.
+    """
+    now = datetime.utcnow()
+
+    entry = session.scalar(
+        select(CachedCompletion)
+        .where(CachedCompletion.prompt_hash == prompt_hash)
+        .where(CachedCompletion.expires > now)
+    )
+
+    if entry is None:
+        return None
+
+    entry.last_used = now
+    _remember(prompt_hash, entry.completion, entry.expires)
+
+    return entry.completion
+
+
+def store(session: Session, prompt_hash: str, completion: str) -> None:
+    """
+    Cache a completion, then evict expired completions and the least recently used past COMPLETION_CACHE_SIZE.
+    """
+    now = datetime.utcnow()
+    expires = now + TTL
+
+    upsert(
+        session,
+        CachedCompletion,
+        {
+            "prompt_hash": prompt_hash,
+            "completion": completion,
+            "expires": expires,
+            "last_used": now,
+        },
+        ["prompt_hash"],
+    )
+    _remember(prompt_hash, completion, expires)
+
+    session.execute(delete(CachedCompletion).where(CachedCompletion.expires <= now))
+
+    excess = (
+        session.scalar(select(func.count(CachedCompletion.id))) - COMPLETION_CACHE_SIZE
+    )
+    if excess > 0:
+        session.execute(
+            delete(CachedCompletion).where(
+                CachedCompletion.id.in_(
+                    select(CachedCompletion.id)
+                    .order_by(CachedCompletion.last_used)
+                    .limit(excess)
+                )
+            )
+        )
@@ -0,0 +1,148 @@
+"""
+Lets one EduBot be shared by many OS threads, E.g. one bot serving many rooms on a multi-core machine.
+
+Calls for the same chat thread run one at a time, identical calls already in flight share one result, and calls for
+ different chat threads run in parallel, either in the caller's threads or in a shared pool, see EduBot.submit.
+"""
+from __future__ import annotations
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Hashable, Iterator, TypeVar
+
+from edubot import BOT_WORKERS, deadlines
+from edubot.deadlines import DeadlineExceeded
+
+T = TypeVar("T")
+
+
+class KeyedLocks:
+    """
+    One reentrant lock per key, locks are dropped once nothing holds or waits for them.
+    """
+
+    def __init__(self):
+        # The lock of each key, and the number of callers holding or waiting for it
+        self.__locks: dict[Hashable, tuple[threading.RLock, int]] = {}
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        """
+        Hold the lock of "key" inside this block, waiting no longer than the deadline of the call in progress.
+        """
+        with self.__lock:
+            lock, users = self.__locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.RLock()
+            self.__locks[key] = (lock, users + 1)
+
+        try:
+            left = deadlines.remaining()
+            if not lock.acquire(timeout=-1 if left is None else left):
+                raise DeadlineExceeded("The thread was busy until the deadline")
+
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            with self.__lock:
+                lock, users = self.__locks[key]
+                if users == 1:
+                    del self.__locks[key]
+                else:
+                    self.__locks[key] = (lock, users - 1)
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, callers with the key of a call in flight receive its result.
+    """
+
+    def __init__(self):
+        self.__in_flight: dict[str, Future] = {}
+        self.__lock = threading.Lock()
+
+    def call(self, key: str, fn: Callable[[], T]) -> T:
+        """
+        Call "fn", or wait for the call in flight with the same key, no longer than the deadline.
+        """
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.__in_flight[key] = Future()
+
+        if not leader:
+            try:
+                return future.result(timeout=deadlines.remaining())
+            except FutureTimeoutError:
+                raise DeadlineExceeded("The call ran past its deadline") from None
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+
+
+class KeyedExecutor:
+    """
+    Runs tasks in a pool of threads, tasks with the same key one at a time in the order they were submitted.
+
+    A key only occupies one thread of the pool at a time, so a busy chat thread can't hold up the others.
+    """
+
+    def __init__(self, max_workers: int):
+        self.__pool = ThreadPoolExecutor(max_workers, thread_name_prefix="edubot")
+        # The tasks waiting to run for each key with a task running
+        self.__queues: dict[Hashable, deque] = {}
+        self.__lock = threading.Lock()
+
+    def submit(self, key: Hashable, fn: Callable[..., T], *args, **kwargs) -> Future[T]:
+        future: Future[T] = Future()
+
+        with self.__lock:
+            idle = key not in self.__queues
+            self.__queues.setdefault(key, deque()).append((future, fn, args, kwargs))
+
+        if idle:
+            self.__pool.submit(self.__run_next, key)
+
+        return future
+
+    def __run_next(self, key: Hashable) -> None:
+        with self.__lock:
+            future, fn, args, kwargs = self.__queues[key].popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # The next task of the key goes to the back of the pool's queue, behind the tasks of other keys
+        with self.__lock:
+            if self.__queues[key]:
+                self.__pool.submit(self.__run_next, key)
+            else:
+                del self.__queues[key]
+
+
+@lru_cache(maxsize=None)
+def get_executor() -> KeyedExecutor:
+    """
+    Returns the pool shared by every bot in this process.
+    """
+    return KeyedExecutor(BOT_WORKERS)
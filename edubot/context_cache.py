@@ -0,0 +1,201 @@
+"""
+In-memory cache of the recent messages and completions of each thread, so consecutive replies only load the delta.
+
+Every write to a thread increments its version in the database. A cached thread is only used while its version matches,
+so writes from other processes invalidate it, while writes from this process are applied to it directly.
+"""
+import threading
+from bisect import bisect_left, insort_right
+from collections import OrderedDict
+from datetime import datetime
+
+from edubot import CONTEXT_CACHE_MESSAGES, CONTEXT_CACHE_THREADS
+from edubot.sql import message_fingerprint
+from edubot.tokens import count_tokens
+
+
+class CachedMessage:
+    """
+    A message held in the cache, it has the same attributes as edubot.sql.Message that context is built from.
+    """
+
+    __slots__ = ("thread", "username", "message", "time", "fingerprint")
+
+    def __init__(self, thread: int, username: str, message: str, time: datetime):
+        self.thread = thread
+        self.username = username
+        self.message = message
+        self.time = time
+        self.fingerprint = message_fingerprint(thread, username, time, message)
+
+
+class _CachedThread:
+    def __init__(
+        self,
+        version: int,
+        since: datetime,
+        messages: list,
+        completions: dict[str, str],
+    ):
+        self.version = version
+        # Every message sent at or after this time is cached
+        self.since = since
+        # Chronological, ties are in the order they were stored
+        self.messages = messages
+        # The text of the bot's earliest completion to each message, keyed by the message's fingerprint
+        self.completions = completions
+
+
+class ContextCache:
+    """
+    A bounded cache of thread context for one bot, the least recently used threads are evicted first.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_threads: int = CONTEXT_CACHE_THREADS,
+        max_messages: int = CONTEXT_CACHE_MESSAGES,
+    ):
+        """
+        :param model: The model whose token counts are precomputed for cached messages.
+        :param max_threads: The maximum number of cached threads, 0 disables the cache.
+        :param max_messages: The maximum number of messages cached per thread.
+        """
+        self.model = model
+        self.max_threads = max_threads
+        self.max_messages = max_messages
+
+        self.__threads: OrderedDict[int, _CachedThread] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(
+        self, thread_id: int, version: int, since: datetime
+    ) -> tuple[list, dict[str, str]] | None:
+        """
+        Get the messages sent in a thread at or after "since" and the completions to them.
+
+        :param version: The version of the thread in the database.
+        :returns: The messages in chronological order and the completions keyed by fingerprint, or None if the
+         thread isn't cached at this version or the cache doesn't go back to "since".
+        """
+        with self.__lock:
+            cached = self.__threads.get(thread_id)
+
+            if cached is None or cached.version != version or since < cached.since:
+                return None
+
+            self.__threads.move_to_end(thread_id)
+
+            start = bisect_left(cached.messages, since, key=lambda msg: msg.time)
+
+            return cached.messages[start:], dict(cached.completions)
+
+    def put(
+        self,
+        thread_id: int,
+        version: int,
+        since: datetime,
+        messages: list,
+        completions: dict[str, str],
+    ) -> None:
+        """
+        Cache the context of a thread loaded from the database.
+
+        :param version: The version of the thread, read before the context was loaded.
+        :param since: The time the context was loaded from.
+        :param messages: Every message sent at or after "since" in chronological order.
+        :param completions: The completions to those messages keyed by fingerprint.
+        """
+        if not self.max_threads:
+            return
+
+        messages = [
+            CachedMessage(msg.thread, msg.username, msg.message, msg.time)
+            for msg in messages
+        ]
+        self.__count_tokens(messages, completions.values())
+
+        with self.__lock:
+            self.__threads[thread_id] = _CachedThread(
+                version, since, messages, dict(completions)
+            )
+            self.__threads.move_to_end(thread_id)
+            self.__trim(thread_id)
+
+            while len(self.__threads) > self.max_threads:
+                self.__threads.popitem(last=False)
+
+    def update(
+        self,
+        thread_id: int,
+        version: int | None,
+        messages: list[CachedMessage] = (),
+        completions: dict[str, str] | None = None,
+    ) -> None:
+        """
+        Apply a write to a thread that incremented its version.
+
+        :param version: The version of the thread after the write, None if it isn't known.
+        :param messages: Messages that were added.
+        :param completions: Completions that were added keyed by the fingerprint of the message they reply to.
+        """
+        completions = completions or {}
+        self.__count_tokens(messages, completions.values())
+
+        with self.__lock:
+            cached = self.__threads.get(thread_id)
+            if cached is None:
+                return
+
+            # Another process wrote to the thread since it was cached
+            if version is None or cached.version != version - 1:
+                del self.__threads[thread_id]
+                return
+
+            cached.version = version
+
+            fingerprints = {msg.fingerprint for msg in cached.messages}
+            for msg in messages:
+                if msg.time >= cached.since and msg.fingerprint not in fingerprints:
+                    insort_right(cached.messages, msg, key=lambda item: item.time)
+
+            for fingerprint, completion in completions.items():
+                cached.completions.setdefault(fingerprint, completion)
+
+            self.__trim(thread_id)
+
+    def __trim(self, thread_id: int) -> None:
+        """
+        Drop the oldest messages of a thread past max_messages.
+        """
+        cached = self.__threads[thread_id]
+
+        excess = len(cached.messages) - self.max_messages
+        if excess <= 0:
+            return
+
+        # Messages sent at the same time are dropped together, so the thread stays complete from "since"
+        cut = excess
+        while (
+            cut < len(cached.messages)
+            and cached.messages[cut].time == cached.messages[excess - 1].time
+        ):
+            cut += 1
+
+        if cut == len(cached.messages):
+            del self.__threads[thread_id]
+            return
+
+        for msg in cached.messages[:cut]:
+            cached.completions.pop(msg.fingerprint, None)
+
+        cached.messages = cached.messages[cut:]
+        cached.since = cached.messages[0].time
+
+    def __count_tokens(self, messages, completions) -> None:
+        # Token counts are memoized, so trimming context to fit the prompt later doesn't tokenize these again
+        for msg in messages:
+            count_tokens(msg.message, self.model)
+        for completion in completions:
+            count_tokens(completion, self.model)
@@ -0,0 +1,293 @@
+"""
+Deadlines that bound how long an EduBot call can take, and hedged requests that cut its tail latency.
+
+Every EduBot method is given CALL_TIMEOUT seconds if it is set, and integrations can give a call less time, E.g.
+    with deadlines.within(10):
+        bot.gpt_answer(context, thread_name)
+
+The deadline applies to everything the call does: SQL statements, waiting for the LLM gateway, OpenAI requests and
+ Replicate and Stability requests. DeadlineExceeded is raised once it passes.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+from edubot import CALL_TIMEOUT, HEDGE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The percentile of recent latencies after which a hedged request sends a second attempt
+HEDGE_PERCENTILE = 95
+# The number of recent latencies the percentile is taken from, and how many are needed before hedging starts
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a call runs past its deadline.
+    """
+
+
+# The time.monotonic() time the call in progress must finish by
+_deadline: ContextVar[float | None] = ContextVar("edubot_deadline", default=None)
+
+
+@contextmanager
+def within(seconds: float | None) -> Iterator[None]:
+    """
+    Give the calls made inside this block "seconds" to finish, an earlier deadline that is already set is kept.
+
+    :param seconds: The time allowed, None for no limit.
+    """
+    current = _deadline.get()
+
+    if seconds is None:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """
+    Returns the seconds left before the deadline, None if there is no deadline.
+
+    :raises DeadlineExceeded: If the deadline has passed.
+    """
+    if (deadline := _deadline.get()) is None:
+        return None
+
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("The call ran past its deadline")
+
+    return left
+
+
+def check(*args) -> None:
+    """
+    Raise DeadlineExceeded if the deadline has passed, it is also a SQLAlchemy 'before_cursor_execute' listener.
+    """
+    remaining()
+
+
+def request_timeout() -> dict:
+    """
+    Returns the keyword arguments that limit an OpenAI request to the time left.
+    """
+    if (left := remaining()) is None:
+        return {}
+
+    return {"request_timeout": left}
+
+
+def bounded(fn: Callable) -> Callable:
+    """
+    Decorator giving every call to a method or coroutine method CALL_TIMEOUT seconds, if it is set.
+    """
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with within(CALL_TIMEOUT or None):
+                # Cancel the whole coroutine at the deadline, including work in other libraries
+                return await wait_for(fn(*args, **kwargs))
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with within(CALL_TIMEOUT or None):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _start(fn: Callable[[], T]) -> Future[T]:
+    """
+    Run "fn" in a daemon thread with the caller's context, so a hung request can't stop the process exiting.
+    """
+    future: Future[T] = Future()
+    context = copy_context()
+
+    def run() -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    return future
+
+
+def call(fn: Callable[[], T]) -> T:
+    """
+    Call "fn", giving up on it at the deadline, for providers whose clients can't be given a timeout.
+
+    A request that is given up on is left to finish in the background.
+    """
+    if (left := remaining()) is None:
+        return fn()
+
+    future = _start(fn)
+    done, _ = wait([future], timeout=left)
+
+    if not done:
+        raise DeadlineExceeded("The call ran past its deadline")
+
+    return future.result()
+
+
+async def wait_for(awaitable: Awaitable[T]) -> T:
+    """
+    Await "awaitable", cancelling it at the deadline.
+    """
+    if (left := remaining()) is None:
+        return await awaitable
+
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("The call ran past its deadline") from None
+
+
+class Hedger:
+    """
+    Sends a second attempt of a request that is slower than usual, using whichever attempt answers first.
+
+    Requests are only hedged once HEDGE_MIN_SAMPLES latencies are known, after the HEDGE_PERCENTILE latency has passed.
+     Only idempotent requests should be hedged, as both attempts can complete.
+    """
+
+    def __init__(self, name: str, enabled: bool = HEDGE_REQUESTS):
+        """
+        :param name: Names the requests in logs, E.g. 'caption'
+        :param enabled: Send second attempts, otherwise requests are only timed.
+        """
+        self.name = name
+        self.enabled = enabled
+        self.__latencies: deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self.__lock = threading.Lock()
+
+    def delay(self) -> float | None:
+        """
+        Returns the seconds after which a second attempt is sent, None if requests aren't hedged yet.
+        """
+        with self.__lock:
+            if not self.enabled or len(self.__latencies) < HEDGE_MIN_SAMPLES:
+                return None
+
+            ordered = sorted(self.__latencies)
+
+        return ordered[min(len(ordered) * HEDGE_PERCENTILE // 100, len(ordered) - 1)]
+
+    def __timed(self, fn: Callable[[], T]) -> Callable[[], T]:
+        def run() -> T:
+            start = time.monotonic()
+            result = fn()
+            with self.__lock:
+                self.__latencies.append(time.monotonic() - start)
+            return result
+
+        return run
+
+    def __atimed(self, fn: Callable[[], Awaitable[T]]) -> Callable[[], Awaitable[T]]:
+        async def run() -> T:
+            start = time.monotonic()
+            result = await fn()
+            with self.__lock:
+                self.__latencies.append(time.monotonic() - start)
+            return result
+
+        return run
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """
+        Call "fn", calling it again in parallel if the first call is slow. Respects the deadline like call().
+        """
+        if (delay := self.delay()) is None:
+            return call(self.__timed(fn))
+
+        left = remaining()
+        attempts = [_start(self.__timed(fn))]
+        done, _ = wait(attempts, timeout=delay if left is None else min(delay, left))
+
+        if not done:
+            logger.debug(f"Hedging a {self.name} request after {delay:.2f}s")
+            attempts.append(_start(self.__timed(fn)))
+
+        while attempts:
+            left = remaining()
+            done, _ = wait(attempts, timeout=left, return_when=FIRST_COMPLETED)
+
+            if not done:
+                raise DeadlineExceeded("The call ran past its deadline")
+
+            for attempt in done:
+                attempts.remove(attempt)
+
+                # The other attempt may still succeed
+                if attempt.exception() is None or not attempts:
+                    # A running attempt can't be stopped, its result is ignored
+                    for loser in attempts:
+                        loser.cancel()
+                    return attempt.result()
+
+    async def acall(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Async version of call(), "fn" returns a new awaitable each time it is called. The slower attempt is cancelled.
+        """
+        if (delay := self.delay()) is None:
+            return await wait_for(self.__atimed(fn)())
+
+        left = remaining()
+        attempts = {asyncio.ensure_future(self.__atimed(fn)())}
+
+        try:
+            done, _ = await asyncio.wait(
+                attempts, timeout=delay if left is None else min(delay, left)
+            )
+
+            if not done:
+                logger.debug(f"Hedging a {self.name} request after {delay:.2f}s")
+                attempts.add(asyncio.ensure_future(self.__atimed(fn)()))
+
+            while attempts:
+                done, _ = await asyncio.wait(
+                    attempts, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not done:
+                    raise DeadlineExceeded("The call ran past its deadline")
+
+                for attempt in done:
+                    attempts.discard(attempt)
+
+                    # The other attempt may still succeed
+                    if attempt.exception() is None or not attempts:
+                        return attempt.result()
+        finally:
+            for loser in attempts:
+                loser.cancel()
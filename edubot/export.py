@@ -0,0 +1,463 @@
+"""
+Export positively scored completions as a chat-format JSONL dataset for fine-tuning, E.g.
+    python -m edubot.export dataset.jsonl --platform matrix --min-score 2 --checkpoint dataset.checkpoint
+
+Every line is one training example: the thread context before a message, trimmed to the prompt budget, followed by
+ the bot's completion to it. Rows are streamed from the database in batches, and examples are passed to the writer in
+ chunks, so memory use doesn't grow with history.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from sqlalchemy import and_, desc, or_, select
+
+from edubot.sql import Bot, Completion, Message, Session, Thread, create_schema
+from edubot.tokens import TokenBudget
+
+logger = logging.getLogger(__name__)
+
+# The number of rows fetched from the database at a time
+EXPORT_BATCH_SIZE = 1000
+
+# The maximum number of messages before a completion that are considered for its context
+MAX_CONTEXT_MESSAGES = 200
+
+# The number of examples passed from a worker to the writer at a time, progress is checkpointed after each chunk
+EXPORT_CHUNK_SIZE = 100
+# The number of chunks each worker can produce ahead of the writer
+EXPORT_QUEUE_CHUNKS = 2
+# Seconds between checks for a closed export by workers waiting for the writer
+_PUT_POLL = 1.0
+
+
+class _Unit:
+    """
+    The completions of one bot in one thread, these are exported together by a worker.
+    """
+
+    __slots__ = ("thread_id", "bot_id", "after")
+
+    def __init__(self, thread_id: int, bot_id: int, after: list | None = None):
+        """
+        :param after: Resume after the example at this position, from a checkpoint.
+        """
+        self.thread_id = thread_id
+        self.bot_id = bot_id
+        self.after = after
+
+    @property
+    def key(self) -> list[int]:
+        return [self.thread_id, self.bot_id]
+
+
+class DatasetExporter:
+    """
+    Streams training examples from the database, optionally exporting several threads in parallel.
+    """
+
+    def __init__(
+        self,
+        bot: str | None = None,
+        platform: str | None = None,
+        min_score: int = 1,
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+        system: list[str] | None = None,
+        max_tokens: int | None = None,
+        workers: int = 1,
+    ):
+        """
+        :param bot: Only export completions of bots with this username.
+        :param platform: Only export threads on this platform.
+        :param min_score: Only export completions scored at least this highly.
+        :param since: Only export completions to messages sent at or after this time.
+        :param until: Only export completions to messages sent before this time.
+        :param system: System messages that start every example, E.g. the bot's personality.
+        :param max_tokens: The prompt budget each example is trimmed to, defaults to the one gpt_answer uses.
+        :param workers: The number of threads exported at the same time.
+        """
+        from edubot.bot import GPT_SETTINGS, MAX_PROMPT_TOKENS
+
+        self.bot = bot
+        self.platform = platform
+        self.min_score = min_score
+        self.since = since
+        self.until = until
+        self.system = system or []
+        self.budget = TokenBudget(
+            GPT_SETTINGS["model"], max_tokens or MAX_PROMPT_TOKENS
+        )
+        self.workers = workers
+
+    def examples(
+        self, after: list[int] | None = None, position: list | None = None
+    ) -> Iterator[dict]:
+        """
+        Yield every training example in the order they are exported.
+
+        :param after: Resume after this unit key, from a checkpoint.
+        :param position: Resume the unit "after" from the example after this position instead.
+        """
+        for _, examples, _ in self.__export_units(after, position):
+            yield from examples
+
+    def export(self, path: str, checkpoint: str | None = None) -> int:
+        """
+        Write every training example to a JSONL file.
+
+        With a checkpoint the export can be resumed if it is interrupted, the file is then appended to instead of
+         being overwritten. Progress is saved after each chunk of examples, along with the length of the file at that
+         point.
+
+        :param path: The file the examples are written to.
+        :param checkpoint: A file that progress is saved to and resumed from.
+        :returns: The number of examples written by this call.
+        """
+        state = _read_checkpoint(checkpoint)
+
+        with open(path, "ab" if state else "wb") as f:
+            if state:
+                # Drop examples written after the checkpoint was saved, they are exported again
+                f.truncate(state["offset"])
+                logger.info(f"Resuming export of {path} after thread {state['unit']}")
+
+            written = 0
+
+            for unit, examples, position in self.__export_units(
+                state and state["unit"], state and state.get("after")
+            ):
+                for example in examples:
+                    f.write(json.dumps(example, ensure_ascii=False).encode() + b"\n")
+                written += len(examples)
+
+                if checkpoint:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    _write_checkpoint(
+                        checkpoint,
+                        {"unit": unit.key, "after": position, "offset": f.tell()},
+                    )
+
+        return written
+
+    def __export_units(
+        self, after: list[int] | None, position: list | None
+    ) -> Iterator[tuple[_Unit, list[dict], list | None]]:
+        """
+        Export units in parallel, yielding chunks of their examples in order.
+
+        Each chunk comes with the position of its last example, the last chunk of a unit comes with None.
+        """
+        closed = threading.Event()
+
+        # Units are submitted as results are consumed, and workers wait for the writer once they are a few chunks
+        #  ahead, so unwritten examples don't pile up in memory
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending: deque[tuple[_Unit, queue.Queue]] = deque()
+
+            try:
+                for unit in self.__units(after, position):
+                    chunks: queue.Queue = queue.Queue(EXPORT_QUEUE_CHUNKS)
+                    pool.submit(self.__produce, unit, chunks, closed)
+                    pending.append((unit, chunks))
+
+                    if len(pending) > self.workers * 2:
+                        yield from _drain(*pending.popleft())
+
+                while pending:
+                    yield from _drain(*pending.popleft())
+            finally:
+                # Stops the workers if the export is interrupted
+                closed.set()
+
+    def __units(
+        self, after: list[int] | None, position: list | None
+    ) -> Iterator[_Unit]:
+        """
+        Stream every thread and bot with completions that match the filters, ordered by their key.
+        """
+        stmt = (
+            select(Thread.id, Bot.id)
+            .select_from(Completion)
+            .join(Message, Completion.reply_to == Message.id)
+            .join(Thread, Message.thread == Thread.id)
+            .join(Bot, Completion.bot == Bot.id)
+            .where(Completion.score >= self.min_score)
+            .group_by(Thread.id, Bot.id)
+            .order_by(Thread.id, Bot.id)
+        )
+
+        if self.since is not None:
+            stmt = stmt.where(Message.time >= self.since)
+        if self.until is not None:
+            stmt = stmt.where(Message.time < self.until)
+        if self.bot is not None:
+            stmt = stmt.where(Bot.username == self.bot)
+        if self.platform is not None:
+            stmt = stmt.where(Thread.platform == self.platform)
+        if after is not None:
+            thread_id, bot_id = after
+            stmt = stmt.where(
+                or_(
+                    Thread.id > thread_id,
+                    and_(
+                        Thread.id == thread_id,
+                        # A unit that was partly exported is resumed
+                        Bot.id > bot_id if position is None else Bot.id >= bot_id,
+                    ),
+                )
+            )
+
+        with Session() as session:
+            for row in session.execute(
+                stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)
+            ):
+                yield _Unit(*row, after=position if list(row) == after else None)
+
+    def __produce(
+        self, unit: _Unit, chunks: queue.Queue, closed: threading.Event
+    ) -> None:
+        """
+        Put the examples of a unit on "chunks" in chunks, followed by None. Exceptions are put on it instead.
+        """
+        if closed.is_set():
+            return
+
+        try:
+            examples: list[dict] = []
+
+            for position, example in self.__unit_examples(unit):
+                examples.append(example)
+
+                if len(examples) == EXPORT_CHUNK_SIZE:
+                    if not _put(chunks, (examples, position), closed):
+                        return
+                    examples = []
+
+            _put(chunks, (examples, None), closed)
+        except BaseException as e:
+            _put(chunks, e, closed)
+
+    def __unit_examples(self, unit: _Unit) -> Iterator[tuple[list, dict]]:
+        """
+        Build the examples of one unit by streaming its thread in chronological order.
+
+        Yields the position of each example with it, the time and ID of the message it replies to and its own ID.
+        """
+        # The recent context as (role, content) pairs
+        history: deque[tuple[str, str]] = deque(maxlen=MAX_CONTEXT_MESSAGES)
+
+        resume = None
+        if unit.after is not None:
+            resume = (datetime.datetime.fromisoformat(unit.after[0]), *unit.after[1:])
+
+        with Session() as session:
+            stmt = (
+                select(
+                    Message.id,
+                    Message.message,
+                    Message.time,
+                    Completion.id,
+                    Completion.message,
+                    Completion.score,
+                )
+                .outerjoin(
+                    Completion,
+                    and_(
+                        Completion.reply_to == Message.id,
+                        Completion.bot == unit.bot_id,
+                    ),
+                )
+                .where(Message.thread == unit.thread_id)
+                .order_by(Message.time, Message.id, Completion.id)
+            )
+
+            if (first := resume[0] if resume else self.since) is not None:
+                # Only the messages that can be in the context of the first example are needed
+                start = session.scalar(
+                    select(Message.time)
+                    .where(Message.thread == unit.thread_id)
+                    .where(Message.time < first)
+                    .order_by(desc(Message.time))
+                    .offset(MAX_CONTEXT_MESSAGES - 1)
+                    .limit(1)
+                )
+                if start is not None:
+                    stmt = stmt.where(Message.time >= start)
+
+            if self.until is not None:
+                stmt = stmt.where(Message.time < self.until)
+
+            last_id = None
+            replied = False
+
+            for (
+                msg_id,
+                message,
+                time,
+                completion_id,
+                completion,
+                score,
+            ) in session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+                # A message has a row for each of the bot's completions to it, the earliest is kept in the context
+                if msg_id != last_id:
+                    last_id = msg_id
+                    history.append(("user", message))
+                    replied = False
+
+                if completion is None:
+                    continue
+
+                if (
+                    score >= self.min_score
+                    and (self.since is None or time >= self.since)
+                    and (resume is None or (time, msg_id, completion_id) > resume)
+                ):
+                    yield [time.isoformat(), msg_id, completion_id], self.__example(
+                        history, completion
+                    )
+
+                if not replied:
+                    history.append(("assistant", completion))
+                    replied = True
+
+    def __example(self, history: deque[tuple[str, str]], completion: str) -> dict:
+        """
+        Format a training example, keeping the newest context that fits in the prompt.
+        """
+        # The example's own completion is never in "history" yet, as it is only added after the example
+        context = list(history)
+        start = self.budget.fit(self.system, [content for _, content in context])
+
+        return {
+            "messages": [{"role": "system", "content": text} for text in self.system]
+            + [{"role": role, "content": content} for role, content in context[start:]]
+            + [{"role": "assistant", "content": completion}]
+        }
+
+
+def _put(chunks: queue.Queue, item, closed: threading.Event) -> bool:
+    """
+    Put an item on a bounded queue once there is room, returns False if the export is closed first.
+    """
+    while not closed.is_set():
+        try:
+            chunks.put(item, timeout=_PUT_POLL)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _drain(
+    unit: _Unit, chunks: queue.Queue
+) -> Iterator[tuple[_Unit, list[dict], list | None]]:
+    """
+    Yield the chunks of a unit as its worker produces them, re-raising the worker's exception.
+    """
+    while True:
+        item = chunks.get()
+
+        if isinstance(item, BaseException):
+            raise item
+
+        examples, position = item
+        yield unit, examples, position
+
+        if position is None:
+            return
+
+
+def _read_checkpoint(path: str | None) -> dict | None:
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path: str, state: dict) -> None:
+    # Replace the checkpoint atomically, so an interrupted write can't corrupt it
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+
+    os.replace(f"{path}.tmp", path)
+
+
+def _datetime(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m edubot.export",
+        description="Export positively scored completions as a chat-format JSONL fine-tuning dataset.",
+    )
+    parser.add_argument("path", help="The JSONL file to write.")
+    parser.add_argument("--bot", help="Only export completions of this bot username.")
+    parser.add_argument("--platform", help="Only export threads on this platform.")
+    parser.add_argument(
+        "--min-score",
+        type=int,
+        default=1,
+        help="Only export completions scored at least this highly.",
+    )
+    parser.add_argument(
+        "--since",
+        type=_datetime,
+        help="Only export replies to messages sent at or after this ISO 8601 time (UTC).",
+    )
+    parser.add_argument(
+        "--until",
+        type=_datetime,
+        help="Only export replies to messages sent before this ISO 8601 time (UTC).",
+    )
+    parser.add_argument(
+        "--system",
+        action="append",
+        help="A system message to start every example with, can be repeated.",
+    )
+    parser.add_argument(
+        "--max-tokens", type=int, help="The token budget of each example's prompt."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Threads exported in parallel."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Save progress to this file, an interrupted export is resumed from it.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    create_schema()
+
+    exporter = DatasetExporter(
+        bot=args.bot,
+        platform=args.platform,
+        min_score=args.min_score,
+        since=args.since,
+        until=args.until,
+        system=args.system,
+        max_tokens=args.max_tokens,
+        workers=args.workers,
+    )
+    written = exporter.export(args.path, args.checkpoint)
+
+    logger.info(f"Exported {written} examples to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Buffers feedback score changes in memory, so a burst of reactions is written with one batched UPDATE.
+"""
+import atexit
+import logging
+import threading
+
+from edubot import FEEDBACK_FLUSH_INTERVAL, FEEDBACK_FLUSH_THRESHOLD, queries
+from edubot.sql import Session
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackBuffer:
+    """
+    Coalesces score changes per completion, writing them from a background thread on an interval or threshold.
+    """
+
+    def __init__(self, flush_interval: float, flush_threshold: int):
+        """
+        :param flush_interval: Seconds between writes of the buffered changes.
+        :param flush_threshold: The number of completions with buffered changes that causes an early write.
+        """
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+        # The buffered change to the score of each completion, keyed by the ID of its bot and its ID
+        self.__pending: dict[tuple[int, int], int] = {}
+        self.__lock = threading.Lock()
+
+        # Set to write the buffered changes before the interval is up
+        self.__wake = threading.Event()
+        # This is lazy loaded
+        self.__thread: threading.Thread | None = None
+
+    def add(self, bot_id: int, completion_id: int, offset: int) -> None:
+        """
+        Buffer a change to the score of a completion sent by a bot, this never waits for the database.
+        """
+        key = (bot_id, completion_id)
+
+        with self.__lock:
+            self.__pending[key] = self.__pending.get(key, 0) + offset
+            pending = len(self.__pending)
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="edubot-feedback", daemon=True
+                )
+                self.__thread.start()
+                # Don't lose feedback buffered when the process exits
+                atexit.register(self.flush)
+
+        if pending >= self.flush_threshold:
+            self.__wake.set()
+
+    def flush(self) -> None:
+        """
+        Write every buffered change now.
+        """
+        with self.__lock:
+            deltas = {key: delta for key, delta in self.__pending.items() if delta}
+            self.__pending = {}
+
+        if not deltas:
+            return
+
+        try:
+            with Session() as session:
+                queries.add_scores(session, deltas)
+                session.commit()
+        except Exception:
+            logger.exception("Writing feedback failed, it will be retried.")
+
+            # Merge the changes back so the next flush retries them
+            with self.__lock:
+                for key, delta in deltas.items():
+                    self.__pending[key] = self.__pending.get(key, 0) + delta
+            return
+
+        logger.info(f"Feedback written for {len(deltas)} completions.")
+
+    def __run(self) -> None:
+        while True:
+            self.__wake.wait(self.flush_interval)
+            self.__wake.clear()
+            self.flush()
+
+
+# This is lazy loaded
+_buffer: FeedbackBuffer | None = None
+_buffer_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """
+    Returns whether score changes are buffered, see FEEDBACK_FLUSH_INTERVAL.
+    """
+    return FEEDBACK_FLUSH_INTERVAL > 0
+
+
+def add(bot_id: int, completion_id: int, offset: int) -> None:
+    """
+    Buffer a change to the score of a completion sent by a bot in the process wide buffer.
+    """
+    global _buffer
+
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = FeedbackBuffer(
+                    FEEDBACK_FLUSH_INTERVAL, FEEDBACK_FLUSH_THRESHOLD
+                )
+
+    _buffer.add(bot_id, completion_id, offset)
+
+
+def flush() -> None:
+    """
+    Write the process wide buffer now, E.g. before shutting down.
+    """
+    if _buffer is not None:
+        _buffer.flush()
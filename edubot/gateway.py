@@ -0,0 +1,309 @@
+"""
+The gateway every OpenAI request goes through, keeping throughput at the provider's limits instead of collapsing under
+ load.
+
+Requests wait for room in token buckets limiting requests and tokens per minute, then for a free slot in a bounded
+ pool of concurrent requests. Rate limits and transient errors are retried with jittered exponential backoff, and
+ identical requests already in flight are sent once, every caller receiving the same response.
+
+Waiting and retrying stop at the deadline of the call in progress, see edubot.deadlines.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+from edubot import (
+    LLM_CONCURRENCY,
+    LLM_MAX_RETRIES,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    deadlines,
+)
+from edubot.concurrency import SingleFlight
+from edubot.deadlines import DeadlineExceeded, Hedger
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The first retry waits up to this many seconds, doubling for each retry after it
+BACKOFF_BASE = 1.0
+# The longest a retry waits, unless OpenAI asks for longer
+BACKOFF_MAX = 60.0
+
+
+def request_key(*parts) -> str:
+    """
+    Returns a key identifying a request from everything sent in it, identical requests have the same key.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _retryable_errors() -> tuple[type[Exception], ...]:
+    import openai.error
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        # Covers 5xx responses, 4xx responses have their own error types
+        openai.error.APIError,
+    )
+
+
+class TokenBucket:
+    """
+    Limits how much of something is used per minute, allowing bursts up to a minute's worth.
+    """
+
+    def __init__(self, per_minute: int):
+        """
+        :param per_minute: The amount that can be used per minute, 0 is unlimited.
+        """
+        self.per_minute = per_minute
+        self.__level = float(per_minute)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """
+        Take "amount" from the bucket, even if it is not there yet.
+
+        Reservations are queued in the order they are made, so a large request can't be starved by small ones.
+
+        :returns: The seconds to wait before the amount can be used.
+        """
+        if not self.per_minute:
+            return 0.0
+
+        with self.__lock:
+            now = time.monotonic()
+            self.__level = min(
+                self.per_minute,
+                self.__level + (now - self.__updated) * self.per_minute / 60,
+            )
+            self.__updated = now
+
+            # A request larger than the bucket waits for a full bucket instead of forever
+            self.__level -= min(amount, self.per_minute)
+
+            return max(-self.__level * 60 / self.per_minute, 0.0)
+
+
+class _LoopState:
+    """
+    The asyncio primitives of the gateway for one event loop, they can't be shared between loops.
+    """
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight: dict[str, asyncio.Future] = {}
+
+
+class LLMGateway:
+    """
+    Applies rate limits, concurrency limits, retries and coalescing to requests, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+        concurrency: int = LLM_CONCURRENCY,
+        max_retries: int = LLM_MAX_RETRIES,
+    ):
+        """
+        :param requests_per_minute: The maximum requests sent per minute, 0 is unlimited.
+        :param tokens_per_minute: The maximum tokens sent per minute, 0 is unlimited.
+        :param concurrency: The maximum requests in flight at once.
+        :param max_retries: The number of times a failed request is retried.
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+        self.__semaphore = threading.BoundedSemaphore(concurrency)
+        self.__in_flight = SingleFlight()
+        self.__loops: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, _LoopState
+        ] = weakref.WeakKeyDictionary()
+
+    def __reserve(self, tokens: int) -> float:
+        """
+        Returns the seconds to wait for the rate limits, failing early if the wait would pass the deadline.
+        """
+        delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+        if (left := deadlines.remaining()) is not None and delay >= left:
+            raise DeadlineExceeded("The rate limit wait would pass the deadline")
+
+        return delay
+
+    @contextmanager
+    def limit(self, tokens: int) -> Iterator[None]:
+        """
+        Wait for the rate and concurrency limits before sending a request that can't be retried, E.g. a stream.
+
+        :param tokens: An estimate of the tokens the request uses, including the completion.
+        """
+        time.sleep(self.__reserve(tokens))
+
+        if not self.__semaphore.acquire(timeout=deadlines.remaining()):
+            raise DeadlineExceeded("No request slot was free before the deadline")
+
+        try:
+            yield
+        finally:
+            self.__semaphore.release()
+
+    @asynccontextmanager
+    async def alimit(self, tokens: int) -> AsyncIterator[None]:
+        """
+        Async version of limit(), the concurrency limit applies to each event loop separately.
+        """
+        await asyncio.sleep(self.__reserve(tokens))
+
+        async with self.__loop_state().semaphore:
+            yield
+
+    def call(
+        self,
+        request: Callable[[], T],
+        key: str,
+        tokens: int,
+        hedger: Hedger | None = None,
+    ) -> T:
+        """
+        Send a request through the gateway.
+
+        :param request: Sends the request, it is called again for each retry.
+        :param key: Identifies the request, see request_key(). Callers with the same key share one request.
+        :param tokens: An estimate of the tokens the request uses, including the completion.
+        :param hedger: Hedges each attempt of the request, see edubot.deadlines.Hedger.
+        :returns: The response, which may be shared with other callers.
+        """
+        return self.__in_flight.call(key, lambda: self.__send(request, tokens, hedger))
+
+    async def acall(
+        self,
+        request: Callable[[], Awaitable[T]],
+        key: str,
+        tokens: int,
+        hedger: Hedger | None = None,
+    ) -> T:
+        """
+        Async version of call(), "request" returns a new awaitable each time it is called.
+        """
+        state = self.__loop_state()
+
+        if (future := state.in_flight.get(key)) is not None:
+            logger.debug(f"Waiting for the identical request {key[:8]} in flight")
+            # Shielded, so a cancelled follower doesn't cancel the request for everyone else
+            return await deadlines.wait_for(asyncio.shield(future))
+
+        future = state.in_flight[key] = asyncio.get_running_loop().create_future()
+
+        try:
+            result = await self.__asend(request, tokens, hedger)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # The exception is raised here, followers retrieving it is optional
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del state.in_flight[key]
+
+    def __send(self, request: Callable[[], T], tokens: int, hedger: Hedger | None) -> T:
+        def attempt() -> T:
+            with self.limit(tokens):
+                return request()
+
+        for retry in range(self.max_retries + 1):
+            try:
+                return hedger.call(attempt) if hedger else deadlines.call(attempt)
+            except _retryable_errors() as e:
+                if retry == self.max_retries:
+                    raise
+
+                delay = self.__backoff(retry, e)
+
+            time.sleep(delay)
+
+    async def __asend(
+        self, request: Callable[[], Awaitable[T]], tokens: int, hedger: Hedger | None
+    ) -> T:
+        async def attempt() -> T:
+            async with self.alimit(tokens):
+                return await request()
+
+        for retry in range(self.max_retries + 1):
+            try:
+                if hedger:
+                    return await hedger.acall(attempt)
+                return await deadlines.wait_for(attempt())
+            except _retryable_errors() as e:
+                if retry == self.max_retries:
+                    raise
+
+                delay = self.__backoff(retry, e)
+
+            await asyncio.sleep(delay)
+
+    def __backoff(self, attempt: int, error: Exception) -> float:
+        """
+        Returns the seconds to wait before retrying, jittered so clients that failed together don't retry together.
+        """
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+        # OpenAI says how long to wait when rate limiting
+        headers = getattr(error, "headers", None) or {}
+        try:
+            delay = max(delay, float(headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+
+        if (left := deadlines.remaining()) is not None and delay >= left:
+            raise DeadlineExceeded("Retrying would pass the deadline") from error
+
+        logger.warning(
+            f"OpenAI request failed ({error}), retry {attempt + 1} of {self.max_retries} in {delay:.1f}s"
+        )
+
+        return delay
+
+    def __loop_state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+
+        if (state := self.__loops.get(loop)) is None:
+            state = self.__loops[loop] = _LoopState(self.concurrency)
+
+        return state
+
+
+@lru_cache(maxsize=None)
+def get_gateway() -> LLMGateway:
+    """
+    Returns the gateway shared by every bot in this process.
+    """
+    return LLMGateway()
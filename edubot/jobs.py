@@ -0,0 +1,498 @@
+"""
+A queue of EduBot calls stored in the database and run by worker processes, so slow calls don't block integrations
+ and the work can be spread over several machines.
+
+Integrations submit calls and get a future of each result, E.g.
+    future = jobs.submit(bot, "generate_image", prompt, msg, thread_name, priority=1)
+    future.add_done_callback(lambda done: post_image(done.result()))
+
+Workers are started with:
+    python -m edubot.jobs --processes 4
+
+Jobs with a higher priority run first, except that the jobs of a thread run one at a time in the order they were
+ submitted. Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL, SQLite runs the claiming UPDATE
+ under its write lock instead. A job whose worker died is run again once JOB_TIMEOUT has passed.
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import inspect
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Any
+
+from sqlalchemy import and_, delete, desc, exists, or_, select, update
+from sqlalchemy.orm import aliased
+
+from edubot import (
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_INTERVAL,
+    JOB_RESULT_TTL,
+    JOB_TIMEOUT,
+    JOB_WORKERS,
+)
+from edubot.bot import BaseEduBot, EduBot
+from edubot.sql import Job, Session, create_schema
+from edubot.types import CompletionText
+
+logger = logging.getLogger(__name__)
+
+# The EduBot methods that can be run as jobs
+JOB_KINDS = frozenset(
+    ("gpt_answer", "summarise_url", "save_image_to_context", "generate_image")
+)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# The maximum number of jobs whose results are fetched by one query
+_WATCH_BATCH_SIZE = 500
+
+
+class JobFailed(RuntimeError):
+    """
+    Raised by the future of a job that failed on every attempt, or was cancelled.
+    """
+
+
+class JobFuture(Future):
+    """
+    The result of a job, set once a worker has run it.
+    """
+
+    def __init__(self, job_id: int):
+        super().__init__()
+        self.job_id = job_id
+
+    def cancel(self) -> bool:
+        """
+        Cancel the job if no worker has started it yet.
+        """
+        with Session() as session:
+            cancelled = session.execute(
+                update(Job)
+                .where(Job.id == self.job_id)
+                .where(Job.status == PENDING)
+                .values(status=FAILED, error="Cancelled", finished=datetime.utcnow())
+            ).rowcount
+            session.commit()
+
+        return bool(cancelled) and super().cancel()
+
+
+def _encode(value: Any) -> Any:
+    """
+    Convert the arguments and results of jobs to JSON compatible values.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, CompletionText):
+        return {"__completion__": str(value), "id": value.id}
+    if isinstance(value, str):
+        return value
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+
+    from PIL import Image
+
+    if isinstance(value, Image.Image):
+        buffer = io.BytesIO()
+        value.save(buffer, format="PNG")
+        return {"__image__": base64.b64encode(buffer.getvalue()).decode()}
+
+    raise TypeError(f"Jobs can't pass {type(value).__name__} values")
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    if "__completion__" in value:
+        return CompletionText(value["__completion__"], value["id"])
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    if "__image__" in value:
+        from PIL import Image
+
+        return Image.open(io.BytesIO(base64.b64decode(value["__image__"])))
+
+    return {key: _decode(item) for key, item in value.items()}
+
+
+class _Watcher:
+    """
+    Polls the database for the results of the jobs this process is waiting on, setting their futures.
+    """
+
+    def __init__(self):
+        self.__futures: dict[int, JobFuture] = {}
+        self.__lock = threading.Lock()
+        # This is lazy loaded
+        self.__thread: threading.Thread | None = None
+
+    def watch(self, future: JobFuture) -> None:
+        with self.__lock:
+            self.__futures[future.job_id] = future
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="edubot-jobs", daemon=True
+                )
+                self.__thread.start()
+
+    def __run(self) -> None:
+        while True:
+            time.sleep(JOB_POLL_INTERVAL)
+
+            with self.__lock:
+                # Forget jobs cancelled by this process
+                for job_id in [
+                    job_id
+                    for job_id, future in self.__futures.items()
+                    if future.cancelled()
+                ]:
+                    del self.__futures[job_id]
+
+                waiting = list(self.__futures)
+
+            try:
+                for start in range(0, len(waiting), _WATCH_BATCH_SIZE):
+                    self.__collect(waiting[start : start + _WATCH_BATCH_SIZE])
+            except Exception:
+                logger.exception("Checking for finished jobs failed, it is retried.")
+
+    def __collect(self, job_ids: list[int]) -> None:
+        with Session() as session:
+            finished = session.execute(
+                select(Job.id, Job.status, Job.result, Job.error)
+                .where(Job.id.in_(job_ids))
+                .where(Job.status.in_((DONE, FAILED)))
+            ).all()
+
+        for job_id, status, result, error in finished:
+            with self.__lock:
+                future = self.__futures.pop(job_id)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if status == DONE:
+                future.set_result(_decode(json.loads(result)))
+            else:
+                future.set_exception(JobFailed(error))
+
+
+_watcher = _Watcher()
+
+
+def submit(bot: BaseEduBot, kind: str, *args, priority: int = 0, **kwargs) -> JobFuture:
+    """
+    Queue a call of an EduBot method to be run by a worker.
+
+    :param bot: The bot the call is made by, workers create an EduBot with the same username, platform and personality.
+    :param kind: The name of the method, one of JOB_KINDS.
+    :param args: The arguments of the method.
+    :param priority: Jobs with a higher priority are run first, after the earlier jobs of the same thread.
+    :param kwargs: The keyword arguments of the method.
+    :returns: A future of the value returned by the method.
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"{kind} can't be run as a job")
+
+    # Fails early if the arguments don't fit the method
+    arguments = inspect.signature(getattr(EduBot, kind)).bind(None, *args, **kwargs)
+
+    payload = {
+        "bot": {
+            "username": bot.username,
+            "platform": bot.platform,
+            "personality": bot.personality,
+        },
+        "args": _encode(list(args)),
+        "kwargs": _encode(kwargs),
+    }
+
+    create_schema()
+
+    with Session() as session:
+        job = Job(
+            kind=kind,
+            platform=bot.platform,
+            thread_name=arguments.arguments["thread_name"],
+            priority=priority,
+            status=PENDING,
+            payload=json.dumps(payload, ensure_ascii=False),
+        )
+        session.add(job)
+        session.commit()
+
+        return get(job.id)
+
+
+def get(job_id: int) -> JobFuture:
+    """
+    Returns a future of the result of a job, E.g. one submitted before the integration restarted.
+    """
+    future = JobFuture(job_id)
+    _watcher.watch(future)
+
+    return future
+
+
+class Worker:
+    """
+    Runs jobs one at a time until it is stopped.
+    """
+
+    def __init__(self, poll_interval: float = JOB_POLL_INTERVAL):
+        """
+        :param poll_interval: Seconds to wait before checking for jobs again when there are none.
+        """
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+        # Bots are reused between jobs, keyed by username, platform and personality
+        self.__bots: dict[tuple, EduBot] = {}
+        self.__stop = threading.Event()
+
+    def stop(self) -> None:
+        """
+        Stop once the job in progress is finished.
+        """
+        self.__stop.set()
+
+    def run(self) -> None:
+        logger.info(f"Worker {self.name} started")
+
+        while not self.__stop.is_set():
+            if not self.run_one():
+                self.__expire()
+                self.__stop.wait(self.poll_interval)
+
+        logger.info(f"Worker {self.name} stopped")
+
+    def run_one(self) -> bool:
+        """
+        Claim and run the next job.
+
+        :returns: False if there were no jobs that could be run.
+        """
+        with Session() as session:
+            job_id = self.__claim(session)
+            if job_id is None:
+                return False
+
+            job = session.get(Job, job_id)
+            kind, payload = job.kind, json.loads(job.payload)
+            session.commit()
+
+        logger.debug(f"Running job {job_id} ({kind})")
+
+        try:
+            bot = self.__bot(**payload["bot"])
+            value = getattr(bot, kind)(
+                *_decode(payload["args"]), **_decode(payload["kwargs"])
+            )
+            self.__finish(
+                job_id,
+                status=DONE,
+                result=json.dumps(_encode(value)),
+                finished=datetime.utcnow(),
+            )
+        except Exception as e:
+            logger.exception(f"Job {job_id} ({kind}) failed.")
+            self.__fail(job_id, f"{type(e).__name__}: {e}")
+
+        return True
+
+    def __bot(self, username: str, platform: str, personality: list[str]) -> EduBot:
+        key = (username, platform, tuple(personality))
+
+        if key not in self.__bots:
+            self.__bots[key] = EduBot(username, platform, personality)
+
+        return self.__bots[key]
+
+    def __claim(self, session) -> int | None:
+        """
+        Mark the next job that can be run as running by this worker.
+
+        The next job has the highest priority of the pending jobs whose thread has no earlier pending or running job.
+        """
+        candidate = aliased(Job)
+        earlier = aliased(Job)
+
+        claimable = (
+            select(candidate.id)
+            .where(candidate.status == PENDING)
+            .where(
+                ~exists()
+                .where(earlier.platform == candidate.platform)
+                .where(earlier.thread_name == candidate.thread_name)
+                .where(earlier.id < candidate.id)
+                .where(earlier.status.in_((PENDING, RUNNING)))
+            )
+            .order_by(desc(candidate.priority), candidate.id)
+            .limit(1)
+            # Other workers skip the job while it is being claimed, instead of waiting for it
+            .with_for_update(skip_locked=True, of=candidate)
+        )
+
+        claim = update(Job).where(Job.status == PENDING)
+        claim_values = {
+            "status": RUNNING,
+            "worker": self.name,
+            "started": datetime.utcnow(),
+            "attempts": Job.attempts + 1,
+        }
+
+        if session.get_bind().dialect.update_returning:
+            # One statement, so SQLite's write lock covers finding the job and claiming it
+            return session.scalar(
+                claim.where(Job.id == claimable.scalar_subquery())
+                .values(**claim_values)
+                .returning(Job.id)
+            )
+
+        if (job_id := session.scalar(claimable)) is None:
+            return None
+
+        claimed = session.execute(
+            claim.where(Job.id == job_id).values(**claim_values)
+        ).rowcount
+
+        return job_id if claimed else None
+
+    def __finish(self, job_id: int, **values) -> None:
+        with Session() as session:
+            # A job that timed out may have been given to another worker
+            session.execute(
+                update(Job)
+                .where(Job.id == job_id)
+                .where(Job.worker == self.name)
+                .where(Job.status == RUNNING)
+                .values(**values)
+            )
+            session.commit()
+
+    def __fail(self, job_id: int, error: str) -> None:
+        with Session() as session:
+            attempts = session.scalar(select(Job.attempts).where(Job.id == job_id))
+
+        if attempts < JOB_MAX_ATTEMPTS:
+            # Retried in its place in the thread's order
+            self.__finish(job_id, status=PENDING, error=error)
+        else:
+            self.__finish(
+                job_id, status=FAILED, error=error, finished=datetime.utcnow()
+            )
+
+    def __expire(self) -> None:
+        """
+        Return jobs whose worker died to the queue, and delete the results of jobs finished long ago.
+        """
+        now = datetime.utcnow()
+
+        with Session() as session:
+            timed_out = and_(
+                Job.status == RUNNING,
+                Job.started < now - timedelta(seconds=JOB_TIMEOUT),
+            )
+
+            session.execute(
+                update(Job)
+                .where(timed_out)
+                .where(Job.attempts >= JOB_MAX_ATTEMPTS)
+                .values(status=FAILED, error="Timed out", finished=now)
+            )
+            session.execute(update(Job).where(timed_out).values(status=PENDING))
+
+            session.execute(
+                delete(Job)
+                .where(or_(Job.status == DONE, Job.status == FAILED))
+                .where(Job.finished < now - timedelta(hours=JOB_RESULT_TTL))
+            )
+            session.commit()
+
+
+def _run_worker(poll_interval: float) -> None:
+    """
+    The entry point of worker processes.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    worker = Worker(poll_interval)
+
+    # Finish the job in progress before exiting
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+
+    worker.run()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m edubot.jobs",
+        description="Run worker processes that run queued EduBot jobs.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=JOB_WORKERS,
+        help="Worker processes to run. Defaults to job_workers in the config.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=JOB_POLL_INTERVAL,
+        help="Seconds idle workers wait before checking for jobs again.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    create_schema()
+
+    # Spawned processes don't inherit the parent's database connections
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=_run_worker, args=(args.poll_interval,), name=f"edubot-worker-{i}"
+        )
+        for i in range(args.processes)
+    ]
+
+    for process in processes:
+        process.start()
+
+    def stop(*_) -> None:
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Timing, SQL statement and token usage measurements of EduBot calls.
+
+Nothing is measured until a sink is added, E.g.
+    metrics.add_sink(lambda call: print(call.operation, call.duration, call.stages))
+    metrics.add_sink(metrics.PrometheusExporter())
+"""
+import functools
+import inspect
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class CallMetrics:
+    """
+    The measurements of one call to an EduBot method, passed to every sink when the call finishes.
+    """
+
+    def __init__(self, operation: str):
+        # The name of the method, E.g. 'gpt_answer'
+        self.operation = operation
+        # Seconds the whole call took
+        self.duration = 0.0
+        # Seconds spent in each stage of the call, E.g. 'db' 'llm' 'tokenize'
+        self.stages: dict[str, float] = {}
+        # The number of SQL statements executed
+        self.queries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # The number of messages in the chat context sent to the LLM
+        self.context_messages = 0
+
+        # Stages can be timed, and statements counted, from worker threads
+        self.__lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self.__lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_tokens(self, prompt: int = 0, completion: int = 0) -> None:
+        with self.__lock:
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+
+    def add_query(self) -> None:
+        with self.__lock:
+            self.queries += 1
+
+
+# Called with the CallMetrics of every finished call
+_sinks: list[Callable[[CallMetrics], None]] = []
+
+# The measurements of the call in progress
+_current: ContextVar[CallMetrics | None] = ContextVar("edubot_metrics", default=None)
+
+_DISABLED = nullcontext()
+
+
+def add_sink(sink: Callable[[CallMetrics], None]) -> None:
+    """
+    Start passing the measurements of every call to "sink".
+    """
+    _sinks.append(sink)
+
+
+def remove_sink(sink: Callable[[CallMetrics], None]) -> None:
+    _sinks.remove(sink)
+
+
+def current() -> CallMetrics | None:
+    """
+    Returns the measurements of the call in progress, None if there isn't one or no sinks have been added.
+    """
+    return _current.get()
+
+
+def operation(name: str):
+    """
+    Measure an EduBot call, calls made inside another call are measured as part of it.
+    """
+    if not _sinks or _current.get() is not None:
+        return _DISABLED
+
+    return _measure(name)
+
+
+@contextmanager
+def _measure(name: str) -> Iterator[CallMetrics]:
+    call = CallMetrics(name)
+    token = _current.set(call)
+    start = time.perf_counter()
+
+    try:
+        yield call
+    finally:
+        call.duration = time.perf_counter() - start
+        _current.reset(token)
+
+        for sink in list(_sinks):
+            # A broken sink mustn't break the bot
+            try:
+                sink(call)
+            except Exception:
+                logger.exception(f"Metrics sink {sink!r} failed.")
+
+
+def measured(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator measuring every call to a function or coroutine function as operation "name".
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with operation(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with operation(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def stage(name: str):
+    """
+    Time a stage of the call in progress, stages with the same name are added together.
+    """
+    if _current.get() is None:
+        return _DISABLED
+
+    return _time_stage(name)
+
+
+@contextmanager
+def _time_stage(name: str) -> Iterator[None]:
+    call = _current.get()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        call.add_stage(name, time.perf_counter() - start)
+
+
+def bind(fn: Callable) -> Callable:
+    """
+    Wrap a function that is run in a worker thread so it runs in the caller's context.
+
+    Its measurements are added to the call in progress, and it keeps the call's deadline.
+    """
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def count_query(*args) -> None:
+    """
+    SQLAlchemy 'before_cursor_execute' listener counting the statements of the call in progress.
+    """
+    if (call := _current.get()) is not None:
+        call.add_query()
+
+
+class PrometheusExporter:
+    """
+    A sink that totals measurements, rendering them in the Prometheus text format for a /metrics endpoint.
+    """
+
+    def __init__(self, prefix: str = "edubot"):
+        self.prefix = prefix
+        self.__lock = threading.Lock()
+        # Keyed by metric name, then by label values
+        self.__counters: dict[str, dict[tuple, float]] = {}
+
+    def __add(self, name: str, labels: tuple, value: float) -> None:
+        series = self.__counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def __call__(self, call: CallMetrics) -> None:
+        with self.__lock:
+            operation = (("operation", call.operation),)
+            self.__add("calls_total", operation, 1)
+            self.__add("call_seconds_total", operation, call.duration)
+            self.__add("sql_queries_total", operation, call.queries)
+            self.__add("context_messages_total", operation, call.context_messages)
+
+            for kind, tokens in (
+                ("prompt", call.prompt_tokens),
+                ("completion", call.completion_tokens),
+            ):
+                self.__add("tokens_total", operation + (("kind", kind),), tokens)
+
+            for stage_name, seconds in call.stages.items():
+                self.__add(
+                    "stage_seconds_total", operation + (("stage", stage_name),), seconds
+                )
+
+    def render(self) -> str:
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+        lines = []
+
+        with self.__lock:
+            for name, series in sorted(self.__counters.items()):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for labels, value in sorted(series.items()):
+                    label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f"{self.prefix}_{name}{{{label_text}}} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+class StatsdExporter:
+    """
+    A sink that sends measurements to a StatsD server over UDP, timings are in milliseconds.
+    """
+
+    def __init__(
+        self, host: str = "localhost", port: int = 8125, prefix: str = "edubot"
+    ):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.setblocking(False)
+
+    def __call__(self, call: CallMetrics) -> None:
+        name = f"{self.prefix}.{call.operation}"
+
+        lines = [
+            f"{name}.duration:{call.duration * 1000:.3f}|ms",
+            f"{name}.sql_queries:{call.queries}|c",
+            f"{name}.prompt_tokens:{call.prompt_tokens}|c",
+            f"{name}.completion_tokens:{call.completion_tokens}|c",
+            f"{name}.context_messages:{call.context_messages}|g",
+        ]
+        lines += [
+            f"{name}.stage.{stage_name}:{seconds * 1000:.3f}|ms"
+            for stage_name, seconds in call.stages.items()
+        ]
+
+        # Metrics are best effort, a full buffer or missing server drops them
+        try:
+            self.__socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError as e:
+            logger.debug(f"Couldn't send metrics to StatsD: {e}")
@@ -0,0 +1,238 @@
+"""
+Set-based database queries that run inside an existing session.
+
+These resolve whole contexts with a constant number of statements instead of one query per message.
+"""
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from edubot.sql import Bot, Completion, Message, Thread, message_fingerprint
+from edubot.types import MessageInfo
+
+
+def fingerprint(thread_id: int, msg: MessageInfo) -> str:
+    """
+    Returns the fingerprint "msg" has, or would have, when stored in a thread.
+    """
+    return message_fingerprint(thread_id, msg["username"], msg["time"], msg["message"])
+
+
+def get_or_create_thread(session: Session, platform: str, thread_name: str) -> Thread:
+    """
+    Get a thread by name, inserting it if it doesn't exist yet.
+    """
+    thread = session.scalars(
+        select(Thread)
+        .where(Thread.platform == platform)
+        .where(Thread.thread_name == thread_name)
+    ).first()
+
+    if thread is not None:
+        return thread
+
+    # Another process may be creating the same thread, only one insert takes effect
+    stmt = _dialect_insert(session, Thread)
+
+    if stmt is None:
+        try:
+            with session.begin_nested():
+                session.add(Thread(platform=platform, thread_name=thread_name))
+        except IntegrityError:
+            pass
+    else:
+        session.execute(
+            stmt.values(
+                platform=platform, thread_name=thread_name
+            ).on_conflict_do_nothing(index_elements=["thread_name", "platform"])
+        )
+
+    return session.scalars(
+        select(Thread)
+        .where(Thread.platform == platform)
+        .where(Thread.thread_name == thread_name)
+    ).one()
+
+
+def touch_thread(session: Session, thread_id: int) -> int | None:
+    """
+    Increment the version of a thread after writing to it.
+
+    :returns: The new version, or None if the database can't return it.
+    """
+    table = Thread.__table__
+    stmt = (
+        update(table).where(table.c.id == thread_id).values(version=table.c.version + 1)
+    )
+
+    if not session.get_bind().dialect.update_returning:
+        session.execute(stmt)
+        return None
+
+    return session.scalar(stmt.returning(table.c.version))
+
+
+def get_message(session: Session, thread_id: int, msg: MessageInfo) -> Message | None:
+    """
+    Get a message in a thread by its fingerprint.
+    """
+    return session.scalars(
+        select(Message).where(Message.fingerprint == fingerprint(thread_id, msg))
+    ).first()
+
+
+def messages_since(session: Session, thread_id: int, since: datetime) -> list[Message]:
+    """
+    Get every message in a thread sent at or after "since" in chronological order.
+    """
+    return list(
+        session.scalars(
+            select(Message)
+            .where(Message.thread == thread_id)
+            .where(Message.time >= since)
+            .order_by(Message.time, Message.id)
+        )
+    )
+
+
+def bot_usernames(session: Session, platform: str, usernames: set[str]) -> set[str]:
+    """
+    Returns the subset of "usernames" that belong to bots on this platform.
+    """
+    if not usernames:
+        return set()
+
+    return set(
+        session.scalars(
+            select(Bot.username)
+            .where(Bot.platform == platform)
+            .where(Bot.username.in_(usernames))
+        )
+    )
+
+
+def completions_since(
+    session: Session, bot_id: int, thread_id: int, since: datetime
+) -> dict[str, str]:
+    """
+    Get the text of a bot's completions to messages sent in a thread at or after "since".
+
+    :return: The earliest completion to each message, keyed by the fingerprint of the message it replies to.
+    """
+    completions: dict[str, str] = {}
+
+    for completion, reply_to in session.execute(
+        select(Completion.message, Message.fingerprint)
+        .join(Message, Completion.reply_to == Message.id)
+        .where(Message.thread == thread_id)
+        .where(Message.time >= since)
+        .where(Completion.bot == bot_id)
+        .order_by(Completion.id)
+    ):
+        completions.setdefault(reply_to, completion)
+
+    return completions
+
+
+def completions_to(
+    session: Session, bot_id: int, message_ids: list[int]
+) -> dict[int, str]:
+    """
+    Get the text of a bot's completions to the given messages.
+
+    :return: The earliest completion to each message, keyed by the ID of the message it replies to.
+    """
+    completions: dict[int, str] = {}
+
+    for completion, reply_to in session.execute(
+        select(Completion.message, Completion.reply_to)
+        .where(Completion.bot == bot_id)
+        .where(Completion.reply_to.in_(message_ids))
+        .order_by(Completion.id)
+    ):
+        completions.setdefault(reply_to, completion)
+
+    return completions
+
+
+def _dialect_insert(session: Session, model):
+    """
+    Returns an insert statement for "model" that supports ON CONFLICT clauses if the database does.
+    """
+    dialect = session.get_bind().dialect.name
+
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    return None
+
+
+def upsert(session: Session, model, row: dict, keys: list[str]) -> None:
+    """
+    Insert a row, or update the existing row with the same unique "keys".
+    """
+    stmt = _dialect_insert(session, model)
+
+    if stmt is None:
+        existing = session.scalars(
+            select(model).filter_by(**{key: row[key] for key in keys})
+        ).first()
+        if existing is None:
+            session.add(model(**row))
+        else:
+            for column, value in row.items():
+                setattr(existing, column, value)
+        session.flush()
+        return
+
+    session.execute(
+        stmt.values(**row).on_conflict_do_update(
+            index_elements=keys,
+            set_={column: value for column, value in row.items() if column not in keys},
+        )
+    )
+
+
+def insert_messages(session: Session, rows: list[dict]) -> None:
+    """
+    Insert message rows with a single statement, skipping rows whose fingerprint already exists.
+    """
+    if not rows:
+        return
+
+    stmt = _dialect_insert(session, Message)
+
+    if stmt is None:
+        stmt = insert(Message)
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+
+    session.execute(stmt, rows)
+
+
+def add_scores(session: Session, deltas: dict[tuple[int, int], int]) -> None:
+    """
+    Add to the scores of several completions with a single batched UPDATE.
+
+    :param deltas: The change to the score of each completion, keyed by the ID of the bot that sent it and its ID.
+     Completions sent by another bot are left unchanged.
+    """
+    if not deltas:
+        return
+
+    table = Completion.__table__
+
+    session.execute(
+        update(table)
+        .where(table.c.id == bindparam("_id"))
+        .where(table.c.bot == bindparam("_bot"))
+        .values(score=table.c.score + bindparam("_delta")),
+        [
+            {"_bot": bot_id, "_id": completion_id, "_delta": delta}
+            for (bot_id, completion_id), delta in deltas.items()
+        ],
+    )
@@ -0,0 +1,423 @@
+"""
+Moves old messages out of the message and completion tables, so the tables EduBot queries stay small.
+
+Run periodically, E.g. from cron:
+    python -m edubot.retention --days 90 --platform matrix 30 --thread matrix '!room:example.org' 365 --compact
+
+Messages older than their thread's policy are archived along with their completions, either to the message_archive
+ and completion_archive tables or to a gzipped JSONL file. Messages with scored completions are kept with the
+ MAX_CONTEXT_MESSAGES messages before them, as they are needed to export fine-tuning datasets. Each batch is archived
+ in its own short transaction.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+from collections import deque
+
+from sqlalchemy import and_, delete, insert, or_, orm, select
+
+from edubot import RETENTION_DAYS, queries
+from edubot.export import MAX_CONTEXT_MESSAGES
+from edubot.sql import (
+    ArchivedCompletion,
+    ArchivedMessage,
+    Completion,
+    Message,
+    Session,
+    Thread,
+    create_schema,
+    engine,
+)
+
+logger = logging.getLogger(__name__)
+
+# The number of messages archived per transaction, smaller batches hold locks for less time
+RETENTION_BATCH_SIZE = 1000
+
+# The number of free pages each incremental vacuum step returns to the OS
+VACUUM_PAGES = 2000
+
+# The value of SQLite's auto_vacuum pragma in incremental mode
+_SQLITE_INCREMENTAL_VACUUM = 2
+
+
+class _TableArchive:
+    """
+    Archives rows to the message_archive and completion_archive tables, in the same transaction as the delete.
+    """
+
+    def write(
+        self, session: orm.Session, thread: Thread, messages: list, completions: list
+    ) -> None:
+        session.execute(insert(ArchivedMessage), [msg._asdict() for msg in messages])
+
+        if completions:
+            session.execute(
+                insert(ArchivedCompletion),
+                [completion._asdict() for completion in completions],
+            )
+
+    def close(self) -> None:
+        pass
+
+
+class _FileArchive:
+    """
+    Archives rows to a gzipped JSONL file, one line per message with its completions.
+
+    Rows are written before the delete is committed, so a failed batch can be archived twice.
+    """
+
+    def __init__(self, path: str):
+        # Appending adds a new gzip member, which readers decompress as one stream
+        self.file = gzip.open(path, "at", encoding="utf-8")
+
+    def write(
+        self, session: orm.Session, thread: Thread, messages: list, completions: list
+    ) -> None:
+        replies: dict[int, list[dict]] = {}
+        for completion in completions:
+            replies.setdefault(completion.reply_to, []).append(
+                {
+                    "id": completion.id,
+                    "bot": completion.bot,
+                    "score": completion.score,
+                    "message": completion.message,
+                }
+            )
+
+        for msg in messages:
+            self.file.write(
+                json.dumps(
+                    {
+                        "id": msg.id,
+                        "platform": thread.platform,
+                        "thread_name": thread.thread_name,
+                        "username": msg.username,
+                        "message": msg.message,
+                        "time": msg.time.isoformat(),
+                        "completions": replies.get(msg.id, []),
+                    },
+                    ensure_ascii=False,
+                )
+                + "\n"
+            )
+
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class RetentionPolicy:
+    """
+    How long the messages of each thread are kept, the most specific policy for a thread applies.
+    """
+
+    def __init__(
+        self,
+        days: int = RETENTION_DAYS,
+        platforms: dict[str, int] | None = None,
+        threads: dict[tuple[str, str], int] | None = None,
+    ):
+        """
+        :param days: The number of days messages are kept for, 0 keeps them forever.
+        :param platforms: Overrides "days" for every thread on a platform.
+        :param threads: Overrides the other policies for single threads, keyed by platform and thread name.
+        """
+        self.days = days
+        self.platforms = platforms or {}
+        self.threads = threads or {}
+
+    def max_age(self, platform: str, thread_name: str) -> int:
+        """
+        Returns the number of days the messages of a thread are kept for, 0 if they are kept forever.
+        """
+        if (platform, thread_name) in self.threads:
+            return self.threads[(platform, thread_name)]
+
+        return self.platforms.get(platform, self.days)
+
+
+def archive(
+    policy: RetentionPolicy,
+    archive_path: str | None = None,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    now: datetime.datetime | None = None,
+) -> int:
+    """
+    Archive every message older than its thread's policy, except the messages needed to export scored completions.
+
+    :param archive_path: A gzipped JSONL file to archive to instead of the archive tables.
+    :param batch_size: The number of messages archived per transaction.
+    :param now: The time (in UTC) that ages are measured from.
+    :returns: The number of messages archived.
+    """
+    now = now or datetime.datetime.utcnow()
+    target = _FileArchive(archive_path) if archive_path else _TableArchive()
+    archived = 0
+
+    with Session() as session:
+        threads = list(session.scalars(select(Thread)))
+        session.expunge_all()
+
+    try:
+        for thread in threads:
+            if not (days := policy.max_age(thread.platform, thread.thread_name)):
+                continue
+
+            cutoff = now - datetime.timedelta(days=days)
+            after = None
+
+            while True:
+                count, after = _archive_batch(thread, cutoff, target, batch_size, after)
+                if not count:
+                    break
+                archived += count
+
+            logger.debug(f"Archived thread {thread.id} up to {cutoff}")
+    finally:
+        target.close()
+
+    logger.info(f"Archived {archived} messages")
+
+    return archived
+
+
+def _archivable(
+    session: orm.Session,
+    thread: Thread,
+    cutoff: datetime.datetime,
+    batch_size: int,
+    after: tuple[datetime.datetime, int] | None,
+) -> tuple[list[int], tuple[datetime.datetime, int] | None]:
+    """
+    Find the oldest messages of a thread sent before "cutoff" that can be archived.
+
+    Messages with scored completions are kept, along with the MAX_CONTEXT_MESSAGES messages before each of them, as
+     edubot.export builds the context of examples from them.
+
+    :param after: The time and ID of the last message that a previous batch got to.
+    :returns: The IDs of up to "batch_size" messages, and the time and ID of the last message this batch got to.
+    """
+    stmt = (
+        select(Message.id, Message.time)
+        .where(Message.thread == thread.id)
+        .order_by(Message.time, Message.id)
+    )
+    if after is not None:
+        stmt = stmt.where(
+            or_(
+                Message.time > after[0],
+                and_(Message.time == after[0], Message.id > after[1]),
+            )
+        )
+
+    ids: list[int] = []
+    # The newest messages that a scored message could still follow closely enough to keep
+    pending: deque = deque()
+
+    result = session.execute(stmt.execution_options(yield_per=batch_size))
+
+    try:
+        for page in result.partitions():
+            scored = set(
+                session.scalars(
+                    select(Completion.reply_to)
+                    .where(Completion.reply_to.in_([msg.id for msg in page]))
+                    .where(Completion.score != 0)
+                )
+            )
+
+            for msg in page:
+                if msg.id in scored:
+                    pending.clear()
+                    after = (msg.time, msg.id)
+                    continue
+
+                pending.append(msg)
+                if len(pending) <= MAX_CONTEXT_MESSAGES:
+                    continue
+
+                oldest = pending.popleft()
+                if oldest.time >= cutoff:
+                    return ids, after
+
+                ids.append(oldest.id)
+                after = (oldest.time, oldest.id)
+
+                if len(ids) == batch_size:
+                    return ids, after
+    finally:
+        result.close()
+
+    # No scored message follows the newest messages of the thread
+    for msg in pending:
+        if msg.time >= cutoff or len(ids) == batch_size:
+            break
+
+        ids.append(msg.id)
+        after = (msg.time, msg.id)
+
+    return ids, after
+
+
+def _archive_batch(
+    thread: Thread,
+    cutoff: datetime.datetime,
+    target: _TableArchive | _FileArchive,
+    batch_size: int,
+    after: tuple[datetime.datetime, int] | None,
+) -> tuple[int, tuple[datetime.datetime, int] | None]:
+    """
+    Archive the oldest messages of a thread sent before "cutoff" in one transaction.
+
+    :param after: The time and ID of the last message that the previous batch got to.
+    :returns: The number of messages archived, 0 once there are none left, and where the next batch starts.
+    """
+    with Session() as session:
+        ids, after = _archivable(session, thread, cutoff, batch_size, after)
+
+        if not ids:
+            return 0, after
+
+        messages = session.execute(
+            select(
+                Message.id,
+                Message.username,
+                Message.message,
+                Message.time,
+                Message.thread,
+            )
+            .where(Message.id.in_(ids))
+            .order_by(Message.time, Message.id)
+        ).all()
+
+        completions = session.execute(
+            select(
+                Completion.id,
+                Completion.bot,
+                Completion.score,
+                Completion.message,
+                Completion.reply_to,
+            ).where(Completion.reply_to.in_(ids))
+        ).all()
+
+        target.write(session, thread, messages, completions)
+
+        session.execute(delete(Completion).where(Completion.reply_to.in_(ids)))
+        session.execute(delete(Message).where(Message.id.in_(ids)))
+
+        # Invalidate cached context that includes the archived messages
+        queries.touch_thread(session, thread.id)
+
+        session.commit()
+
+    return len(ids), after
+
+
+def compact(full: bool = False) -> None:
+    """
+    Return the space freed by archiving to the OS, only SQLite databases need this.
+
+    Incremental vacuuming frees a few pages per transaction, so the database stays usable while it runs. A full
+     VACUUM rewrites the whole database, blocking writers until it is done, and is only needed once to convert
+     databases created before incremental vacuuming was enabled.
+
+    :param full: Run a full VACUUM instead of an incremental one.
+    """
+    if engine.dialect.name != "sqlite":
+        logger.info(f"Leaving {engine.dialect.name} to reclaim space by itself")
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        mode = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+
+        if full:
+            # Every connection sets auto_vacuum to incremental, so the rewritten database uses it
+            conn.exec_driver_sql("VACUUM")
+        elif mode != _SQLITE_INCREMENTAL_VACUUM:
+            logger.warning(
+                "The database doesn't support incremental vacuuming, compact it with full=True once."
+            )
+            return
+        else:
+            while conn.exec_driver_sql("PRAGMA freelist_count").scalar():
+                conn.exec_driver_sql(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+
+        # Truncate the write-ahead log, which grows to the size of the largest transaction
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    logger.info("Compacted the database")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m edubot.retention",
+        description="Archive old messages and completions, then optionally compact the database.",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=RETENTION_DAYS,
+        help="Days messages are kept for, 0 keeps them forever. Defaults to retention_days in the config.",
+    )
+    parser.add_argument(
+        "--platform",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("PLATFORM", "DAYS"),
+        help="Days messages on a platform are kept for, can be repeated.",
+    )
+    parser.add_argument(
+        "--thread",
+        nargs=3,
+        action="append",
+        default=[],
+        metavar=("PLATFORM", "THREAD", "DAYS"),
+        help="Days messages in a thread are kept for, can be repeated.",
+    )
+    parser.add_argument(
+        "--archive-file",
+        help="Archive to this gzipped JSONL file instead of the archive tables.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=RETENTION_BATCH_SIZE,
+        help="Messages archived per transaction.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Return freed space to the OS afterwards (SQLite only).",
+    )
+    parser.add_argument(
+        "--full-vacuum",
+        action="store_true",
+        help="Rewrite the whole database when compacting, this blocks writers while it runs.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    create_schema()
+
+    policy = RetentionPolicy(
+        args.days,
+        {platform: int(days) for platform, days in args.platform},
+        {(platform, thread): int(days) for platform, thread, days in args.thread},
+    )
+    archive(policy, args.archive_file, args.batch_size)
+
+    if args.compact or args.full_vacuum:
+        compact(full=args.full_vacuum)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Finds older messages of a thread that are relevant to the conversation, so they can be added to the prompt.
+
+Messages and completions are searched with the database's own full-text search, SQLite's FTS5 or PostgreSQL's
+ tsvectors, so no embedding service is needed. The indexes are created by a migration, see edubot.sql.
+
+The newest messages of the conversation are the query, and the best matches sent before the context are added to the
+ prompt in chronological order, along with the bot's replies to them, until RETRIEVAL_TOKENS is used.
+"""
+from __future__ import annotations
+
+import re
+from datetime import datetime
+
+from sqlalchemy import DateTime, bindparam, inspect, select, text
+from sqlalchemy.orm import Session
+
+from edubot import RETRIEVAL_RESULTS, RETRIEVAL_TOKENS
+from edubot.sql import TEXT_SEARCH_CONFIG, Completion, Message
+from edubot.tokens import count_tokens
+
+# The number of newest messages of the conversation that the query is made from
+QUERY_MESSAGES = 3
+# The maximum words in a query, the newest words are kept
+MAX_QUERY_TERMS = 16
+# Words shorter than this are left out of queries
+MIN_TERM_LENGTH = 3
+
+# Common words that would match most messages
+STOP_WORDS = frozenset(
+    "about after again also and any are because been before being but can could did does doing for from had has have"
+    " her here him his how into its just like more most not now off once only other our out over own same she should"
+    " some such than that the their them then there these they this those through too under until very was were what"
+    " when where which while who whom why will with would you your".split()
+)
+
+_SQLITE_SEARCH = """
+SELECT message.id, bm25(message_fts) AS rank
+FROM message_fts JOIN message ON message.id = message_fts.rowid
+WHERE message_fts MATCH :query AND message.thread = :thread AND message.time < :before
+UNION ALL
+SELECT completion.reply_to, bm25(completion_fts) AS rank
+FROM completion_fts JOIN completion ON completion.id = completion_fts.rowid
+JOIN message ON message.id = completion.reply_to
+WHERE completion_fts MATCH :query AND completion.bot = :bot AND message.thread = :thread AND message.time < :before
+ORDER BY rank LIMIT :limit
+"""
+
+_POSTGRES_SEARCH = f"""
+SELECT message.id, -ts_rank(to_tsvector('{TEXT_SEARCH_CONFIG}', message.message), query) AS rank
+FROM message, to_tsquery('{TEXT_SEARCH_CONFIG}', :query) query
+WHERE to_tsvector('{TEXT_SEARCH_CONFIG}', message.message) @@ query
+AND message.thread = :thread AND message.time < :before
+UNION ALL
+SELECT completion.reply_to, -ts_rank(to_tsvector('{TEXT_SEARCH_CONFIG}', completion.message), query) AS rank
+FROM completion JOIN message ON message.id = completion.reply_to, to_tsquery('{TEXT_SEARCH_CONFIG}', :query) query
+WHERE to_tsvector('{TEXT_SEARCH_CONFIG}', completion.message) @@ query
+AND completion.bot = :bot AND message.thread = :thread AND message.time < :before
+ORDER BY rank LIMIT :limit
+"""
+
+# Whether the database has full-text indexes, keyed by dialect name
+_available: dict[str, bool] = {}
+
+
+def enabled() -> bool:
+    return RETRIEVAL_RESULTS > 0
+
+
+def _search_available(session: Session) -> bool:
+    dialect = session.get_bind().dialect.name
+
+    if dialect not in _available:
+        if dialect == "sqlite":
+            _available[dialect] = inspect(session.connection()).has_table("message_fts")
+        else:
+            _available[dialect] = dialect == "postgresql"
+
+    return _available[dialect]
+
+
+def query_terms(texts: list[str]) -> list[str]:
+    """
+    Returns the distinct words of "texts" worth searching for, newest first.
+    """
+    terms: list[str] = []
+
+    for message in reversed(texts):
+        for word in reversed(re.findall(r"\w+", message.lower())):
+            if (
+                len(word) >= MIN_TERM_LENGTH
+                and word not in STOP_WORDS
+                and word not in terms
+            ):
+                terms.append(word)
+
+    return terms[:MAX_QUERY_TERMS]
+
+
+def recall(
+    session: Session,
+    thread_id: int,
+    bot_id: int,
+    username: str,
+    texts: list[str],
+    before: datetime,
+    model: str,
+) -> str | None:
+    """
+    Search a thread for the messages sent before "before" that best match the newest messages of the conversation.
+
+    :param username: The username of the bot, its replies to the messages found are included.
+    :param texts: The messages of the conversation, oldest first.
+    :param before: Only messages sent before this time are searched, E.g. the start of the context.
+    :param model: The model the prompt is sent to, used to count tokens.
+    :returns: The messages found formatted for a system message, or None if nothing was found.
+    """
+    if not _search_available(session) or not (
+        terms := query_terms(texts[-QUERY_MESSAGES:])
+    ):
+        return None
+
+    if session.get_bind().dialect.name == "sqlite":
+        search, query = _SQLITE_SEARCH, " OR ".join(f'"{term}"' for term in terms)
+    else:
+        search, query = _POSTGRES_SEARCH, " | ".join(terms)
+
+    ranked: list[int] = []
+    for msg_id, _ in session.execute(
+        # Times are bound like the DateTime column, so they compare with the stored strings on SQLite
+        text(search).bindparams(bindparam("before", type_=DateTime())),
+        {
+            "query": query,
+            "thread": thread_id,
+            "bot": bot_id,
+            "before": before,
+            "limit": RETRIEVAL_RESULTS * 2,
+        },
+    ):
+        if msg_id not in ranked:
+            ranked.append(msg_id)
+
+    if not ranked:
+        return None
+
+    ranked = ranked[:RETRIEVAL_RESULTS]
+
+    messages = {
+        msg.id: msg
+        for msg in session.scalars(select(Message).where(Message.id.in_(ranked)))
+    }
+    replies: dict[int, str] = {}
+    for reply_to, completion in session.execute(
+        select(Completion.reply_to, Completion.message)
+        .where(Completion.reply_to.in_(ranked))
+        .where(Completion.bot == bot_id)
+        .order_by(Completion.id)
+    ):
+        replies.setdefault(reply_to, completion)
+
+    # Keep the best matches that fit in the budget, then show them in the order they were sent
+    found: list[Message] = []
+    tokens = 0
+    for msg_id in ranked:
+        msg = messages[msg_id]
+        tokens += count_tokens(_format(msg, username, replies.get(msg_id)), model)
+
+        if tokens > RETRIEVAL_TOKENS:
+            break
+        found.append(msg)
+
+    if not found:
+        return None
+
+    found.sort(key=lambda msg: (msg.time, msg.id))
+
+    return (
+        "Earlier messages in this chat that may be relevant to the conversation:\n"
+        + ("\n".join(_format(msg, username, replies.get(msg.id)) for msg in found))
+    )
+
+
+def _format(msg: Message, username: str, reply: str | None) -> str:
+    line = f"[{msg.time:%Y-%m-%d %H:%M}] {msg.username}: {msg.message}"
+
+    if reply is not None:
+        line += f"\n{username}: {reply}"
+
+    return line
@@ -1,17 +1,179 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+
 from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
+    bindparam,
     create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    update,
 )
+from sqlalchemy.engine import URL, Connection, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session as OrmSession
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from edubot import (
+    ASYNC_DATABASE,
+    DATABASE,
+    DATABASE_ECHO,
+    DATABASE_MAX_OVERFLOW,
+    DATABASE_POOL_RECYCLE,
+    DATABASE_POOL_SIZE,
+    DATABASE_STATEMENT_TIMEOUT,
+    deadlines,
+    metrics,
+)
+
+logger = logging.getLogger(__name__)
+
+# The async driver used for each database backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+# The PostgreSQL text search configuration used to index and search messages, see edubot.retrieval
+TEXT_SEARCH_CONFIG = "english"
+
+# The key of the PostgreSQL advisory lock held while the schema is created or migrated
+SCHEMA_LOCK_KEY = 0x6564756274
+
+# Memory mapped I/O and page cache sizes for SQLite connections
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+
+
+def _engine_options(url: str | URL) -> dict:
+    """
+    Build the create_engine() keyword arguments for a database URL from the config.
+    """
+    url = make_url(url)
+    options: dict = {"echo": DATABASE_ECHO, "future": True}
+
+    if url.get_backend_name() == "sqlite":
+        if DATABASE_STATEMENT_TIMEOUT:
+            # How long to wait for another connection's write lock before failing
+            options["connect_args"] = {"timeout": DATABASE_STATEMENT_TIMEOUT}
+
+        # In-memory databases use a pool without a size
+        if url.database in (None, "", ":memory:"):
+            return options
+
+        if url.get_driver_name() == "aiosqlite":
+            # Every aiosqlite connection has a thread that would keep the process alive while pooled, and SQLite
+            #  connections are cheap to open, so they aren't pooled
+            options["poolclass"] = NullPool
+            return options
+    elif url.get_backend_name() == "postgresql" and DATABASE_STATEMENT_TIMEOUT:
+        timeout_ms = int(DATABASE_STATEMENT_TIMEOUT * 1000)
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {
+                "server_settings": {"statement_timeout": str(timeout_ms)}
+            }
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout_ms}"}
+
+    options["pool_size"] = DATABASE_POOL_SIZE
+    options["max_overflow"] = DATABASE_MAX_OVERFLOW
+    options["pool_recycle"] = DATABASE_POOL_RECYCLE
+
+    return options
+
+
+def _configure_sqlite(dbapi_connection, connection_record) -> None:
+    """
+    Tune every new SQLite connection for concurrent readers and writers.
+    """
+    cursor = dbapi_connection.cursor()
+    # Pages freed by retention can be returned to the OS without rewriting the whole file, see edubot.retention
+    # Only takes effect for new databases so it is set first, existing ones are converted by a full VACUUM
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # Readers don't block writers, and writers don't block readers
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Safe in WAL mode, commits no longer wait for the disk to sync
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    # Negative values are in KiB rather than pages
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+
 
-from edubot import DATABASE
+engine = create_engine(DATABASE, **_engine_options(DATABASE))
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _configure_sqlite)
+
+event.listen(engine, "before_cursor_execute", metrics.count_query)
+# Statements aren't started after the deadline of the call in progress
+event.listen(engine, "before_cursor_execute", deadlines.check)
+
+
+def _limit_statement_time(session, transaction, connection) -> None:
+    """
+    Cancel PostgreSQL statements that run past the deadline of the call in progress, see edubot.deadlines.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+
+    if (left := deadlines.remaining()) is not None:
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {max(int(left * 1000), 1)}"
+        )
+
+
+# Applies to the sessions of both engines
+event.listen(OrmSession, "after_begin", _limit_statement_time)
+
+# This is lazy loaded as it requires an async driver
+_async_sessionmaker = None
+
+
+def async_session():
+    """
+    Create a session bound to the async engine, used by AsyncEduBot.
+
+    The engine uses ASYNC_DATABASE, or DATABASE with its driver swapped for aiosqlite or asyncpg.
+    """
+    global _async_sessionmaker
+
+    if _async_sessionmaker is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        if ASYNC_DATABASE:
+            url = make_url(ASYNC_DATABASE)
+        else:
+            url = make_url(DATABASE)
+            url = url.set(
+                drivername=f"{url.get_backend_name()}+{ASYNC_DRIVERS[url.get_backend_name()]}"
+            )
+
+        async_engine = create_async_engine(url, **_engine_options(url))
+
+        if async_engine.dialect.name == "sqlite":
+            event.listen(async_engine.sync_engine, "connect", _configure_sqlite)
+
+        event.listen(
+            async_engine.sync_engine, "before_cursor_execute", metrics.count_query
+        )
+        event.listen(async_engine.sync_engine, "before_cursor_execute", deadlines.check)
+
+        _async_sessionmaker = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    return _async_sessionmaker()
 
-engine = create_engine(DATABASE, echo=True, future=True)
 
 Base = declarative_base()
 
@@ -36,11 +198,40 @@ class Thread(Base):
     # Identifier for this thread that is unique for this platform
     thread_name = Column(String, nullable=False)
 
+    # Incremented by every write to the thread's messages or completions, used to invalidate cached context
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+
     # Delete all messages within this thread if the thread is deleted
     messages = relationship("Message", cascade="all, delete")
 
     # Threads cannot have the same name on the same platform
-    UniqueConstraint(thread_name, platform)
+    __table_args__ = (UniqueConstraint(thread_name, platform),)
+
+
+def message_fingerprint(
+    thread: int, username: str, time: datetime, message: str
+) -> str:
+    """
+    Returns a compact hash that identifies a message, used to find messages without comparing their full text.
+    """
+    # Times are stored without a timezone, so aware times are normalised to naive UTC
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (str(thread), username, time.isoformat(), message):
+        digest.update(part.encode())
+        # Separate the fields so that different splits of the same text don't collide
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def _default_fingerprint(context) -> str:
+    params = context.get_current_parameters()
+    return message_fingerprint(
+        params["thread"], params["username"], params["time"], params["message"]
+    )
 
 
 class Message(Base):
@@ -63,7 +254,16 @@ class Message(Base):
     thread = Column(Integer, ForeignKey("thread.id"), nullable=False)
 
     # Someone cannot write the same message at the same time in the same thread
-    UniqueConstraint(username, message, time, thread)
+    fingerprint = Column(
+        String(32),
+        nullable=False,
+        unique=True,
+        index=True,
+        default=_default_fingerprint,
+    )
+
+    # Context is loaded by thread and time
+    __table_args__ = (Index("ix_message_thread_time", thread, time),)
 
 
 class Completion(Base):
@@ -86,6 +286,9 @@ class Completion(Base):
     # The message the bot was replying to
     reply_to = Column(Integer, ForeignKey("message.id"), nullable=False)
 
+    # Completions are looked up by the bot that wrote them and the message they reply to
+    __table_args__ = (Index("ix_completion_bot_reply_to", bot, reply_to),)
+
 
 class Bot(Base):
     """
@@ -106,8 +309,452 @@ class Bot(Base):
     completions = relationship("Completion", cascade="all, delete")
 
     # Two bots with the same username cannot operate on the same platform
-    UniqueConstraint(username, platform)
+    __table_args__ = (UniqueConstraint(username, platform),)
+
+
+class UrlSummary(Base):
+    """
+    Table caching the summaries of web pages, including pages that couldn't be summarised.
+    """
+
+    __tablename__ = "url_summary"
+
+    id = Column(Integer, primary_key=True)
+
+    # A hash of the normalised URL, used to look up pages
+    url_hash = Column(String(32), nullable=False, unique=True, index=True)
+
+    url = Column(String(2000), nullable=False)
+
+    # A hash of the page's plaintext, used to reuse summaries of pages served from several URLs
+    content_hash = Column(String(32), index=True)
+
+    # The summary, or None if the page couldn't be summarised
+    summary = Column(String(5000))
+
+    # Why the page was or wasn't summarised, see edubot.url_cache
+    outcome = Column(String(20), nullable=False)
+
+    # The time (in UTC) that this entry stops being used
+    expires = Column(DateTime(), nullable=False)
+
+    # The time (in UTC) that this entry was last used, the least recently used entries are evicted first
+    last_used = Column(DateTime(), nullable=False, index=True)
+
+
+class ImageCaption(Base):
+    """
+    Table caching the AI generated captions of images, so an image posted many times is only captioned once.
+    """
+
+    __tablename__ = "image_caption"
+
+    id = Column(Integer, primary_key=True)
+
+    # The image's dimensions and perceptual hash from edubot.captions.cache_key
+    image_hash = Column(String(128), nullable=False, unique=True, index=True)
+
+    caption = Column(String(5000), nullable=False)
+
+    # The time (in UTC) that this entry was last used, the least recently used entries are evicted first
+    last_used = Column(DateTime(), nullable=False, index=True)
+
+
+class ImageCaptionBucket(Base):
+    """
+    Table of the buckets each cached caption's perceptual hash is in, used to find the captions of similar images.
+    """
+
+    __tablename__ = "image_caption_bucket"
+
+    id = Column(Integer, primary_key=True)
+
+    caption = Column(
+        Integer, ForeignKey("image_caption.id"), nullable=False, index=True
+    )
+
+    # One band of the perceptual hash combined with its position, see edubot.captions
+    bucket = Column(Integer, nullable=False, index=True)
+
+
+class CachedCompletion(Base):
+    """
+    Table caching completions by their prompt, so an identical prompt isn't sent to OpenAI twice.
+    """
+
+    __tablename__ = "completion_cache"
+
+    id = Column(Integer, primary_key=True)
+
+    # A hash of the prompt messages and the settings they are sent with, see edubot.gateway.request_key
+    prompt_hash = Column(String(64), nullable=False, unique=True, index=True)
+
+    completion = Column(String(5000), nullable=False)
+
+    # The time (in UTC) that this entry stops being used
+    expires = Column(DateTime(), nullable=False)
+
+    # The time (in UTC) that this entry was last used, the least recently used entries are evicted first
+    last_used = Column(DateTime(), nullable=False, index=True)
+
+
+class ThreadSummary(Base):
+    """
+    Table for the rolling summary of each thread's older messages, see edubot.thread_summaries.
+    """
+
+    __tablename__ = "thread_summary"
+
+    id = Column(Integer, primary_key=True)
+
+    thread = Column(Integer, ForeignKey("thread.id"), nullable=False)
+
+    # The bot whose replies are included in the summary
+    bot = Column(Integer, ForeignKey("bot.id"), nullable=False)
+
+    summary = Column(String, nullable=False)
+
+    # The time (in UTC) and ID of the newest message the summary covers
+    until_time = Column(DateTime(), nullable=False)
+    until_id = Column(Integer, nullable=False)
+
+    # The time (in UTC) that the summary was last updated
+    updated = Column(DateTime(), nullable=False)
+
+    # Each bot has one summary of a thread
+    __table_args__ = (UniqueConstraint(thread, bot),)
+
+
+class Job(Base):
+    """
+    Table for EduBot calls queued to run in worker processes, see edubot.jobs.
+    """
+
+    __tablename__ = "job"
+
+    id = Column(Integer, primary_key=True)
+
+    # The EduBot method that is called, E.g. 'gpt_answer'
+    kind = Column(String(30), nullable=False)
+
+    # The thread the call is for, jobs for the same thread run one at a time in the order they were submitted
+    platform = Column(String(100), nullable=False)
+    thread_name = Column(String, nullable=False)
+
+    # Jobs with a higher priority are run first
+    priority = Column(Integer, nullable=False, default=0)
+
+    # pending, running, done or failed
+    status = Column(String(10), nullable=False, default="pending")
+
+    # JSON of the bot and the arguments of the call
+    payload = Column(String, nullable=False)
+
+    # JSON of the value returned by the call, or the error that failed it
+    result = Column(String)
+    error = Column(String)
+
+    # The number of times the job has been started
+    attempts = Column(Integer, nullable=False, default=0)
+
+    # The times (in UTC) that the job was submitted, last started and finished
+    created = Column(DateTime(), nullable=False, default=datetime.utcnow)
+    started = Column(DateTime())
+    finished = Column(DateTime())
+
+    # Identifies the worker process running the job, E.g. 'host:1234'
+    worker = Column(String(100))
+
+    __table_args__ = (
+        # Workers claim the pending job with the highest priority
+        Index("ix_job_status_priority", status, priority, id),
+        # Jobs wait for the earlier jobs of their thread
+        Index("ix_job_thread", platform, thread_name, id),
+    )
+
+
+class ArchivedMessage(Base):
+    """
+    Table for messages moved out of the message table by edubot.retention, it has no indexes besides its key.
+    """
+
+    __tablename__ = "message_archive"
+
+    # The ID the message had in the message table
+    id = Column(Integer, primary_key=True)
+
+    username = Column(String(100), nullable=False)
+
+    message = Column(String(5000), nullable=False)
+
+    # The time (in UTC) that this message was sent
+    time = Column(DateTime(), nullable=False)
+
+    thread = Column(Integer, ForeignKey("thread.id"), nullable=False)
+
+
+class ArchivedCompletion(Base):
+    """
+    Table for completions archived along with the message they reply to.
+    """
+
+    __tablename__ = "completion_archive"
+
+    # The ID the completion had in the completion table
+    id = Column(Integer, primary_key=True)
+
+    bot = Column(Integer, ForeignKey("bot.id"), nullable=False)
+
+    score = Column(Integer, nullable=False)
+
+    message = Column(String(5000), nullable=False)
+
+    # The ID of the archived message it replies to
+    reply_to = Column(Integer, ForeignKey("message_archive.id"), nullable=False)
+
+
+class SchemaVersion(Base):
+    """
+    Table recording which schema migrations have been applied to the database.
+    """
+
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+
+    # The time (in UTC) that the migration was applied
+    applied = Column(DateTime(), nullable=False, default=datetime.utcnow)
+
+
+def _add_message_fingerprints(conn: Connection, batch_size: int = 5000) -> None:
+    """
+    Add and fill in the fingerprint column of a message table created before it existed.
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("message")}
+    if "fingerprint" in columns:
+        return
+
+    logger.info("Adding fingerprints to the message table.")
+
+    table = Message.__table__
+
+    conn.execute(text("ALTER TABLE message ADD COLUMN fingerprint VARCHAR(32)"))
+
+    last_id = 0
+
+    while rows := conn.execute(
+        select(
+            table.c.id,
+            table.c.thread,
+            table.c.username,
+            table.c.time,
+            table.c.message,
+        )
+        .where(table.c.id > last_id)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    ).all():
+        last_id = rows[-1].id
+
+        conn.execute(
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values(fingerprint=bindparam("_fingerprint")),
+            [
+                {
+                    "_id": row.id,
+                    "_fingerprint": message_fingerprint(
+                        row.thread, row.username, row.time, row.message
+                    ),
+                }
+                for row in rows
+            ],
+        )
+
+    for index in table.indexes:
+        if index.name == "ix_message_fingerprint":
+            index.create(conn)
+
+
+def _add_lookup_indexes(conn: Connection) -> None:
+    """
+    Add the composite indexes used by context and completion lookups.
+    """
+    for table in (Message.__table__, Completion.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _add_thread_versions(conn: Connection) -> None:
+    """
+    Add the version column to a thread table created before it existed.
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("thread")}
+    if "version" in columns:
+        return
+
+    conn.execute(
+        text("ALTER TABLE thread ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    )
+
+
+def _add_full_text_indexes(conn: Connection) -> None:
+    """
+    Index the text of messages and completions for edubot.retrieval.
+
+    SQLite uses FTS5 tables kept up to date by triggers, PostgreSQL uses GIN indexes of tsvectors.
+    """
+    if conn.dialect.name == "postgresql":
+        for table in ("message", "completion"):
+            conn.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_text_search ON {table} "
+                    f"USING GIN (to_tsvector('{TEXT_SEARCH_CONFIG}', message))"
+                )
+            )
+        return
+
+    if conn.dialect.name != "sqlite":
+        logger.warning(
+            f"Full-text search isn't supported on {conn.dialect.name}, retrieval is disabled."
+        )
+        return
+
+    try:
+        # A savepoint, so a SQLite without FTS5 doesn't fail the rest of the migration
+        with conn.begin_nested():
+            for table in ("message", "completion"):
+                conn.execute(
+                    text(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts "
+                        f"USING fts5(message, content='{table}', content_rowid='id')"
+                    )
+                )
+                conn.execute(
+                    text(
+                        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+                        f"INSERT INTO {table}_fts(rowid, message) VALUES (new.id, new.message); END"
+                    )
+                )
+                conn.execute(
+                    text(
+                        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+                        f"INSERT INTO {table}_fts({table}_fts, rowid, message) VALUES ('delete', old.id, old.message); "
+                        "END"
+                    )
+                )
+                conn.execute(
+                    text(
+                        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF message ON {table} BEGIN "
+                        f"INSERT INTO {table}_fts({table}_fts, rowid, message) VALUES ('delete', old.id, old.message); "
+                        f"INSERT INTO {table}_fts(rowid, message) VALUES (new.id, new.message); END"
+                    )
+                )
+                # Index the rows written before the table existed
+                conn.execute(
+                    text(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+                )
+    except OperationalError as e:
+        logger.warning(f"SQLite was built without FTS5, retrieval is disabled: {e}")
+
+
+def _rekey_image_captions(conn: Connection) -> None:
+    """
+    Drop the captions cached by the 64 bit perceptual hashes of images, which different images often share, and widen
+     the column for the keys that replaced them.
+    """
+    conn.execute(delete(ImageCaption))
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("ALTER TABLE image_caption ALTER COLUMN image_hash TYPE VARCHAR(128)")
+        )
+
+
+def _add_caption_buckets(conn: Connection) -> None:
+    """
+    Drop the captions cached by exact image content, they have no buckets to be found by.
+    """
+    conn.execute(delete(ImageCaption))
+
+
+# Migrations bring databases created by older versions up to date, in order.
+# Each one is given the connection of the transaction that records it, and is idempotent because new databases are
+#  already created with the latest schema.
+# Never reorder or remove entries, only append new ones.
+MIGRATIONS = [
+    _add_message_fingerprints,
+    _add_lookup_indexes,
+    _add_thread_versions,
+    _add_full_text_indexes,
+    _rekey_image_captions,
+    _add_caption_buckets,
+]
+
+
+def _lock_schema(conn: Connection) -> None:
+    """
+    Take a lock held until the end of the connection's transaction, so processes starting together change the schema
+     one at a time.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY}
+        )
+    elif conn.dialect.name == "sqlite":
+        # Takes the database's write lock now rather than at the first write, waiting for other writers
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _schema_version(conn: Connection) -> int:
+    return conn.scalar(select(func.max(SchemaVersion.version))) or 0
+
+
+def migrate() -> None:
+    """
+    Apply any migrations that haven't been applied to the database yet.
+
+    Each migration is recorded in the same transaction that applies it, under a lock so it is only applied once.
+    """
+    with engine.connect() as conn:
+        current = _schema_version(conn)
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+
+        with engine.begin() as conn:
+            _lock_schema(conn)
+
+            # Another process may have applied it while this one waited for the lock
+            if version <= _schema_version(conn):
+                continue
+
+            logger.info(f"Migrating database to schema version {version}.")
+            migration(conn)
+
+            conn.execute(insert(SchemaVersion).values(version=version))
+
+
+# Guards the schema being created by several threads at once
+_schema_lock = threading.Lock()
+_schema_created = False
+
+
+def create_schema() -> None:
+    """
+    Create tables if they aren't already and apply migrations, this only happens once per process.
+    """
+    global _schema_created
+
+    with _schema_lock:
+        if _schema_created:
+            return
+
+        with engine.begin() as conn:
+            _lock_schema(conn)
+            Base.metadata.create_all(conn)
 
+        migrate()
 
-# Create Tables if they aren't already
-Base.metadata.create_all(engine)
+        _schema_created = True
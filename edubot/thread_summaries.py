@@ -0,0 +1,238 @@
+"""
+Rolling summaries of the older messages in each thread, so prompts stay small without losing long-range context.
+
+Once ROLLING_SUMMARY_BATCH messages have aged out of the window of the ROLLING_SUMMARY_WINDOW newest messages, they
+ are folded into the thread's summary by a background request. Prompts then contain the system messages, the summary
+ and only the messages that the summary doesn't cover yet.
+
+Each bot has its own summary of a thread, as it includes the bot's own replies.
+"""
+from __future__ import annotations
+
+import threading
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import and_, desc, func, or_, select
+from sqlalchemy.orm import Session
+
+from edubot import ROLLING_SUMMARY_BATCH, ROLLING_SUMMARY_WINDOW, queries
+from edubot.sql import Message, ThreadSummary
+from edubot.tokens import count_tokens, truncate_tokens
+
+# Prompt for GPT to fold new messages into the summary of a conversation
+THREAD_SUMMARY_PROMPT = (
+    "Your input is the summary of a chat conversation so far, followed by the messages sent after it. "
+    "Rewrite the summary so that it also covers the new messages.\n"
+    "Keep the names of the participants, the questions they asked, and the facts, decisions and answers given. "
+    "Leave out greetings and small talk.\n"
+    "Return only the summary, in no more than 300 words.\n"
+)
+
+# The most tokens of messages folded into a summary by one request, the rest are folded by the next update
+MAX_FOLD_TOKENS = 8000
+# The number of messages loaded at a time while filling a request
+FOLD_PAGE_SIZE = 100
+# The number of messages outside the window that the first summary of a thread covers, so enabling rolling summaries
+#  doesn't send the whole history of every long thread to GPT
+FIRST_SUMMARY_MESSAGES = 500
+
+# The threads whose summary this process is updating, keyed by thread and bot
+_updating: set[tuple[int, int]] = set()
+_updating_lock = threading.Lock()
+
+
+class Backlog(NamedTuple):
+    """
+    The messages of a thread that have aged out of the window, and the summary they are folded into.
+    """
+
+    thread_id: int
+    bot_id: int
+    # The current summary, None if the thread doesn't have one yet
+    summary: str | None
+    # The ID of the newest message covered by the current summary
+    until_id: int | None
+    # The messages to fold as "username: message" lines, and the time and ID of the newest one
+    lines: list[str]
+    last_time: datetime
+    last_id: int
+
+
+def enabled() -> bool:
+    return ROLLING_SUMMARY_WINDOW > 0
+
+
+def claim(thread_id: int, bot_id: int) -> bool:
+    """
+    Returns whether this caller should update the summary of a thread, only one update runs at a time in a process.
+
+    Call release() once the update is done.
+    """
+    with _updating_lock:
+        if (thread_id, bot_id) in _updating:
+            return False
+
+        _updating.add((thread_id, bot_id))
+        return True
+
+
+def release(thread_id: int, bot_id: int) -> None:
+    with _updating_lock:
+        _updating.discard((thread_id, bot_id))
+
+
+def lookup(
+    session: Session, thread_id: int, bot_id: int
+) -> tuple[str, datetime] | None:
+    """
+    Get the summary of a thread and the time of the newest message it covers.
+    """
+    row = session.execute(
+        select(ThreadSummary.summary, ThreadSummary.until_time)
+        .where(ThreadSummary.thread == thread_id)
+        .where(ThreadSummary.bot == bot_id)
+    ).first()
+
+    return None if row is None else (row.summary, row.until_time)
+
+
+def recent(summary: tuple[str, datetime] | None, context: list) -> list:
+    """
+    Returns the messages of the context that the summary doesn't cover.
+    """
+    if summary is None:
+        return context
+
+    _, until = summary
+    return [msg for msg in context if msg["time"] > until]
+
+
+def backlog(
+    session: Session, thread_id: int, bot_id: int, username: str, model: str
+) -> Backlog | None:
+    """
+    Get the oldest messages that have aged out of the window, if there are enough to update the summary.
+
+    Only the messages folded by one request are loaded, up to MAX_FOLD_TOKENS. A thread without a summary starts from
+     its FIRST_SUMMARY_MESSAGES newest messages outside the window, older messages are never summarised.
+
+    :param username: The username of the bot, its replies are included.
+    :param model: The model the messages are sent to, used to count their tokens.
+    """
+    current = session.scalar(
+        select(ThreadSummary)
+        .where(ThreadSummary.thread == thread_id)
+        .where(ThreadSummary.bot == bot_id)
+    )
+
+    if current is not None:
+        start = (current.until_time, current.until_id)
+    else:
+        start = session.execute(
+            select(Message.time, Message.id)
+            .where(Message.thread == thread_id)
+            .order_by(desc(Message.time), desc(Message.id))
+            .offset(ROLLING_SUMMARY_WINDOW + FIRST_SUMMARY_MESSAGES)
+            .limit(1)
+        ).first()
+
+    stmt = select(Message).where(Message.thread == thread_id)
+    if start is not None:
+        stmt = stmt.where(
+            or_(
+                Message.time > start[0],
+                and_(Message.time == start[0], Message.id > start[1]),
+            )
+        )
+
+    unsummarised = session.scalar(
+        stmt.with_only_columns(func.count(Message.id)).order_by(None)
+    )
+    if unsummarised < ROLLING_SUMMARY_WINDOW + ROLLING_SUMMARY_BATCH:
+        return None
+
+    lines: list[str] = []
+    tokens = 0
+    last: Message | None = None
+
+    result = session.scalars(
+        stmt.order_by(Message.time, Message.id)
+        .limit(unsummarised - ROLLING_SUMMARY_WINDOW)
+        .execution_options(yield_per=FOLD_PAGE_SIZE)
+    )
+
+    try:
+        for page in result.partitions():
+            completions = queries.completions_to(
+                session, bot_id, [msg.id for msg in page]
+            )
+
+            for msg in page:
+                text = f"{msg.username}: {msg.message}"
+                if completion := completions.get(msg.id):
+                    text += f"\n{username}: {completion}"
+
+                tokens += count_tokens(text, model)
+                if lines and tokens > MAX_FOLD_TOKENS:
+                    break
+
+                lines.append(truncate_tokens(text, MAX_FOLD_TOKENS, model))
+                last = msg
+
+            if tokens > MAX_FOLD_TOKENS:
+                break
+    finally:
+        result.close()
+
+    return Backlog(
+        thread_id,
+        bot_id,
+        current and current.summary,
+        current and current.until_id,
+        lines,
+        last.time,
+        last.id,
+    )
+
+
+def request_messages(backlog: Backlog) -> list[dict]:
+    """
+    Returns the messages of the request that folds a backlog into its summary.
+    """
+    return [
+        {"role": "system", "content": THREAD_SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"Summary so far: {backlog.summary or 'The conversation has just started.'}\n\n"
+            "New messages:\n" + "\n".join(backlog.lines),
+        },
+    ]
+
+
+def store(session: Session, backlog: Backlog, summary: str) -> bool:
+    """
+    Save the summary that a backlog was folded into.
+
+    :returns: False if the summary was updated by someone else since the backlog was read, it is then not saved.
+    """
+    current = session.scalar(
+        select(ThreadSummary)
+        .where(ThreadSummary.thread == backlog.thread_id)
+        .where(ThreadSummary.bot == backlog.bot_id)
+        .with_for_update()
+    )
+
+    if (current and current.until_id) != backlog.until_id:
+        return False
+
+    if current is None:
+        current = ThreadSummary(thread=backlog.thread_id, bot=backlog.bot_id)
+        session.add(current)
+
+    current.summary = summary
+    current.until_time = backlog.last_time
+    current.until_id = backlog.last_id
+    current.updated = datetime.utcnow()
+
+    return True
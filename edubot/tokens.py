@@ -0,0 +1,129 @@
+"""
+Token counting and prompt budgeting.
+"""
+from __future__ import annotations
+
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# The number of distinct texts whose token counts are remembered
+TOKEN_CACHE_SIZE = 65536
+# Only the counts of texts up to this many characters are remembered, E.g. chat messages. Longer texts like web pages
+#  rarely repeat, and caching them would keep up to TOKEN_CACHE_SIZE of them alive
+MAX_CACHED_TEXT_LENGTH = 1024
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding of a model, loading it only once per model.
+    """
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Returns the number of tokens "text" is encoded to by "model".
+
+    Counts of short texts are memoized, so messages that appear in consecutive contexts are only tokenized once.
+    """
+    if len(text) > MAX_CACHED_TEXT_LENGTH:
+        return len(get_encoding(model).encode(text))
+
+    return _count_short(text, model)
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _count_short(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def clear_cache() -> None:
+    """
+    Forget the memoized token counts.
+    """
+    _count_short.cache_clear()
+
+
+def newest_within_budget(counts: list[int], budget: int) -> int:
+    """
+    Find the oldest message that can be kept if the newest messages are kept first.
+
+    :param counts: The token count of each message in chronological order.
+    :param budget: The maximum number of tokens the kept messages can add up to.
+    :return: The index of the first message to keep, len(counts) if none fit.
+    """
+    # Running totals from the newest message backwards, these never decrease so they can be bisected
+    totals = list(accumulate(reversed(counts)))
+    return len(counts) - bisect_right(totals, budget)
+
+
+class TokenBudget:
+    """
+    Selects the messages that make up a prompt without exceeding a token limit.
+    """
+
+    def __init__(self, model: str, max_tokens: int):
+        """
+        :param model: The model whose encoding is used to count tokens.
+        :param max_tokens: The maximum number of tokens a prompt can contain.
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def count(self, text: str) -> int:
+        """
+        Returns the number of tokens in "text".
+        """
+        return count_tokens(text, self.model)
+
+    def fit(self, system: list[str], history: list[str]) -> int:
+        """
+        Find how much chat history fits in the prompt alongside the system messages.
+
+        System messages are always kept, the remaining budget is filled with the newest history.
+
+        :param system: The content of the system messages.
+        :param history: The content of the chat history in chronological order.
+        :return: The index of the oldest history message to keep.
+        """
+        remaining = self.max_tokens - sum(self.count(text) for text in system)
+        return newest_within_budget(
+            [self.count(text) for text in history], max(remaining, 0)
+        )
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    """
+    Cut "text" down to at most "max_tokens" tokens, encoding it only once.
+    """
+    enc = get_encoding(model)
+    tokens = enc.encode(text)
+
+    if len(tokens) <= max_tokens:
+        return text
+
+    return enc.decode(tokens[:max_tokens])
+
+
+def split_tokens(text: str, chunk_tokens: int, model: str) -> list[str]:
+    """
+    Split "text" into consecutive chunks of at most "chunk_tokens" tokens, encoding it only once.
+    """
+    enc = get_encoding(model)
+    tokens = enc.encode(text)
+
+    if len(tokens) <= chunk_tokens:
+        return [text]
+
+    return [
+        enc.decode(tokens[start : start + chunk_tokens])
+        for start in range(0, len(tokens), chunk_tokens)
+    ]
@@ -2,10 +2,13 @@
 Custom types
 """
 # TODO: Consider replacing these with langchain objects/db
+from __future__ import annotations
+
 from datetime import datetime
-from typing import TypedDict
+from typing import TYPE_CHECKING, TypedDict
 
-import PIL.Image
+if TYPE_CHECKING:
+    import PIL.Image
 
 
 class MessageInfo(TypedDict):
@@ -37,3 +40,18 @@ class CompletionInfo(TypedDict):
 
     message: str
     time: datetime
+
+
+class CompletionText(str):
+    """
+    The text of a completion written by the bot, with the ID that identifies it in the database.
+
+    Integrations can store the ID with the posted message and pass it to EduBot.change_completion_score.
+    """
+
+    id: int
+
+    def __new__(cls, text: str, completion_id: int) -> CompletionText:
+        completion = super().__new__(cls, text)
+        completion.id = completion_id
+        return completion
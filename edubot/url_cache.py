@@ -0,0 +1,165 @@
+"""
+Database cache of web page summaries, so a link shared in many threads is only fetched and summarised once.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from edubot import URL_CACHE_NEGATIVE_TTL, URL_CACHE_SIZE, URL_CACHE_TTL
+from edubot.queries import upsert
+from edubot.sql import UrlSummary
+
+# Outcomes of summarising a page
+SUMMARISED = "summarised"
+NO_CONTENT = "no_content"
+FETCH_FAILED = "fetch_failed"
+
+# How long each outcome is cached for, fetch failures are often temporary so they are retried sooner
+TTLS = {
+    SUMMARISED: timedelta(hours=URL_CACHE_TTL),
+    NO_CONTENT: timedelta(hours=URL_CACHE_NEGATIVE_TTL),
+    FETCH_FAILED: timedelta(hours=min(URL_CACHE_NEGATIVE_TTL, 1)),
+}
+
+# Query parameters that only track where a link was shared, they don't change the page
+TRACKING_PARAMS = {"fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "ref_src"}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalise_url(url: str) -> str:
+    """
+    Returns a canonical form of a URL so that links to the same page share a cache entry.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+        )
+    )
+
+    # The fragment is never sent to the server
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def _hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def content_hash(text: str) -> str:
+    """
+    Returns the hash used to find summaries of pages with the same plaintext.
+    """
+    return _hash(text)
+
+
+def url_hash(url: str) -> str:
+    """
+    Returns the hash a URL is cached under.
+    """
+    return _hash(normalise_url(url))
+
+
+def lookup(session: Session, urls: list[str]) -> dict[str, UrlSummary]:
+    """
+    Get the unexpired cache entries of several URLs, marking them as recently used.
+
+    :returns: The entries that were found, keyed by url_hash().
+    """
+    now = datetime.utcnow()
+
+    entries = {
+        entry.url_hash: entry
+        for entry in session.scalars(
+            select(UrlSummary)
+            .where(UrlSummary.url_hash.in_({url_hash(url) for url in urls}))
+            .where(UrlSummary.expires > now)
+        )
+    }
+
+    for entry in entries.values():
+        entry.last_used = now
+
+    return entries
+
+
+def lookup_content(session: Session, text_hashes: list[str]) -> dict[str, str]:
+    """
+    Get unexpired summaries of pages with the same plaintext as other pages.
+
+    :returns: The summaries that were found, keyed by content_hash().
+    """
+    if not text_hashes:
+        return {}
+
+    return {
+        text_hash: summary
+        for text_hash, summary in session.execute(
+            select(UrlSummary.content_hash, UrlSummary.summary)
+            .where(UrlSummary.content_hash.in_(set(text_hashes)))
+            .where(UrlSummary.outcome == SUMMARISED)
+            .where(UrlSummary.expires > datetime.utcnow())
+        )
+    }
+
+
+def store(
+    session: Session,
+    url: str,
+    outcome: str,
+    summary: str | None = None,
+    text_hash: str | None = None,
+) -> None:
+    """
+    Cache the outcome of summarising a URL.
+
+    :param url: The URL that was summarised.
+    :param outcome: One of SUMMARISED, NO_CONTENT or FETCH_FAILED.
+    :param summary: The summary of the page, if there is one.
+    :param text_hash: The content_hash() of the page's plaintext, if it was fetched.
+    """
+    now = datetime.utcnow()
+    normalised = normalise_url(url)
+
+    upsert(
+        session,
+        UrlSummary,
+        {
+            "url_hash": _hash(normalised),
+            "url": normalised[:2000],
+            "content_hash": text_hash,
+            "summary": summary,
+            "outcome": outcome,
+            "expires": now + TTLS[outcome],
+            "last_used": now,
+        },
+        ["url_hash"],
+    )
+
+
+def evict(session: Session) -> None:
+    """
+    Delete expired entries, then the least recently used entries past URL_CACHE_SIZE.
+    """
+    session.execute(delete(UrlSummary).where(UrlSummary.expires <= datetime.utcnow()))
+
+    excess = session.scalar(select(func.count(UrlSummary.id))) - URL_CACHE_SIZE
+    if excess > 0:
+        session.execute(
+            delete(UrlSummary).where(
+                UrlSummary.id.in_(
+                    select(UrlSummary.id).order_by(UrlSummary.last_used).limit(excess)
+                )
+            )
+        )